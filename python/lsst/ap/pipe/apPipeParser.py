@@ -62,6 +62,41 @@ class ApPipeParser(pipeBase.ArgumentParser):
 
         self.addReuseOption(["ccdProcessor", "differencer", "diaPipe"])
 
+        self.add_argument("--plan", metavar="PATH",
+                          help="do not process anything; instead write a JSON plan of the stages that "
+                               "would run for each data ID to PATH ('-' for standard output)")
+        self.add_argument("--plan-timings", dest="planTimings", metavar="PATH",
+                          help="typical CPU seconds per image for each of ccdProcessor, differencer "
+                               "and diaPipe, used by --plan to estimate CPU-hours; either a "
+                               "--profile-stages directory (e.g., OUTPUT/apPipe_profile) or file, "
+                               "or JSON written by ap_pipe_profile.py --json or --timings")
+        self.add_argument("--id-stream", dest="idStream", metavar="PATH",
+                          help="instead of --id, process the data IDs read one per line from PATH "
+                               "('-' for standard input, or a named pipe) with a single task; each "
+                               "line is JSON or key=value pairs, e.g. visit=410915 ccdnum=25; -j is "
+                               "ignored")
+        self.add_argument("--watch", metavar="DIR",
+                          help="instead of --id, process ingested raws as their files appear in DIR "
+                               "(e.g., the raw directory of the input repository); requires --watch-pattern")
+        self.add_argument("--watch-pattern", dest="watchPattern", metavar="REGEX",
+                          help="regular expression matched against file paths relative to the --watch "
+                               "directory; its named groups give the data ID, e.g. "
+                               "'(?P<visit>\\d+)/.*_(?P<ccdnum>\\d+)\\.fits'")
+        self.add_argument("--watch-interval", dest="watchInterval", type=float, default=1.0,
+                          metavar="SECONDS", help="time between scans of the --watch directory")
+        self.add_argument("--watch-settle", dest="watchSettle", type=float, default=1.0,
+                          metavar="SECONDS", help="time since a file in the --watch directory was last "
+                                                  "modified before it is assumed to be completely written")
+        self.add_argument("--watch-timeout", dest="watchTimeout", type=float, default=None,
+                          metavar="SECONDS", help="stop watching after this long without new files "
+                                                  "(default: watch forever)")
+        self.add_argument("--profile-stages", dest="profileStages", action="store_true", default=False,
+                          help="record wall time, CPU time, peak memory and I/O of each stage for each "
+                               "data ID in OUTPUT/apPipe_profile; summarize with ap_pipe_profile.py")
+        self.add_id_argument("--profileId", inputDataset, doMakeDataRefList=False,
+                             help="Optional data IDs to run cProfile on, writing one file per stage to "
+                                  "OUTPUT/apPipe_cProfile, e.g. --profileId visit=410915 ccdnum=25")
+
     # TODO: workaround for lack of support for multi-input butlers; see DM-11865
     # Can't delegate to pipeBase.ArgumentParser.parse_args because creating the
     # Butler more than once causes repo conflicts
@@ -138,6 +173,8 @@ class ApPipeParser(pipeBase.ArgumentParser):
         self._parseDirectories(namespace)
         namespace.template = _fixPath(DEFAULT_INPUT_NAME, namespace.rawTemplate)
         del namespace.rawTemplate
+        if namespace.watch is not None and namespace.watchPattern is None:
+            self.error("--watch requires --watch-pattern")
 
         if namespace.clobberOutput:
             if namespace.output is None:
@@ -154,6 +191,9 @@ class ApPipeParser(pipeBase.ArgumentParser):
         namespace.log.debug("template=%s", namespace.template)
 
         obeyShowArgument(namespace.show, namespace.config, exit=False)
+        # Only data IDs need a Butler; don't pay for one if nothing else is wanted
+        if namespace.show and "run" not in namespace.show and "data" not in namespace.show:
+            sys.exit(0)
 
         # No environment variable or --output or --rerun specified.
         if self.requireOutput and namespace.output is None and namespace.rerun is None:
@@ -23,11 +23,38 @@
 
 __all__ = ["ApPipeTaskRunner"]
 
+import collections
+import contextlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import lsst.daf.base as dafBase
 import lsst.pipe.base as pipeBase
+from lsst.ap.pipe.profiling import StageProfiler, TargetCProfiler, readStageTimings
+from lsst.ap.pipe.reusePlan import makeReusePlan, getDataIdKey
+from lsst.ap.pipe.watcher import DirectoryWatcher
+
+
+# Stages of ApPipeTask, as named by --reuse-output-from
+_STAGES = ["ccdProcessor", "differencer", "diaPipe"]
 
 
 class ApPipeTaskRunner(pipeBase.ButlerInitializedTaskRunner):
 
+    def __init__(self, TaskClass, parsedCmd, doReturnResults=False):
+        super().__init__(TaskClass, parsedCmd, doReturnResults=doReturnResults)
+        self.reusePlan = None
+        self.profilers = []
+        if getattr(parsedCmd, "profileStages", False):
+            self.profilers.append(StageProfiler(os.path.join(parsedCmd.output, "apPipe_profile")))
+        profileIds = getattr(parsedCmd, "profileId", None)
+        if profileIds is not None and profileIds.idList:
+            self.profilers.append(TargetCProfiler(os.path.join(parsedCmd.output, "apPipe_cProfile"),
+                                                  profileIds.idList))
+
     @staticmethod
     def getTargetList(parsedCmd, **kwargs):
         """Get a list of (rawRef, kwargs) for `TaskRunner.__call__`.
@@ -36,5 +63,594 @@ class ApPipeTaskRunner(pipeBase.ButlerInitializedTaskRunner):
             parsedCmd,
             templateIds=parsedCmd.templateId.idList,
             reuse=parsedCmd.reuse,
+            templatesPrepared=parsedCmd.config.doPrepareTemplates,
             **kwargs
         )
+
+    def run(self, parsedCmd):
+        """Run the task on all targets, or only plan the run.
+
+        If ``--plan`` was given, the execution plan is written instead (see
+        `makeExecutionPlan`), and nothing is processed or written to the
+        output repository. If ``--id-stream`` or ``--watch`` was given,
+        targets are read from the stream or found in the watched directory
+        instead of ``--id`` (see `runStream` and `runWatch`).
+        """
+        if getattr(parsedCmd, "plan", None) is not None:
+            self.writeExecutionPlan(parsedCmd)
+            return []
+        if getattr(parsedCmd, "idStream", None) is not None:
+            return self.runStream(parsedCmd)
+        if getattr(parsedCmd, "watch", None) is not None:
+            return self.runWatch(parsedCmd)
+        return super().run(parsedCmd)
+
+    def writeExecutionPlan(self, parsedCmd):
+        """Write the plan made by `makeExecutionPlan` as JSON.
+
+        Parameters
+        ----------
+        parsedCmd : `argparse.Namespace`
+            Parsed command-line options, including ``plan`` (the output
+            file, or ``-`` for standard output) and ``planTimings`` (per-stage
+            timings in any format read by
+            `lsst.ap.pipe.profiling.readStageTimings`, or `None`).
+        """
+        timings = None
+        if parsedCmd.planTimings is not None:
+            timings = readStageTimings(parsedCmd.planTimings)
+        plan = self.makeExecutionPlan(parsedCmd, timings=timings)
+        if parsedCmd.plan == "-":
+            json.dump(plan, sys.stdout, indent=2, default=str)
+            sys.stdout.write("\n")
+        else:
+            with open(parsedCmd.plan, "w") as f:
+                json.dump(plan, f, indent=2, default=str)
+            self.log.info("Wrote execution plan for {0} targets to {1}.".format(
+                len(plan["targets"]), parsedCmd.plan))
+
+    def runStream(self, parsedCmd, stream=None):
+        """Run a single task on targets read one at a time from a stream.
+
+        The task, and with it the Butler and the APDB connection, is
+        constructed only once, and reused for every target.
+
+        Parameters
+        ----------
+        parsedCmd : `argparse.Namespace`
+            Parsed command-line options, including ``idStream`` (the file to
+            read, or ``-`` for standard input).
+        stream : iterable of `str`, optional
+            The lines to read, overriding ``parsedCmd.idStream``.
+
+        Returns
+        -------
+        resultList : `list` [`lsst.pipe.base.Struct`]
+            For each target, a struct with components ``exitStatus`` (0 on
+            success) and ``dataRef``.
+
+        Notes
+        -----
+        Each line is a data ID, either as a JSON object or as
+        space-separated ``key=value`` pairs, e.g. ``visit=410915 ccdnum=25``.
+        Partial data IDs are expanded to all matching raw images. Blank lines
+        and lines starting with ``#`` are ignored. A line that cannot be
+        parsed or looked up is logged, and gives a single failed result.
+        Processing ends at the end of the stream, so a named pipe can be used
+        to feed a long-lived worker.
+
+        Targets are processed one at a time; ``-j`` is ignored.
+        """
+        if not self.precall(parsedCmd):
+            return []
+        if self.numProcesses > 1:
+            self.log.warn("--id-stream processes one target at a time; ignoring -j {0}.".format(
+                self.numProcesses))
+
+        task = self.makeTask(parsedCmd=parsedCmd)
+        kwargs = dict(templateIds=parsedCmd.templateId.idList, reuse=parsedCmd.reuse)
+        butler = parsedCmd.butler
+        keyTypes = butler.getKeys("raw")
+
+        resultList = []
+        with contextlib.ExitStack() as context:
+            if stream is None:
+                stream = sys.stdin if parsedCmd.idStream == "-" \
+                    else context.enter_context(open(parsedCmd.idStream))
+            for line in stream:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                try:
+                    dataId = _parseDataIdLine(line, keyTypes)
+                    dataRefs = [dataRef for dataRef in butler.subset("raw", dataId=dataId)
+                                if dataRef.datasetExists("raw")]
+                except Exception as e:
+                    if self.doRaise:
+                        raise
+                    self.log.warn("Cannot find data for {0!r}: {1}: {2}".format(line, type(e).__name__, e))
+                    resultList.append(pipeBase.Struct(exitStatus=1, dataRef=None))
+                    continue
+                if not dataRefs:
+                    self.log.warn("No raw data found for {0}.".format(dataId))
+                for dataRef in dataRefs:
+                    resultList.append(self._runStreamTarget(task, dataRef, kwargs))
+        return resultList
+
+    def runWatch(self, parsedCmd):
+        """Process raw images as they arrive in a directory.
+
+        Each worker process constructs a single task, and reuses it for all
+        the images it processes.
+
+        Parameters
+        ----------
+        parsedCmd : `argparse.Namespace`
+            Parsed command-line options, including ``watch`` (the directory
+            to watch), ``watchPattern`` and ``watchSettle`` (see
+            `lsst.ap.pipe.watcher.DirectoryWatcher`), and ``watchInterval``
+            and ``watchTimeout`` (see
+            `lsst.ap.pipe.watcher.DirectoryWatcher.watch`).
+
+        Returns
+        -------
+        resultList : `list` [`lsst.pipe.base.Struct`]
+            For each image, a struct with components ``exitStatus`` (0 on
+            success), ``dataId``, and ``latency`` (the time from the arrival
+            of the file to the end of processing, including the writing of
+            ``apdb_marker``, in seconds).
+
+        Notes
+        -----
+        The files must be raws that are already ingested into the input
+        repository, e.g. the repository's own raw files. Files present when
+        watching starts are processed too; use ``--reuse-output-from`` to
+        skip images that were already processed.
+
+        With several processes, at most two images per process wait to be
+        processed; watching pauses while that many are queued.
+        """
+        if not self.precall(parsedCmd):
+            return []
+
+        watcher = DirectoryWatcher(parsedCmd.watch, parsedCmd.watchPattern,
+                                   keyTypes=parsedCmd.butler.getKeys("raw"),
+                                   settleTime=parsedCmd.watchSettle)
+        kwargs = dict(templateIds=parsedCmd.templateId.idList, reuse=parsedCmd.reuse)
+        self.log.info("Watching {0} for new raws...".format(parsedCmd.watch))
+
+        resultList = []
+
+        def report(results):
+            for result in results:
+                self.log.info("Processed {0} {1:.1f} s after arrival{2}.".format(
+                    result.dataId, result.latency, "" if result.exitStatus == 0 else " (failed)"))
+            resultList.extend(results)
+
+        arrivals = (arrival for batch in watcher.watch(parsedCmd.watchInterval, parsedCmd.watchTimeout)
+                    for arrival in batch)
+        if self.numProcesses > 1:
+            # Workers inherit the Butler and this runner when forked
+            pool = multiprocessing.get_context("fork").Pool(
+                processes=self.numProcesses, initializer=_initWatchWorker, initargs=(self, parsedCmd, kwargs))
+            maxPending = 2*self.numProcesses
+            pending = collections.deque()
+            try:
+                for arrival in arrivals:
+                    pending.append(pool.apply_async(_processArrival, (arrival,), callback=report,
+                                                    error_callback=lambda e: self.log.fatal(
+                                                        "Failed to process new raw: {0}".format(e))))
+                    # Results are reported by the callbacks; only keep the queue bounded
+                    while pending and (pending[0].ready() or len(pending) >= maxPending):
+                        pending.popleft().wait()
+                for result in pending:
+                    result.wait()
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            _initWatchWorker(self, parsedCmd, kwargs)
+            for arrival in arrivals:
+                report(_processArrival(arrival))
+        return resultList
+
+    def _runStreamTarget(self, task, dataRef, kwargs):
+        """Run an existing task on a single target.
+
+        Parameters
+        ----------
+        task : `lsst.ap.pipe.ApPipeTask`
+            The task to run.
+        dataRef : `lsst.daf.persistence.ButlerDataRef`
+            The raw data to process.
+        kwargs : `dict`
+            Other arguments to ``task.runDataRef``.
+
+        Returns
+        -------
+        result : `lsst.pipe.base.Struct`
+            A struct with components ``exitStatus`` (0 on success) and
+            ``dataRef``.
+        """
+        exitStatus = 0
+        try:
+            self.runTask(task, dataRef, kwargs)
+        except Exception as e:
+            if self.doRaise:
+                raise
+            exitStatus = 1
+            task.log.fatal("Failed on dataId={0}: {1}: {2}".format(dataRef.dataId, type(e).__name__, e))
+        task.writeMetadata(dataRef)
+        # Each target's metadata must describe only that target
+        for subtask in task.getTaskDict().values():
+            subtask.metadata = dafBase.PropertyList()
+        return pipeBase.Struct(exitStatus=exitStatus, dataRef=dataRef)
+
+    def makeExecutionPlan(self, parsedCmd, timings=None):
+        """Determine which stages ``ApPipeTask.runDataRef`` will run.
+
+        Parameters
+        ----------
+        parsedCmd : `argparse.Namespace`
+            Parsed command-line options.
+        timings : `dict` [`str`, `float`], optional
+            The typical CPU time, in seconds, of each of the
+            ``ccdProcessor``, ``templateCcdProcessor``, ``differencer`` and
+            ``diaPipe`` stages for a single image, as profiled by
+            ``ApPipeTask``. If ``templateCcdProcessor`` is missing, templates
+            are assumed to take as long as science images.
+
+        Returns
+        -------
+        plan : `dict`
+            A JSON-serializable plan, with keys:
+
+            ``targets``
+                For each target, its ``dataId``, the ``stages`` that will
+                run, and the data IDs of the ``templates`` it will process
+                (`list` of `dict`).
+            ``templates``
+                The data IDs of templates processed once before all targets,
+                if ``config.doPrepareTemplates`` is set (`list` of `dict`).
+            ``stageCounts``
+                The number of times each stage will run, with each processed
+                template counted as ``templateCcdProcessor``, and only
+                science images as ``ccdProcessor`` (`dict`).
+            ``timings``
+                The per-stage timings used for the estimate (`dict` or `None`).
+            ``estimatedCpuHours``
+                The estimated total CPU time of the run, or `None` if
+                ``timings`` is `None` or is missing a stage that will run
+                (`float`).
+        """
+        templateIds = parsedCmd.templateId.idList
+        reuse = parsedCmd.reuse
+        reusePlan = self.planReuse(parsedCmd) if reuse else None
+
+        def willRun(stage, dataRef, datasetType):
+            return stage not in reuse or not self.TaskClass.outputExists(dataRef, datasetType, reusePlan)
+
+        diaSrcType = self.config.differencer.coaddName + "Diff_diaSrc"
+        stageCounts = dict.fromkeys(_STAGES + ["templateCcdProcessor"], 0)
+        targets = []
+        preparedTemplates = {}
+        for rawRef in parsedCmd.id.refList:
+            calexpRef = self.TaskClass.getCalexpRef(rawRef)
+            templates = []
+            if templateIds:
+                for _, calexpTemplateRef in self.TaskClass.getTemplateRefs(rawRef, templateIds):
+                    if willRun("ccdProcessor", calexpTemplateRef, "calexp"):
+                        templates.append(calexpTemplateRef.dataId)
+                        # As in runDataRef, later targets reuse the template
+                        if reusePlan is not None:
+                            reusePlan.setExists("calexp", calexpTemplateRef.dataId)
+            if self.config.doPrepareTemplates:
+                preparedTemplates.update((getDataIdKey(dataId), dataId) for dataId in templates)
+                templates = []
+            stages = [stage for stage, datasetType in zip(_STAGES, ["calexp", diaSrcType, "apdb_marker"])
+                      if willRun(stage, calexpRef, datasetType)]
+
+            for stage in stages:
+                stageCounts[stage] += 1
+            stageCounts["templateCcdProcessor"] += len(templates)
+            targets.append({"dataId": rawRef.dataId, "stages": stages, "templates": templates})
+        stageCounts["templateCcdProcessor"] += len(preparedTemplates)
+
+        estimatedCpuHours = None
+        if timings is not None:
+            stageTimings = dict(timings)
+            if "ccdProcessor" in timings:
+                stageTimings.setdefault("templateCcdProcessor", timings["ccdProcessor"])
+            try:
+                estimatedCpuHours = sum(stageTimings[stage] * count for stage, count in stageCounts.items()
+                                        if count) / 3600.0
+            except KeyError:
+                pass
+        return {
+            "targets": targets,
+            "templates": list(preparedTemplates.values()),
+            "stageCounts": stageCounts,
+            "timings": timings,
+            "estimatedCpuHours": estimatedCpuHours,
+        }
+
+    def makeTask(self, parsedCmd=None, args=None):
+        """Create the task, with profiling if ``--profile-stages`` or
+        ``--profileId`` was given.
+        """
+        task = super().makeTask(parsedCmd=parsedCmd, args=args)
+        task.profilers = list(self.profilers)
+        return task
+
+    def runTask(self, task, dataRef, kwargs):
+        """Run the task on a single target, and wait for its outputs.
+        """
+        if self.reusePlan is not None:
+            kwargs = dict(kwargs, reusePlan=self.reusePlan)
+        with task.profileStage("runDataRef", dataRef.dataId):
+            try:
+                return super().runTask(task, dataRef, kwargs)
+            finally:
+                task.flushWrites()
+
+    def precall(self, parsedCmd):
+        """Write configs and, if requested, plan reuse and process all templates.
+
+        Existing outputs are looked up here if ``config.doBatchReuseChecks``
+        is set, and templates are processed here, before any science image,
+        if ``config.doPrepareTemplates`` is set.
+        """
+        if not super().precall(parsedCmd):
+            return False
+        if self.config.doBatchReuseChecks and parsedCmd.reuse:
+            self.reusePlan = self.planReuse(parsedCmd)
+        if self.config.doPrepareTemplates:
+            self.prepareTemplates(parsedCmd)
+        return True
+
+    def planReuse(self, parsedCmd):
+        """Find which outputs of all targets already exist.
+
+        Parameters
+        ----------
+        parsedCmd : `argparse.Namespace`
+            Parsed command-line options, as passed to `precall`.
+
+        Returns
+        -------
+        plan : `lsst.ap.pipe.reusePlan.ReusePlan`
+            The existence of every output checked by
+            ``ApPipeTask.runDataRef`` for ``--reuse-output-from``.
+        """
+        templateIds = parsedCmd.templateId.idList
+        reuse = parsedCmd.reuse
+        queries = [query for rawRef in parsedCmd.id.refList
+                   for query in self.TaskClass.getReuseQueries(self.config, rawRef, templateIds, reuse)]
+        plan = makeReusePlan(parsedCmd.butler, queries)
+        nFound = sum(bool(plan.exists(datasetType, dataId)) for datasetType, dataId in queries)
+        self.log.info("Found {0} of {1} reusable outputs for {2} targets.".format(
+            nFound, len(queries), len(parsedCmd.id.refList)))
+
+        stageTypes = {"ccdProcessor": "calexp",
+                      "differencer": self.config.differencer.coaddName + "Diff_diaSrc",
+                      "diaPipe": "apdb_marker"}
+        calexpIds = [self.TaskClass.getCalexpRef(rawRef).dataId for rawRef in parsedCmd.id.refList]
+        for stage, datasetType in stageTypes.items():
+            if stage in reuse:
+                nSkipped = sum(bool(plan.exists(datasetType, calexpId)) for calexpId in calexpIds)
+                self.log.info("{0} of {1} targets will skip {2}.".format(nSkipped, len(calexpIds), stage))
+        return plan
+
+    def prepareTemplates(self, parsedCmd):
+        """Run ccdProcessor exactly once on every template needed by the targets.
+
+        Parameters
+        ----------
+        parsedCmd : `argparse.Namespace`
+            Parsed command-line options, as passed to `precall`.
+
+        Notes
+        -----
+        Templates shared by several science images (e.g., the same template
+        visit used for every science visit) are processed only once. Unique
+        templates are processed in parallel using up to ``numProcesses``
+        processes, each of which constructs a single task.
+        """
+        templateIds = parsedCmd.templateId.idList
+        if not templateIds:
+            return
+        reuse = parsedCmd.reuse
+
+        rawTemplateRefs = {}
+        for rawRef in parsedCmd.id.refList:
+            for rawTemplateRef, calexpTemplateRef in self.TaskClass.getTemplateRefs(rawRef, templateIds):
+                key = getDataIdKey(calexpTemplateRef.dataId)
+                if key in rawTemplateRefs:
+                    continue
+                if "ccdProcessor" in reuse \
+                        and self.TaskClass.outputExists(calexpTemplateRef, "calexp", self.reusePlan):
+                    self.log.info("ProcessCcd has already been run for template {0}, skipping...".format(
+                        calexpTemplateRef.dataId))
+                    rawTemplateRefs[key] = None
+                else:
+                    rawTemplateRefs[key] = (rawTemplateRef, calexpTemplateRef)
+        toProcess = [refs for refs in rawTemplateRefs.values() if refs is not None]
+        rawTemplateRefs = [rawTemplateRef for rawTemplateRef, _ in toProcess]
+
+        self.log.info("Processing {0} unique templates for {1} science images...".format(
+            len(toProcess), len(parsedCmd.id.refList)))
+        if not toProcess:
+            return
+        if self.numProcesses > 1 and len(toProcess) > 1:
+            # Workers inherit the Butler and this runner when forked
+            pool = multiprocessing.get_context("fork").Pool(
+                processes=min(self.numProcesses, len(toProcess)),
+                initializer=_initTemplateWorker, initargs=(self, parsedCmd))
+            try:
+                succeeded = pool.map(_prepareTemplateInWorker, rawTemplateRefs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            task = self.makeTask(parsedCmd=parsedCmd)
+            succeeded = [self._prepareTemplate(task, rawTemplateRef) for rawTemplateRef in rawTemplateRefs]
+
+        if self.reusePlan is not None:
+            for (_, calexpTemplateRef), success in zip(toProcess, succeeded):
+                if success:
+                    self.reusePlan.setExists("calexp", calexpTemplateRef.dataId)
+
+    def _prepareTemplate(self, task, rawTemplateRef):
+        """Run ccdProcessor on a single template.
+
+        Parameters
+        ----------
+        task : `lsst.ap.pipe.ApPipeTask`
+            The task to run, shared by all templates processed in the same
+            process.
+        rawTemplateRef : `lsst.daf.persistence.ButlerDataRef`
+            A reference to the raw template data.
+
+        Returns
+        -------
+        success : `bool`
+            `True` if the template was processed successfully.
+        """
+        try:
+            with task.profileStage("templateCcdProcessor", rawTemplateRef.dataId):
+                task.runProcessCcd(rawTemplateRef)
+        except Exception as e:
+            if self.doRaise:
+                raise
+            self.log.fatal("Failed to process template {0}: {1}".format(rawTemplateRef.dataId, e))
+            return False
+        return True
+
+
+# Runner and task of a worker of prepareTemplates
+_templateWorker = None
+
+
+def _initTemplateWorker(runner, parsedCmd):
+    """Construct the task used by a worker process of
+    `ApPipeTaskRunner.prepareTemplates`.
+
+    Parameters
+    ----------
+    runner : `ApPipeTaskRunner`
+        The runner that started the worker.
+    parsedCmd : `argparse.Namespace`
+        Parsed command-line options.
+    """
+    global _templateWorker
+    _templateWorker = (runner, runner.makeTask(parsedCmd=parsedCmd))
+
+
+def _prepareTemplateInWorker(rawTemplateRef):
+    """Run ccdProcessor on a single template in a worker process.
+
+    Parameters
+    ----------
+    rawTemplateRef : `lsst.daf.persistence.ButlerDataRef`
+        A reference to the raw template data.
+
+    Returns
+    -------
+    success : `bool`
+        `True` if the template was processed successfully.
+    """
+    runner, task = _templateWorker
+    return runner._prepareTemplate(task, rawTemplateRef)
+
+
+# Runner, task, Butler and runDataRef arguments of a worker of runWatch
+_watchWorker = None
+
+
+def _initWatchWorker(runner, parsedCmd, kwargs):
+    """Construct the task used by a worker process of
+    `ApPipeTaskRunner.runWatch`.
+
+    Parameters
+    ----------
+    runner : `ApPipeTaskRunner`
+        The runner that started the worker.
+    parsedCmd : `argparse.Namespace`
+        Parsed command-line options.
+    kwargs : `dict`
+        Other arguments to ``ApPipeTask.runDataRef``.
+    """
+    global _watchWorker
+    task = runner.makeTask(parsedCmd=parsedCmd)
+    _watchWorker = (runner, task, parsedCmd.butler, kwargs)
+
+
+def _processArrival(arrival):
+    """Process all raws matching a newly arrived file.
+
+    Parameters
+    ----------
+    arrival : `lsst.ap.pipe.watcher.Arrival`
+        The file that arrived.
+
+    Returns
+    -------
+    results : `list` [`lsst.pipe.base.Struct`]
+        For each raw, a struct with components ``exitStatus``, ``dataId``,
+        and ``latency``.
+    """
+    runner, task, butler, kwargs = _watchWorker
+    dataRefs = [dataRef for dataRef in butler.subset("raw", dataId=arrival.dataId)
+                if dataRef.datasetExists("raw")]
+    if not dataRefs:
+        runner.log.warn("No raw data found for {0} ({1}).".format(arrival.dataId, arrival.path))
+
+    results = []
+    for dataRef in dataRefs:
+        # runTask waits for all outputs, including apdb_marker, to be written
+        result = runner._runStreamTarget(task, dataRef, kwargs)
+        results.append(pipeBase.Struct(exitStatus=result.exitStatus, dataId=dataRef.dataId,
+                                       latency=time.time() - arrival.time))
+    return results
+
+
+def _parseDataIdLine(line, keyTypes=None):
+    """Parse a data ID written as JSON or as ``key=value`` pairs.
+
+    Parameters
+    ----------
+    line : `str`
+        The data ID, e.g. ``{"visit": 410915, "ccdnum": 25}`` or
+        ``visit=410915 ccdnum=25``.
+    keyTypes : `dict` [`str`, `type`], optional
+        The type of each data ID key. Values of other keys are kept as
+        parsed.
+
+    Returns
+    -------
+    dataId : `dict`
+        The parsed data ID.
+
+    Raises
+    ------
+    ValueError
+        Raised if ``line`` is not a valid data ID.
+    """
+    if line.startswith("{"):
+        dataId = json.loads(line)
+        if not isinstance(dataId, dict):
+            raise ValueError("JSON data ID must be an object")
+    else:
+        dataId = {}
+        for item in line.split():
+            key, sep, value = item.partition("=")
+            if not sep or not key:
+                raise ValueError("expected key=value, got {0!r}".format(item))
+            dataId[key] = value
+    if keyTypes:
+        try:
+            dataId = {key: keyTypes[key](value) if key in keyTypes else value
+                      for key, value in dataId.items()}
+        except TypeError as e:
+            raise ValueError("invalid data ID value: {0}".format(e)) from e
+    return dataId
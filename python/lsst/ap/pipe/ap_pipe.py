@@ -23,10 +23,15 @@
 
 __all__ = ["ApPipeConfig", "ApPipeTask"]
 
+import concurrent.futures
+import contextlib
+import multiprocessing
+import time
 import warnings
 
 from sqlalchemy.exc import OperationalError, ProgrammingError
 
+import lsst.daf.base as dafBase
 import lsst.pex.config as pexConfig
 import lsst.pipe.base as pipeBase
 
@@ -35,6 +40,7 @@ from lsst.pipe.tasks.imageDifference import ImageDifferenceTask
 from lsst.ap.association import DiaPipelineTask
 from lsst.ap.pipe.apPipeParser import ApPipeParser
 from lsst.ap.pipe.apPipeTaskRunner import ApPipeTaskRunner
+from lsst.ap.pipe.backgroundWriter import BackgroundWriter, AsyncPutDataRef
 
 
 class ApPipeConfig(pexConfig.Config):
@@ -54,6 +60,62 @@ class ApPipeConfig(pexConfig.Config):
         doc="Pipeline task for loading/store DiaSources and DiaObjects and "
             "spatially associating them.",
     )
+    numProcessCcdProcesses = pexConfig.RangeField(
+        dtype=int,
+        default=1,
+        min=1,
+        doc="Maximum number of processes used to run ccdProcessor on the "
+            "templates and science image of a dataRef concurrently. The "
+            "science image is processed in the main process, and templates "
+            "in forked processes. Ignored, and ccdProcessor run serially, if "
+            "ApPipeTask is itself running in a worker process of a "
+            "multiprocessing pool.",
+    )
+    numAssociationIoThreads = pexConfig.RangeField(
+        dtype=int,
+        default=1,
+        min=1,
+        doc="Maximum number of threads used to read the inputs to diaPipe. "
+            "If greater than 1, the calexp is read while difference imaging "
+            "is running, and the other inputs are read concurrently. If 1, "
+            "all inputs are read serially just before association.",
+    )
+    doPassResultsInMemory = pexConfig.Field(
+        dtype=bool,
+        default=False,
+        doc="Pass the calexp, difference image, warped template and DiaSources "
+            "produced by ccdProcessor and differencer directly to diaPipe, "
+            "instead of reading them back from the output repository. Outputs "
+            "are still written as usual.",
+    )
+    backgroundWriteQueueSize = pexConfig.RangeField(
+        dtype=int,
+        default=0,
+        min=0,
+        doc="Maximum number of outputs waiting to be written by a background "
+            "thread, so that processing continues while outputs are written. "
+            "Processing blocks while the queue is full. Only final outputs "
+            "(calexp, src, difference images, DiaSources, apdb_marker) are "
+            "written in the background; intermediate products such as icExp "
+            "are always written synchronously. If 0, all outputs are written "
+            "synchronously.",
+    )
+    doBatchReuseChecks = pexConfig.Field(
+        dtype=bool,
+        default=False,
+        doc="When run from the command line with --reuse-output-from, check "
+            "which outputs already exist for all dataRefs in a single batched "
+            "pass before processing, instead of separately for each dataRef.",
+    )
+    doPrepareTemplates = pexConfig.Field(
+        dtype=bool,
+        default=False,
+        doc="When run from the command line, process every template needed "
+            "by any dataRef exactly once, in parallel, before processing the "
+            "science images. Avoids duplicate ccdProcessor runs (and races on "
+            "the shared template calexps) when many dataRefs use the same "
+            "templates.",
+    )
 
     def setDefaults(self):
         """Settings appropriate for most or all ap_pipe runs.
@@ -111,8 +173,15 @@ class ApPipeTask(pipeBase.CmdLineTask):
         self.makeSubtask("differencer", butler=butler)
         self.makeSubtask("diaPipe", initInputs={"diaSourceSchema": self.differencer.outputSchema})
 
+        self.profilers = []
+        self._prefetchExecutor = None
+        if self.config.backgroundWriteQueueSize > 0:
+            self._writer = BackgroundWriter(self.config.backgroundWriteQueueSize, log=self.log)
+        else:
+            self._writer = None
+
     @pipeBase.timeMethod
-    def runDataRef(self, rawRef, templateIds=None, reuse=None):
+    def runDataRef(self, rawRef, templateIds=None, reuse=None, templatesPrepared=False, reusePlan=None):
         """Execute the ap_pipe pipeline on a single image.
 
         Parameters
@@ -126,6 +195,21 @@ class ApPipeTask(pipeBase.CmdLineTask):
         reuse : `list` of `str`, optional
             The names of all subtasks that may be skipped if their output is
             present. Defaults to skipping nothing.
+        templatesPrepared : `bool`, optional
+            If `True`, assume that ccdProcessor has already been run on all
+            templates (e.g., by `ApPipeTaskRunner.prepareTemplates`) and only
+            process the science image.
+        reusePlan : `lsst.ap.pipe.reusePlan.ReusePlan`, optional
+            Precomputed existence of the outputs checked for ``reuse``, as
+            made by `ApPipeTaskRunner`. Outputs not in the plan, and
+            templates missing from it, are looked up in the repository.
+            Templates processed here are recorded in the plan.
+
+        Notes
+        -----
+        If ``config.backgroundWriteQueueSize`` is positive, some outputs may
+        still be waiting to be written when this method returns. Call
+        `flushWrites` before relying on them.
 
         Returns
         -------
@@ -140,34 +224,55 @@ class ApPipeTask(pipeBase.CmdLineTask):
         """
         if reuse is None:
             reuse = []
-        # Work around mismatched HDU lists for raw and processed data
-        calexpId = rawRef.dataId.copy()
-        if 'hdu' in calexpId:
-            del calexpId['hdu']
-        calexpRef = rawRef.getButler().dataRef("calexp", dataId=calexpId)
+        calexpRef = self.getCalexpRef(rawRef)
 
         # Ensure that templateIds make it through basic data reduction
-        # TODO: treat as independent jobs (may need SuperTask framework?)
-        if templateIds is not None:
-            for templateId in templateIds:
-                # templateId is typically visit-only; consider only the same raft/CCD/etc. as rawRef
-                rawTemplateRef = _siblingRef(rawRef, "raw", templateId)
-                calexpTemplateRef = _siblingRef(calexpRef, "calexp", templateId)
-                if "ccdProcessor" not in reuse or not calexpTemplateRef.datasetExists("calexp", write=True):
-                    self.runProcessCcd(rawTemplateRef)
-
-        if "ccdProcessor" in reuse and calexpRef.datasetExists("calexp", write=True):
+        rawTemplateRefs = []
+        if templateIds is not None and not templatesPrepared:
+            for rawTemplateRef, calexpTemplateRef in self.getTemplateRefs(rawRef, templateIds):
+                # Templates may have been processed for an earlier dataRef since planning
+                if "ccdProcessor" not in reuse \
+                        or not self.outputExists(calexpTemplateRef, "calexp", reusePlan, recheckMissing=True):
+                    rawTemplateRefs.append((rawTemplateRef, calexpTemplateRef))
+        calexpTemplateRefs = [calexpTemplateRef for _, calexpTemplateRef in rawTemplateRefs]
+        rawTemplateRefs = [rawTemplateRef for rawTemplateRef, _ in rawTemplateRefs]
+
+        if self._writer is not None:
+            asyncTypes = self._getBackgroundWriteTypes()
+            rawRef = AsyncPutDataRef(rawRef, self._writer, asyncTypes)
+            calexpRef = AsyncPutDataRef(calexpRef, self._writer, asyncTypes)
+
+        # Templates and the science image are independent until differencing
+        if "ccdProcessor" in reuse and self.outputExists(calexpRef, "calexp", reusePlan):
             self.log.info("ProcessCcd has already been run for {0}, skipping...".format(rawRef.dataId))
+            self.runProcessCcdBatch(rawTemplateRefs)
             processResults = None
         else:
-            processResults = self.runProcessCcd(rawRef)
+            processResults = self.runProcessCcdBatch(rawTemplateRefs, scienceRef=rawRef)
+        # Template calexps are written synchronously, so later dataRefs may use them
+        if reusePlan is not None:
+            for calexpTemplateRef in calexpTemplateRefs:
+                reusePlan.setExists("calexp", calexpTemplateRef.dataId)
+
+        associationInputs = {}
+        if self.config.doPassResultsInMemory and processResults:
+            associationInputs.update(exposure=processResults.exposure)
 
         diffType = self.config.differencer.coaddName
-        if "differencer" in reuse and calexpRef.datasetExists(diffType + "Diff_diaSrc", write=True):
+        prefetched = {}
+        if "differencer" in reuse and self.outputExists(calexpRef, diffType + "Diff_diaSrc", reusePlan):
             self.log.info("DiffIm has already been run for {0}, skipping...".format(calexpRef.dataId))
             diffImResults = None
         else:
-            diffImResults = self.runDiffIm(calexpRef, templateIds)
+            if "diaPipe" not in reuse:
+                # The calexp is final once ccdProcessor is done; read it during differencing
+                prefetched = self.prefetchAssociationInputs(
+                    calexpRef,
+                    [name for name in ["exposure", "ccdExposureIdBits"] if name not in associationInputs])
+            with self.profileStage("differencer", calexpRef.dataId):
+                diffImResults = self.runDiffIm(calexpRef, templateIds)
+            if self.config.doPassResultsInMemory and diffImResults:
+                associationInputs.update(self._getDiffImOutputs(diffImResults))
 
         try:
             if "diaPipe" in reuse:
@@ -177,12 +282,14 @@ class ApPipeTask(pipeBase.CmdLineTask):
                     "matters, please clear the association database and run "
                     "ap_pipe.py with --reuse-output-from=differencer to redo all "
                     "association results consistently.")
-            if "diaPipe" in reuse and calexpRef.datasetExists("apdb_marker", write=True):
+            if "diaPipe" in reuse and self.outputExists(calexpRef, "apdb_marker", reusePlan):
                 message = "DiaPipeline has already been run for {0}, skipping...".format(calexpRef.dataId)
                 self.log.info(message)
                 diaPipeResults = None
             else:
-                diaPipeResults = self.runAssociation(calexpRef)
+                with self.profileStage("diaPipe", calexpRef.dataId):
+                    diaPipeResults = self.runAssociation(calexpRef, inputs=associationInputs,
+                                                         prefetched=prefetched)
         except (OperationalError, ProgrammingError) as e:
             # Don't use lsst.pipe.base.TaskError because it mixes poorly with exception chaining
             raise RuntimeError("Database query failed; did you call make_apdb.py first?") from e
@@ -194,6 +301,109 @@ class ApPipeTask(pipeBase.CmdLineTask):
             diaPipe=diaPipeResults.taskResults if diaPipeResults else None
         )
 
+    @staticmethod
+    def outputExists(dataRef, datasetType, reusePlan=None, recheckMissing=False):
+        """Test whether an output dataset exists.
+
+        Parameters
+        ----------
+        dataRef : `lsst.daf.persistence.ButlerDataRef`
+            A reference to the dataset.
+        datasetType : `str`
+            The dataset type to look for.
+        reusePlan : `lsst.ap.pipe.reusePlan.ReusePlan`, optional
+            Precomputed existence of outputs. If omitted, or if the dataset is
+            not in the plan, the repository is checked directly.
+        recheckMissing : `bool`, optional
+            Also check the repository if ``reusePlan`` records the dataset as
+            missing, for outputs that may have been written since the plan
+            was made (e.g., by another process). Datasets found this way are
+            recorded in ``reusePlan``.
+
+        Returns
+        -------
+        exists : `bool`
+            `True` if the dataset exists in the output repository.
+        """
+        if reusePlan is not None:
+            exists = reusePlan.exists(datasetType, dataRef.dataId)
+            if exists or (exists is not None and not recheckMissing):
+                return exists
+        exists = dataRef.datasetExists(datasetType, write=True)
+        if reusePlan is not None and exists:
+            reusePlan.setExists(datasetType, dataRef.dataId)
+        return exists
+
+    @staticmethod
+    def getReuseQueries(config, rawRef, templateIds=None, reuse=None):
+        """List the outputs checked by `runDataRef` to reuse earlier results.
+
+        Parameters
+        ----------
+        config : `ApPipeConfig`
+            The configuration of the task.
+        rawRef : `lsst.daf.persistence.ButlerDataRef`
+            A reference to the raw data to process.
+        templateIds : `list` of `dict`, optional
+            A list of parsed data IDs for templates, as passed to `runDataRef`.
+        reuse : `list` of `str`, optional
+            The names of all subtasks that may be skipped if their output is
+            present, as passed to `runDataRef`.
+
+        Returns
+        -------
+        queries : `list` of `tuple` [`str`, `dict`]
+            The dataset type and data ID of each output checked by
+            `runDataRef`.
+        """
+        if not reuse:
+            return []
+        calexpRef = ApPipeTask.getCalexpRef(rawRef)
+        queries = []
+        if "ccdProcessor" in reuse:
+            queries.append(("calexp", calexpRef.dataId))
+            if templateIds is not None:
+                queries.extend(("calexp", calexpTemplateRef.dataId)
+                               for _, calexpTemplateRef in ApPipeTask.getTemplateRefs(rawRef, templateIds))
+        if "differencer" in reuse:
+            queries.append((config.differencer.coaddName + "Diff_diaSrc", calexpRef.dataId))
+        if "diaPipe" in reuse:
+            queries.append(("apdb_marker", calexpRef.dataId))
+        return queries
+
+    @staticmethod
+    def getCalexpRef(rawRef):
+        """Return the calexp data reference corresponding to a raw one.
+        """
+        # Work around mismatched HDU lists for raw and processed data
+        calexpId = rawRef.dataId.copy()
+        if 'hdu' in calexpId:
+            del calexpId['hdu']
+        return rawRef.getButler().dataRef("calexp", dataId=calexpId)
+
+    @staticmethod
+    def getTemplateRefs(rawRef, templateIds):
+        """Find the templates needed to process a raw image.
+
+        Parameters
+        ----------
+        rawRef : `lsst.daf.persistence.ButlerDataRef`
+            A reference to the raw science data.
+        templateIds : `list` of `dict`
+            A list of parsed data IDs for templates, as passed to `runDataRef`.
+
+        Returns
+        -------
+        templateRefs : `list` of `tuple`
+            For each template ID, a pair of
+            `lsst.daf.persistence.ButlerDataRef` to the raw template and to
+            its calexp, restricted to the same raft/CCD/etc. as ``rawRef``.
+        """
+        calexpRef = ApPipeTask.getCalexpRef(rawRef)
+        # templateId is typically visit-only; consider only the same raft/CCD/etc. as rawRef
+        return [(_siblingRef(rawRef, "raw", templateId), _siblingRef(calexpRef, "calexp", templateId))
+                for templateId in templateIds]
+
     @pipeBase.timeMethod
     def runProcessCcd(self, sensorRef):
         """Perform ISR with ingested images and calibrations via processCcd.
@@ -218,6 +428,121 @@ class ApPipeTask(pipeBase.CmdLineTask):
         self.log.info("Running ProcessCcd...")
         return self.ccdProcessor.runDataRef(sensorRef)
 
+    def runProcessCcdBatch(self, sensorRefs, scienceRef=None):
+        """Run processCcd on several independent images.
+
+        The images of ``sensorRefs`` are processed in up to
+        ``config.numProcessCcdProcesses`` forked copies of this task (one
+        fewer if ``scienceRef`` is given), while ``scienceRef`` is processed
+        in this process. The call returns once all images have been
+        processed, and the metadata of the forked tasks has been added to
+        that of this task.
+
+        Each image is profiled on its own, in the process that runs it: the
+        images of ``sensorRefs`` as the ``templateCcdProcessor`` stage, and
+        ``scienceRef`` as the ``ccdProcessor`` stage.
+
+        Parameters
+        ----------
+        sensorRefs : `list` of `lsst.daf.persistence.ButlerDataRef`
+            Data references for raw data, such as templates, whose outputs
+            are only written to the repository.
+        scienceRef : `lsst.daf.persistence.ButlerDataRef`, optional
+            Data reference for raw data whose output is also returned.
+
+        Returns
+        -------
+        result : `lsst.pipe.base.Struct` or `None`
+            Output of `config.ccdProcessor.runDataRef` for ``scienceRef``,
+            or `None` if ``scienceRef`` is not given.
+
+        Notes
+        -----
+        Only metadata is sent back from the forked processes, so the outputs
+        of ``sensorRefs`` never need to be pickled.
+        """
+        nWorkers = min(self.config.numProcessCcdProcesses - (scienceRef is not None), len(sensorRefs))
+        # Daemonic pool workers (e.g., from ap_pipe.py -j) may not fork, and
+        # a single image gains nothing from forking
+        if nWorkers < 1 or (nWorkers == 1 and scienceRef is None) \
+                or multiprocessing.current_process().daemon:
+            for sensorRef in sensorRefs:
+                self._runProfiledProcessCcd(sensorRef, "templateCcdProcessor")
+            return self._runProfiledProcessCcd(scienceRef, "ccdProcessor") if scienceRef is not None else None
+
+        # Forked workers write synchronously, and must see all earlier outputs;
+        # no other threads may be running when forking
+        self._stopBackgroundThreads()
+        sensorRefs = [ref.dataRef if isinstance(ref, AsyncPutDataRef) else ref for ref in sensorRefs]
+        nImages = len(sensorRefs) + (scienceRef is not None)
+        self.log.info("Running ProcessCcd on {0} images with {1} processes...".format(
+            nImages, nWorkers + (scienceRef is not None)))
+        startTime = time.time()
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=nWorkers,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=_setForkedTask,
+                initargs=(self,)) as executor:
+            # All workers are forked by the first submit, before this process
+            # can start any threads of its own
+            futures = [executor.submit(_runForkedProcessCcd, sensorRef) for sensorRef in sensorRefs]
+            result = None
+            if scienceRef is not None:
+                result = self._runProfiledProcessCcd(scienceRef, "ccdProcessor")
+            for future in futures:
+                self._mergeMetadata(future.result())
+        self.log.info("Ran ProcessCcd on {0} images in {1:.1f} s.".format(
+            nImages, time.time() - startTime))
+        return result
+
+    def _runProfiledProcessCcd(self, sensorRef, stage):
+        """Run processCcd on a single image, profiled as its own stage.
+
+        Parameters
+        ----------
+        sensorRef : `lsst.daf.persistence.ButlerDataRef`
+            Data reference for raw data.
+        stage : `str`
+            The name of the profiled stage.
+
+        Returns
+        -------
+        result : `lsst.pipe.base.Struct`
+            Output of `runProcessCcd`.
+        """
+        with self.profileStage(stage, sensorRef.dataId):
+            return self.runProcessCcd(sensorRef)
+
+    def _mergeMetadata(self, metadata):
+        """Add the metadata of a copy of this task to that of this task.
+
+        Parameters
+        ----------
+        metadata : `dict` [`str`, `lsst.daf.base.PropertyList`]
+            The metadata of each task of the copy, keyed by full task name.
+            Values of keys already present in this task's metadata are
+            appended to them, as if the copy's methods had run here.
+        """
+        taskDict = self.getTaskDict()
+        for name, taskMetadata in metadata.items():
+            taskDict[name].metadata.combine(taskMetadata)
+
+    def _stopBackgroundThreads(self):
+        """Finish all background reads and writes, and stop their threads.
+
+        The threads are started again when needed.
+
+        Raises
+        ------
+        RuntimeError
+            Raised if any output could not be written in the background.
+        """
+        if self._prefetchExecutor is not None:
+            self._prefetchExecutor.shutdown(wait=True)
+            self._prefetchExecutor = None
+        if self._writer is not None:
+            self._writer.stop()
+
     @pipeBase.timeMethod
     def runDiffIm(self, sensorRef, templateIds=None):
         """Do difference imaging with a template and a science image
@@ -242,8 +567,101 @@ class ApPipeTask(pipeBase.CmdLineTask):
         self.log.info("Running ImageDifference...")
         return self.differencer.runDataRef(sensorRef, templateIdList=templateIds)
 
+    @staticmethod
+    def _getDiffImOutputs(diffImResults):
+        """Extract the inputs to association from the output of `runDiffIm`.
+
+        Parameters
+        ----------
+        diffImResults : `lsst.pipe.base.Struct`
+            Output of `config.differencer.runDataRef`.
+
+        Returns
+        -------
+        inputs : `dict` [`str`]
+            The difference imaging products that can be passed to
+            ``config.diaPipe.run``, keyed by argument name. Products that
+            ``differencer`` did not return are omitted.
+        """
+        outputs = {
+            "diaSourceCat": getattr(diffImResults, "diaSources", None),
+            "diffIm": getattr(diffImResults, "subtractedExposure", None),
+            "warpedExposure": getattr(diffImResults, "warpedExposure", None),
+        }
+        return {name: value for name, value in outputs.items() if value is not None}
+
+    def _getAssociationInputTypes(self):
+        """Return the dataset types read by `runAssociation`.
+
+        Returns
+        -------
+        inputTypes : `dict` [`str`, `str`]
+            The dataset type of each input to ``config.diaPipe.run``, keyed
+            by argument name.
+        """
+        diffType = self.config.differencer.coaddName
+        return {
+            "diaSourceCat": diffType + "Diff_diaSrc",
+            "diffIm": diffType + "Diff_differenceExp",
+            "exposure": "calexp",
+            "warpedExposure": diffType + "Diff_warpedExp",
+            "ccdExposureIdBits": "ccdExposureId_bits",
+        }
+
+    def _getBackgroundWriteTypes(self):
+        """Return the dataset types that may be written in the background.
+
+        Returns
+        -------
+        datasetTypes : `set` [`str`]
+            The final outputs of ccdProcessor, differencer and diaPipe.
+            Intermediate products, such as ``icExp`` and ``postISRCCD``, are
+            modified in place after they are written, so they are not
+            included.
+        """
+        diffType = self.config.differencer.coaddName
+        return {
+            "calexp",
+            "calexpBackground",
+            "src",
+            "srcMatch",
+            "srcMatchFull",
+            diffType + "Diff_diaSrc",
+            diffType + "Diff_differenceExp",
+            diffType + "Diff_warpedExp",
+            "apdb_marker",
+        }
+
+    def prefetchAssociationInputs(self, sensorRef, names=None):
+        """Start reading inputs to `runAssociation` in background threads.
+
+        Parameters
+        ----------
+        sensorRef : `lsst.daf.persistence.ButlerDataRef`
+            Data reference for multiple input dataset types.
+        names : iterable of `str`, optional
+            The ``config.diaPipe.run`` arguments to read. Defaults to all
+            inputs.
+
+        Returns
+        -------
+        prefetched : `dict` [`str`, `concurrent.futures.Future`]
+            The pending reads, keyed by argument name. Empty if
+            ``config.numAssociationIoThreads`` is 1.
+        """
+        inputTypes = self._getAssociationInputTypes()
+        names = list(inputTypes) if names is None else list(names)
+        nThreads = self.config.numAssociationIoThreads
+        if nThreads <= 1 or not names:
+            return {}
+
+        # Threads are reused for later dataRefs
+        if self._prefetchExecutor is None:
+            self._prefetchExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=nThreads)
+        return {name: self._prefetchExecutor.submit(sensorRef.get, inputTypes[name]) for name in names}
+
     @pipeBase.timeMethod
-    def runAssociation(self, sensorRef):
+    def runAssociation(self, sensorRef, inputs=None, prefetched=None):
         """Do source association.
 
         This method writes an ``apdb_marker`` dataset once all changes related
@@ -253,6 +671,12 @@ class ApPipeTask(pipeBase.CmdLineTask):
         ----------
         sensorRef : `lsst.daf.persistence.ButlerDataRef`
             Data reference for multiple input dataset types.
+        inputs : `dict` [`str`], optional
+            Inputs already in memory, keyed by ``config.diaPipe.run``
+            argument name. These are not read from ``sensorRef``.
+        prefetched : `dict` [`str`, `concurrent.futures.Future`], optional
+            Inputs already being read, as returned by
+            `prefetchAssociationInputs`. Any other inputs are read here.
 
         Returns
         -------
@@ -263,17 +687,21 @@ class ApPipeTask(pipeBase.CmdLineTask):
                 results.
             - taskResults : output of `config.diaPipe.run` (`lsst.pipe.base.Struct`).
         """
-        diffType = self.config.differencer.coaddName
+        inputs = dict(inputs) if inputs else {}
+        inputTypes = {name: datasetType for name, datasetType in self._getAssociationInputTypes().items()
+                      if name not in inputs}
+        futures = dict(prefetched) if prefetched else {}
+        futures.update(self.prefetchAssociationInputs(
+            sensorRef, [name for name in inputTypes if name not in futures]))
+        for name, datasetType in inputTypes.items():
+            inputs[name] = futures[name].result() if name in futures else sensorRef.get(datasetType)
 
-        results = self.diaPipe.run(
-            diaSourceCat=sensorRef.get(diffType + "Diff_diaSrc"),
-            diffIm=sensorRef.get(diffType + "Diff_differenceExp"),
-            exposure=sensorRef.get("calexp"),
-            warpedExposure=sensorRef.get(diffType + "Diff_warpedExp"),
-            ccdExposureIdBits=sensorRef.get("ccdExposureId_bits"))
+        results = self.diaPipe.run(**inputs)
 
         # apdb_marker triggers metrics processing; let them try to read
         # something even if association failed
+        # diaPipe has committed to the APDB by now, and background writes are
+        # done in order, so the marker is written after all other outputs
         sensorRef.put(results.apdbMarker, "apdb_marker")
 
         return pipeBase.Struct(
@@ -281,6 +709,40 @@ class ApPipeTask(pipeBase.CmdLineTask):
             taskResults=results
         )
 
+    def profileStage(self, stage, dataId):
+        """Profile a stage of the pipeline, if profiling is enabled.
+
+        Parameters
+        ----------
+        stage : `str`
+            The name of the stage.
+        dataId : `dict`
+            The data ID being processed.
+
+        Returns
+        -------
+        context : context manager
+            A context that profiles its block with each of
+            ``self.profilers`` (e.g., `lsst.ap.pipe.profiling.StageProfiler`
+            or `lsst.ap.pipe.profiling.TargetCProfiler`). Does nothing if
+            ``self.profilers`` is empty.
+        """
+        context = contextlib.ExitStack()
+        for profiler in self.profilers:
+            context.enter_context(profiler.profile(stage, dataId))
+        return context
+
+    def flushWrites(self):
+        """Wait for all outputs to be written.
+
+        Raises
+        ------
+        RuntimeError
+            Raised if any output could not be written in the background.
+        """
+        if self._writer is not None:
+            self._writer.flush()
+
     @classmethod
     def _makeArgumentParser(cls):
         """A parser that can handle extra arguments for ap_pipe.
@@ -315,3 +777,43 @@ def _siblingRef(original, datasetType, dataId):
     """
     butler = original.getButler()
     return butler.dataRef(datasetType, dataId=original.dataId, **dataId)
+
+
+# Task shared with processes forked by ApPipeTask.runProcessCcdBatch
+_forkedTask = None
+
+
+def _setForkedTask(task):
+    """Make a task available to a forked worker process.
+
+    Parameters
+    ----------
+    task : `ApPipeTask`
+        The task to run in the worker. Inherited from the parent process
+        when forking, so it is never pickled.
+    """
+    global _forkedTask
+    _forkedTask = task
+
+
+def _runForkedProcessCcd(sensorRef):
+    """Run processCcd in a forked worker process.
+
+    Parameters
+    ----------
+    sensorRef : `lsst.daf.persistence.ButlerDataRef`
+        Data reference for raw data. The (large) output is only written to
+        the repository.
+
+    Returns
+    -------
+    metadata : `dict` [`str`, `lsst.daf.base.PropertyList`]
+        The metadata recorded while processing ``sensorRef`` by each task,
+        keyed by full task name, for `ApPipeTask._mergeMetadata`.
+    """
+    taskDict = _forkedTask.getTaskDict()
+    # Report only this image's metadata, not that inherited from the parent
+    for task in taskDict.values():
+        task.metadata = dafBase.PropertyList()
+    _forkedTask._runProfiledProcessCcd(sensorRef, "templateCcdProcessor")
+    return {name: task.metadata for name, task in taskDict.items() if task.metadata.names()}
@@ -0,0 +1,245 @@
+#
+# This file is part of ap_pipe.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+__all__ = ["BackgroundWriter", "AsyncPutDataRef"]
+
+import collections
+import queue
+import threading
+
+
+class BackgroundWriter:
+    """Write datasets in order, in a background thread.
+
+    Parameters
+    ----------
+    maxSize : `int`
+        Maximum number of datasets waiting to be written. `put` blocks while
+        this many writes are pending.
+    log : `lsst.log.Log`, optional
+        Logger for writes that are abandoned after a failure.
+
+    Notes
+    -----
+    Datasets are written in the order they were queued. If a write fails,
+    all writes queued after it are abandoned, so that a dataset that marks
+    the completion of earlier outputs (e.g., ``apdb_marker``) is never
+    written without them. The failure is raised by the next call to `put`
+    or `flush`.
+
+    Objects are written some time after they are queued, and must not be
+    modified in the meantime.
+    """
+
+    def __init__(self, maxSize, log=None):
+        self.log = log
+        self._queue = queue.Queue(maxsize=maxSize)
+        self._pending = collections.Counter()
+        self._condition = threading.Condition()
+        self._error = None
+        self._thread = None
+
+    def put(self, dataRef, obj, datasetType=None, **rest):
+        """Queue a dataset for writing.
+
+        Parameters
+        ----------
+        dataRef : `lsst.daf.persistence.ButlerDataRef`
+            The data reference to write through.
+        obj
+            The object to write.
+        datasetType : `str`, optional
+            The dataset type to write, if not the default of ``dataRef``.
+        **rest
+            Other arguments to ``dataRef.put``.
+
+        Raises
+        ------
+        RuntimeError
+            Raised if an earlier write failed.
+        """
+        self._raiseError()
+        self._start()
+        key = _getDatasetType(dataRef, datasetType)
+        with self._condition:
+            self._pending[key] += 1
+        self._queue.put((key, dataRef, obj, datasetType, rest))
+
+    def waitFor(self, dataRef, datasetType=None):
+        """Wait until no dataset of a given type is waiting to be written.
+
+        Parameters
+        ----------
+        dataRef : `lsst.daf.persistence.ButlerDataRef`
+            The data reference to read through.
+        datasetType : `str`, optional
+            The dataset type, if not the default of ``dataRef``.
+
+        Raises
+        ------
+        RuntimeError
+            Raised if an earlier write failed.
+
+        Notes
+        -----
+        Pending writes are matched on dataset type alone, because the same
+        dataset may be written and read through data references with
+        different (but equivalent) data IDs.
+        """
+        key = _getDatasetType(dataRef, datasetType)
+        with self._condition:
+            self._condition.wait_for(lambda: not self._pending[key])
+        self._raiseError()
+
+    def flush(self):
+        """Wait until all queued datasets have been written.
+
+        Raises
+        ------
+        RuntimeError
+            Raised if any write failed.
+        """
+        if self._thread is not None:
+            self._queue.join()
+        self._raiseError()
+
+    def stop(self):
+        """Write all queued datasets, then stop the writer thread.
+
+        The thread is started again by the next call to `put`.
+
+        Raises
+        ------
+        RuntimeError
+            Raised if any write failed.
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._raiseError()
+
+    def _start(self):
+        """Start the writer thread, if it is not already running.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="BackgroundWriter", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        """Write queued datasets until the process exits, or `stop` is
+        called.
+        """
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            key, dataRef, obj, datasetType, rest = item
+            try:
+                if self._error is None:
+                    dataRef.put(obj, datasetType, **rest)
+                elif self.log is not None:
+                    self.log.warn("Not writing {0} {1} after an earlier write failed.".format(
+                        datasetType, dataRef.dataId))
+            except Exception as e:
+                self._error = e
+            finally:
+                with self._condition:
+                    self._pending[key] -= 1
+                    if not self._pending[key]:
+                        del self._pending[key]
+                    self._condition.notify_all()
+                self._queue.task_done()
+
+    def _raiseError(self):
+        """Raise, and then clear, the first failure of a write.
+        """
+        if self._error is not None:
+            # Let the writer thread abandon the writes queued after the failure
+            self._queue.join()
+            error, self._error = self._error, None
+            raise RuntimeError("Failed to write dataset in background.") from error
+
+
+class AsyncPutDataRef:
+    """A data reference whose writes are done by a `BackgroundWriter`.
+
+    Reads of a dataset wait until any pending write of it is complete. All
+    other attributes are those of the wrapped data reference.
+
+    Parameters
+    ----------
+    dataRef : `lsst.daf.persistence.ButlerDataRef`
+        The data reference to wrap.
+    writer : `BackgroundWriter`
+        The writer to queue datasets with.
+    datasetTypes : collection of `str`, optional
+        The dataset types to write in the background. Other dataset types
+        are written synchronously. Defaults to all dataset types.
+
+    Notes
+    -----
+    Only reads and writes through this object are ordered. In particular,
+    datasets read directly from ``dataRef.getButler()`` may not have been
+    written yet.
+
+    Objects written in the background must not be modified after they are
+    put, so ``datasetTypes`` should exclude intermediate products that the
+    caller goes on to change in place.
+    """
+
+    def __init__(self, dataRef, writer, datasetTypes=None):
+        self.dataRef = dataRef
+        self._writer = writer
+        self._datasetTypes = None if datasetTypes is None else frozenset(datasetTypes)
+
+    def __getattr__(self, name):
+        return getattr(self.dataRef, name)
+
+    def put(self, obj, datasetType=None, **rest):
+        if self._datasetTypes is None or _getDatasetType(self.dataRef, datasetType) in self._datasetTypes:
+            self._writer.put(self.dataRef, obj, datasetType, **rest)
+        else:
+            self.dataRef.put(obj, datasetType, **rest)
+
+    def get(self, datasetType=None, **rest):
+        self._writer.waitFor(self.dataRef, datasetType)
+        return self.dataRef.get(datasetType, **rest)
+
+    def datasetExists(self, datasetType=None, write=False, **rest):
+        self._writer.waitFor(self.dataRef, datasetType)
+        return self.dataRef.datasetExists(datasetType, write=write, **rest)
+
+
+def _getDatasetType(dataRef, datasetType):
+    """Return the dataset type read or written through a data reference.
+
+    Parameters
+    ----------
+    dataRef : `lsst.daf.persistence.ButlerDataRef`
+        A data reference to the dataset.
+    datasetType : `str` or `None`
+        The dataset type, or `None` for the default of ``dataRef``.
+    """
+    return dataRef.datasetType if datasetType is None else datasetType
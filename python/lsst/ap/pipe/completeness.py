@@ -0,0 +1,405 @@
+# This file is part of ap_pipe.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""Mergeable completeness histograms of fakes inserted into AP.
+"""
+
+import numpy as np
+import pandas as pd
+
+import lsst.pex.config as pexConfig
+from lsst.pipe.base import PipelineTask, PipelineTaskConfig, PipelineTaskConnections, Struct
+import lsst.pipe.base.connectionTypes as connTypes
+from lsst.pipe.tasks.insertFakes import InsertFakesConfig
+
+__all__ = ["ApFakesCompletenessHistogramTask",
+           "ApFakesCompletenessHistogramConfig",
+           "ApFakesCompletenessHistogramConnections",
+           "MergeApFakesCompletenessHistogramsTask",
+           "MergeApFakesCompletenessHistogramsConfig",
+           "MergeApFakesCompletenessHistogramsConnections",
+           "MergeApFakesTractCompletenessHistogramsTask",
+           "MergeApFakesTractCompletenessHistogramsConfig",
+           "MergeApFakesTractCompletenessHistogramsConnections",
+           "MergeApFakesRunCompletenessHistogramsTask",
+           "MergeApFakesRunCompletenessHistogramsConfig",
+           "MergeApFakesRunCompletenessHistogramsConnections",
+           "makeMagBinEdges",
+           "computeCompletenessHistogram",
+           "mergeCompletenessHistograms"]
+
+
+def makeMagBinEdges(magMin, magMax, binWidth):
+    """Return the edges of equal-width magnitude bins.
+
+    Parameters
+    ----------
+    magMin : `float`
+        Bright edge of the brightest bin.
+    magMax : `float`
+        Faint limit of the bins. The faintest bin is extended past
+        ``magMax`` if ``magMax - magMin`` is not a multiple of ``binWidth``.
+    binWidth : `float`
+        Width of each bin.
+
+    Returns
+    -------
+    binEdges : `numpy.ndarray`
+        Increasing bin edges, starting at ``magMin``.
+    """
+    nBins = int(np.ceil((magMax - magMin) / binWidth - 1e-9))
+    return magMin + binWidth * np.arange(nBins + 1)
+
+
+def computeCompletenessHistogram(magnitudes, isFound, binEdges, weights=None):
+    """Count the possible and found fakes in bins of magnitude.
+
+    Parameters
+    ----------
+    magnitudes : `numpy.ndarray`, (N,)
+        Magnitudes of the inserted fakes.
+    isFound : `numpy.ndarray` of `bool`, (N,)
+        Whether each fake was detected.
+    binEdges : `numpy.ndarray`, (M + 1,)
+        Increasing edges of the magnitude bins. Fakes outside of the bins
+        are not counted.
+    weights : `numpy.ndarray`, (N,), optional
+        Sampling weight of each fake. If provided, the weighted sums are
+        returned instead of the numbers of fakes.
+
+    Returns
+    -------
+    nPossible, nFound : `numpy.ndarray`, (M,)
+        The number (`int`) or the summed weight (`float`) of the inserted
+        and of the detected fakes in each bin.
+    """
+    magnitudes = np.asarray(magnitudes, dtype=float)
+    isFound = np.asarray(isFound, dtype=bool)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+        nPossible, _ = np.histogram(magnitudes, bins=binEdges, weights=weights)
+        nFound, _ = np.histogram(magnitudes[isFound], bins=binEdges, weights=weights[isFound])
+    else:
+        nPossible, _ = np.histogram(magnitudes, bins=binEdges)
+        nFound, _ = np.histogram(magnitudes[isFound], bins=binEdges)
+    return nPossible, nFound
+
+
+def mergeCompletenessHistograms(histograms):
+    """Sum completeness histograms.
+
+    Parameters
+    ----------
+    histograms : iterable of `pandas.DataFrame`
+        Histograms with columns ``band``, ``magMin``, ``magMax``,
+        ``nPossible`` and ``nFound``, as made by
+        `ApFakesCompletenessHistogramTask` or by this function.
+
+    Returns
+    -------
+    histogram : `pandas.DataFrame`
+        The total counts in each (band, magnitude bin), sorted by band and
+        magnitude.
+    """
+    histograms = [histogram for histogram in histograms if histogram is not None]
+    if not histograms:
+        noCounts = np.zeros(0, dtype=np.int64)
+        return _makeHistogramFrame([], [], [], noCounts, noCounts)
+    merged = pd.concat(histograms, ignore_index=True)
+    merged = merged.groupby(["band", "magMin", "magMax"], as_index=False, sort=True)[
+        ["nPossible", "nFound"]].sum()
+    return merged.reset_index(drop=True)
+
+
+def _makeHistogramFrame(band, magMin, magMax, nPossible, nFound):
+    """Make a completeness histogram DataFrame with the standard columns.
+
+    The counts are integers unless they are weighted sums.
+    """
+    countType = np.result_type(np.asarray(nPossible).dtype, np.asarray(nFound).dtype, np.int64)
+    return pd.DataFrame({"band": pd.Series(band, dtype=str),
+                         "magMin": pd.Series(magMin, dtype=float),
+                         "magMax": pd.Series(magMax, dtype=float),
+                         "nPossible": pd.Series(nPossible, dtype=countType),
+                         "nFound": pd.Series(nFound, dtype=countType)})
+
+
+class ApFakesCompletenessHistogramConnections(
+        PipelineTaskConnections,
+        defaultTemplates={"coaddName": "deep",
+                          "fakesType": "fakes_"},
+        dimensions=("instrument", "visit", "detector", "band")):
+    matchedFakes = connTypes.Input(
+        doc="Fakes matched to their detections in the difference image.",
+        name="{fakesType}{coaddName}Diff_matchDiaSrc",
+        storageClass="DataFrame",
+        dimensions=("instrument", "visit", "detector"),
+        deferLoad=True,
+    )
+    completenessHistogram = connTypes.Output(
+        doc="Number of inserted and of detected fakes in bins of magnitude.",
+        name="{fakesType}{coaddName}Diff_completenessHist",
+        storageClass="DataFrame",
+        dimensions=("instrument", "visit", "detector"),
+    )
+
+
+# Inherits from InsertFakesConfig to preserve column names in the fakes
+# catalog.
+class ApFakesCompletenessHistogramConfig(
+        InsertFakesConfig,
+        pipelineConnections=ApFakesCompletenessHistogramConnections):
+    """Config for ApFakesCompletenessHistogramTask.
+    """
+    magMin = pexConfig.RangeField(
+        doc="Bright edge of the brightest magnitude bin.",
+        dtype=float,
+        default=20,
+        min=1,
+        max=40,
+    )
+    magMax = pexConfig.RangeField(
+        doc="Faint edge of the faintest magnitude bin.",
+        dtype=float,
+        default=30,
+        min=1,
+        max=40,
+    )
+    magBinWidth = pexConfig.RangeField(
+        doc="Width of the magnitude bins. Histograms can only be merged if "
+            "they have the same bins.",
+        dtype=float,
+        default=0.5,
+        min=0,
+        inclusiveMin=False,
+    )
+    doUseWeights = pexConfig.Field(
+        doc="Sum the sampling weights of the fakes, as written by "
+            "CreateRandomApFakesTask with a non-uniform magSampling, instead "
+            "of counting them.",
+        dtype=bool,
+        default=False,
+    )
+    weightColName = pexConfig.Field(
+        doc="Name of the column holding the sampling weight of each fake.",
+        dtype=str,
+        default="magWeight",
+    )
+
+    def validate(self):
+        super().validate()
+        if self.magMax <= self.magMin:
+            raise ValueError("magMax must be greater than magMin.")
+
+
+class ApFakesCompletenessHistogramTask(PipelineTask):
+    """Count the inserted and the detected fakes of a detector in bins of
+    magnitude.
+
+    Unlike a completeness ratio, these counts can be summed over detectors,
+    visits and tracts (see `MergeApFakesCompletenessHistogramsTask`) to give
+    completeness curves of whole surveys without re-reading the matched
+    catalogs.
+    """
+
+    _DefaultName = "apFakesCompletenessHistogram"
+    ConfigClass = ApFakesCompletenessHistogramConfig
+
+    def runQuantum(self, butlerQC, inputRefs, outputRefs):
+        inputs = butlerQC.get(inputRefs)
+        inputs["band"] = butlerQC.quantum.dataId["band"]
+        columns = [self.config.magVar % inputs["band"], "diaSourceId"]
+        if self.config.doUseWeights:
+            columns.append(self.config.weightColName)
+        inputs["matchedFakes"] = inputs["matchedFakes"].get(parameters={"columns": columns})
+        outputs = self.run(**inputs)
+        butlerQC.put(outputs, outputRefs)
+
+    def getMagBinEdges(self):
+        """Return the edges of the magnitude bins.
+
+        Returns
+        -------
+        binEdges : `numpy.ndarray`
+            Increasing bin edges, from ``config.magMin`` to at least
+            ``config.magMax``.
+        """
+        return makeMagBinEdges(self.config.magMin, self.config.magMax, self.config.magBinWidth)
+
+    def run(self, matchedFakes, band):
+        """Count the inserted and the detected fakes in bins of magnitude.
+
+        Parameters
+        ----------
+        matchedFakes : `pandas.DataFrame`
+            Fakes inserted into the image, matched to their detected
+            counterparts (``diaSourceId > 0``).
+        band : `str`
+            Band of the image.
+
+        Returns
+        -------
+        result : `lsst.pipe.base.Struct`
+            Results struct with components.
+
+            - ``completenessHistogram`` : Counts of fakes in each magnitude
+              bin, with columns ``band``, ``magMin``, ``magMax``,
+              ``nPossible`` and ``nFound`` (`pandas.DataFrame`). The counts
+              are summed weights if ``config.doUseWeights`` is set.
+        """
+        binEdges = self.getMagBinEdges()
+        nPossible, nFound = computeCompletenessHistogram(
+            matchedFakes[self.config.magVar % band],
+            matchedFakes["diaSourceId"] > 0,
+            binEdges,
+            matchedFakes[self.config.weightColName] if self.config.doUseWeights else None)
+        histogram = _makeHistogramFrame([band] * len(nPossible), binEdges[:-1], binEdges[1:],
+                                        nPossible, nFound)
+        return Struct(completenessHistogram=histogram)
+
+
+class MergeApFakesCompletenessHistogramsConnections(
+        PipelineTaskConnections,
+        defaultTemplates={"coaddName": "deep",
+                          "fakesType": "fakes_"},
+        dimensions=("instrument", "visit")):
+    completenessHistograms = connTypes.Input(
+        doc="Completeness histograms of each detector.",
+        name="{fakesType}{coaddName}Diff_completenessHist",
+        storageClass="DataFrame",
+        dimensions=("instrument", "visit", "detector"),
+        multiple=True,
+    )
+    completenessHistogram = connTypes.Output(
+        doc="Completeness histogram of the visit.",
+        name="{fakesType}{coaddName}Diff_completenessHistVisit",
+        storageClass="DataFrame",
+        dimensions=("instrument", "visit"),
+    )
+
+
+class MergeApFakesCompletenessHistogramsConfig(
+        PipelineTaskConfig,
+        pipelineConnections=MergeApFakesCompletenessHistogramsConnections):
+    """Config for MergeApFakesCompletenessHistogramsTask.
+    """
+    pass
+
+
+class MergeApFakesCompletenessHistogramsTask(PipelineTask):
+    """Sum the completeness histograms of the detectors of a visit.
+    """
+
+    _DefaultName = "mergeApFakesCompletenessHistograms"
+    ConfigClass = MergeApFakesCompletenessHistogramsConfig
+
+    def run(self, completenessHistograms):
+        """Sum completeness histograms.
+
+        Parameters
+        ----------
+        completenessHistograms : `list` [`pandas.DataFrame`]
+            Histograms to sum, with the same magnitude bins.
+
+        Returns
+        -------
+        result : `lsst.pipe.base.Struct`
+            Results struct with components.
+
+            - ``completenessHistogram`` : The summed counts
+              (`pandas.DataFrame`).
+        """
+        return Struct(completenessHistogram=mergeCompletenessHistograms(completenessHistograms))
+
+
+class MergeApFakesTractCompletenessHistogramsConnections(
+        PipelineTaskConnections,
+        defaultTemplates={"coaddName": "deep",
+                          "fakesType": "fakes_"},
+        dimensions=("tract", "skymap")):
+    completenessHistograms = connTypes.Input(
+        doc="Completeness histograms of each detector overlapping the tract.",
+        name="{fakesType}{coaddName}Diff_completenessHist",
+        storageClass="DataFrame",
+        dimensions=("instrument", "visit", "detector"),
+        multiple=True,
+    )
+    completenessHistogram = connTypes.Output(
+        doc="Completeness histogram of the tract.",
+        name="{fakesType}{coaddName}Diff_completenessHistTract",
+        storageClass="DataFrame",
+        dimensions=("tract", "skymap"),
+    )
+
+
+class MergeApFakesTractCompletenessHistogramsConfig(
+        PipelineTaskConfig,
+        pipelineConnections=MergeApFakesTractCompletenessHistogramsConnections):
+    """Config for MergeApFakesTractCompletenessHistogramsTask.
+    """
+    pass
+
+
+class MergeApFakesTractCompletenessHistogramsTask(MergeApFakesCompletenessHistogramsTask):
+    """Sum the completeness histograms of all detectors overlapping a tract.
+
+    Detectors overlapping several tracts are counted in each of them.
+    """
+
+    _DefaultName = "mergeApFakesTractCompletenessHistograms"
+    ConfigClass = MergeApFakesTractCompletenessHistogramsConfig
+
+
+class MergeApFakesRunCompletenessHistogramsConnections(
+        PipelineTaskConnections,
+        defaultTemplates={"coaddName": "deep",
+                          "fakesType": "fakes_"},
+        dimensions=("instrument",)):
+    completenessHistograms = connTypes.Input(
+        doc="Completeness histograms of each visit.",
+        name="{fakesType}{coaddName}Diff_completenessHistVisit",
+        storageClass="DataFrame",
+        dimensions=("instrument", "visit"),
+        multiple=True,
+    )
+    completenessHistogram = connTypes.Output(
+        doc="Completeness histogram of all visits in the run.",
+        name="{fakesType}{coaddName}Diff_completenessHistRun",
+        storageClass="DataFrame",
+        dimensions=("instrument",),
+    )
+
+
+class MergeApFakesRunCompletenessHistogramsConfig(
+        PipelineTaskConfig,
+        pipelineConnections=MergeApFakesRunCompletenessHistogramsConnections):
+    """Config for MergeApFakesRunCompletenessHistogramsTask.
+    """
+    pass
+
+
+class MergeApFakesRunCompletenessHistogramsTask(MergeApFakesCompletenessHistogramsTask):
+    """Sum the visit completeness histograms of a whole run.
+    """
+
+    _DefaultName = "mergeApFakesRunCompletenessHistograms"
+    ConfigClass = MergeApFakesRunCompletenessHistogramsConfig
@@ -19,9 +19,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import concurrent.futures
+import itertools
+import multiprocessing
+import os
+import time
+
 import numpy as np
 import pandas as pd
-import uuid
+from scipy.special import ndtr, ndtri
 
 import lsst.pex.config as pexConfig
 from lsst.pipe.base import PipelineTask, PipelineTaskConnections, Struct
@@ -50,6 +56,19 @@ class CreateRandomApFakesConnections(PipelineTaskConnections,
         storageClass="DataFrame",
         dimensions=("tract", "skymap")
     )
+    fakeCatIndex = connTypes.Output(
+        doc="Index of the rows of the fakes catalog falling in each "
+            "declination zone.",
+        name="{fakesType}fakeSourceCat_zoneIndex",
+        storageClass="DataFrame",
+        dimensions=("tract", "skymap")
+    )
+
+    def __init__(self, *, config=None):
+        super().__init__(config=config)
+
+        if not config.doWriteSpatialIndex:
+            self.outputs.remove("fakeCatIndex")
 
 
 class CreateRandomApFakesConfig(
@@ -97,11 +116,78 @@ class CreateRandomApFakesConfig(
         min=1,
         max=40,
     )
+    magSampling = pexConfig.ChoiceField(
+        doc="How to sample the magnitudes of the fakes between magMin and "
+            "magMax. The stratified and importance modes write the weight of "
+            "each fake, relative to uniform sampling, to weightColName.",
+        dtype=str,
+        default="uniform",
+        allowed={
+            "uniform": "Draw each magnitude independently and uniformly.",
+            "stratified": "Draw the same number of magnitudes uniformly "
+                          "within each of magSamplingBins equal bins, in "
+                          "random order.",
+            "importance": "Draw magnitudes from a mixture of a uniform "
+                          "distribution and a normal distribution around "
+                          "importanceMag, concentrating fakes where the "
+                          "completeness changes.",
+        },
+    )
+    magSamplingBins = pexConfig.RangeField(
+        doc="Number of magnitude bins to stratify over if magSampling is "
+            "stratified.",
+        dtype=int,
+        default=20,
+        min=1,
+    )
+    importanceMag = pexConfig.Field(
+        doc="Center in magnitudes of the normal component of the sampling "
+            "distribution if magSampling is importance, typically the "
+            "expected 50% completeness magnitude. Must be between magMin and "
+            "magMax.",
+        dtype=float,
+        default=24.5,
+    )
+    importanceWidth = pexConfig.RangeField(
+        doc="Standard deviation in magnitudes of the normal component of the "
+            "sampling distribution if magSampling is importance.",
+        dtype=float,
+        default=1.0,
+        min=0,
+        inclusiveMin=False,
+    )
+    importanceUniformFraction = pexConfig.RangeField(
+        doc="Fraction of fakes drawn uniformly between magMin and magMax if "
+            "magSampling is importance. Bounds the weights of fakes far from "
+            "importanceMag by 1 / importanceUniformFraction.",
+        dtype=float,
+        default=0.2,
+        min=0,
+        max=1,
+        inclusiveMin=False,
+    )
+    weightColName = pexConfig.Field(
+        doc="Name of the column holding the sampling weight of each fake if "
+            "magSampling is not uniform.",
+        dtype=str,
+        default="magWeight",
+    )
     randomSeed = pexConfig.Field(
         doc="Random seed to set for reproducible datasets",
         dtype=int,
         default=1234,
     )
+    doSeedByTract = pexConfig.Field(
+        doc="Seed the random streams of each tract with both randomSeed and "
+            "the tract id, so that different tracts get independent fakes. "
+            "Otherwise every tract is generated from randomSeed alone, and "
+            "tracts of the same shape get the same fakes and fake ids. "
+            "Earlier versions always used randomSeed alone, so with this "
+            "default a given randomSeed gives different fakes than they did; "
+            "set to False to reproduce their positions and magnitudes.",
+        dtype=bool,
+        default=True,
+    )
     visitSourceFlagCol = pexConfig.Field(
         doc="Name of the column flagging objects for insertion into the visit "
             "image.",
@@ -114,6 +200,52 @@ class CreateRandomApFakesConfig(
         dtype=str,
         default="isTemplateSource"
     )
+    doSampleTractPolygon = pexConfig.Field(
+        doc="Sample fakes only within the inner polygon of the tract, with "
+            "the number of fakes set from the polygon area. Otherwise fakes "
+            "are sampled over the polygon's bounding circle.",
+        dtype=bool,
+        default=False,
+    )
+    doCompactCatalog = pexConfig.Field(
+        doc="Store magnitudes and the unused shape columns as float32, with "
+            "all bands sharing one magnitude buffer and all shape columns "
+            "sharing one buffer, and store the source type as categorical. "
+            "Positions are always float64.",
+        dtype=bool,
+        default=False,
+    )
+    chunkSize = pexConfig.RangeField(
+        doc="Number of fakes in each chunk yielded by iterFakeCatChunks and "
+            "written by writeFakeCatParquet. 0 makes the whole catalog a "
+            "single chunk. Does not change the catalog.",
+        dtype=int,
+        default=0,
+        min=0,
+    )
+    doWriteSpatialIndex = pexConfig.Field(
+        doc="Sort the fakes catalog into declination zones, ordered by RA "
+            "within each zone, and write an index of the rows in each zone.",
+        dtype=bool,
+        default=False,
+    )
+    spatialIndexZoneHeight = pexConfig.RangeField(
+        doc="Height in degrees of the declination zones used by the spatial "
+            "index.",
+        dtype=float,
+        default=0.05,
+        min=0,
+        inclusiveMin=False,
+    )
+
+    def validate(self):
+        super().validate()
+        # The truncated normal has no mass, and the weights no meaning,
+        # if its center is far outside the sampled range
+        if self.magSampling == "importance" \
+                and not self.magMin <= self.importanceMag <= self.magMax:
+            raise ValueError(f"importanceMag ({self.importanceMag}) must be between magMin "
+                             f"({self.magMin}) and magMax ({self.magMax}).")
 
 
 class CreateRandomApFakesTask(PipelineTask):
@@ -126,6 +258,10 @@ class CreateRandomApFakesTask(PipelineTask):
     _DefaultName = "createApFakes"
     ConfigClass = CreateRandomApFakesConfig
 
+    # Number of fakes drawn from each independent random stream. Changing
+    # it changes the catalogs of more than this many fakes.
+    _randomBlockSize = 100000
+
     def runQuantum(self, butlerQC, inputRefs, outputRefs):
         inputs = butlerQC.get(inputRefs)
         inputs["tractId"] = butlerQC.quantum.dataId["tract"]
@@ -145,40 +281,323 @@ class CreateRandomApFakesTask(PipelineTask):
 
         Returns
         -------
-        randoms : `pandas.DataFrame`
-            Catalog of random points covering the given tract. Follows the
-            columns and format expected in `lsst.pipe.tasks.InsertFakes`.
+        result : `lsst.pipe.base.Struct`
+            Results struct with components.
+
+            - ``fakeCat`` : Catalog of random points covering the given
+              tract. Follows the columns and format expected in
+              `lsst.pipe.tasks.InsertFakes`. (`pandas.DataFrame`)
+            - ``fakeCatIndex`` : Zone index of ``fakeCat``. Only present if
+              ``doWriteSpatialIndex`` is set. (`pandas.DataFrame`)
+        """
+        fakeCat = self._makeFakeCat(
+            _concatFakeCatData([data for _, data in self._iterFakeCatData(tractId, skyMap)]))
+
+        if self.config.doWriteSpatialIndex:
+            fakeCat, fakeCatIndex = self.createSpatialIndex(fakeCat)
+            return Struct(fakeCat=fakeCat, fakeCatIndex=fakeCatIndex)
+
+        return Struct(fakeCat=fakeCat)
+
+    def runTracts(self, tractIds, skyMap, numProcesses=1, outputDir=None):
+        """Create the catalogs of fakes covering several tracts.
+
+        Parameters
+        ----------
+        tractIds : iterable of `int`
+            Tract ids to produce randoms over.
+        skyMap : `lsst.skymap.SkyMap`
+            Skymap to produce randoms over.
+        numProcesses : `int`, optional
+            Number of processes to create the catalogs in. The catalogs do
+            not depend on the number of processes.
+        outputDir : `str`, optional
+            If set, write the catalog of each tract as soon as it is made to
+            ``<outputDir>/tract-<tractId>`` with `writeFakeCatParquet`,
+            instead of returning it. Only one chunk of each catalog is then
+            held in memory at a time.
+
+        Returns
+        -------
+        results : `dict` [`int`, `lsst.pipe.base.Struct`]
+            For each tract, the output of `run` or, if ``outputDir`` is set,
+            a struct whose ``paths`` component lists the files written.
+        """
+        tractIds = list(tractIds)
+        if not self.config.doSeedByTract and len(tractIds) > 1:
+            self.log.warning("doSeedByTract is not set; all tracts will have the same random fakes.")
+
+        nProcesses = min(numProcesses, len(tractIds))
+        # Daemonic pool workers may not fork
+        if nProcesses <= 1 or multiprocessing.current_process().daemon:
+            return {tractId: Struct(**self._runTract(tractId, skyMap, outputDir)) for tractId in tractIds}
+
+        self.log.info(f"Creating fakes over {len(tractIds)} tracts with {nProcesses} processes...")
+        startTime = time.time()
+        results = {}
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=nProcesses,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=_setForkedTask,
+                initargs=(self, skyMap)) as executor:
+            futures = {executor.submit(_runForkedTract, tractId, outputDir): tractId for tractId in tractIds}
+            for future in concurrent.futures.as_completed(futures):
+                results[futures[future]] = Struct(**future.result())
+        self.log.info(f"Created fakes over {len(tractIds)} tracts in {time.time() - startTime:.1f} s.")
+        return {tractId: results[tractId] for tractId in tractIds}
+
+    def _runTract(self, tractId, skyMap, outputDir=None):
+        """Create, and optionally write, the catalog of fakes of one tract.
+
+        Parameters
+        ----------
+        tractId : `int`
+            Tract id to produce randoms over.
+        skyMap : `lsst.skymap.SkyMap`
+            Skymap to produce randoms over.
+        outputDir : `str`, optional
+            Directory to write the catalog under, as in `runTracts`.
+
+        Returns
+        -------
+        result : `dict`
+            The components of the output of `run` or, if ``outputDir`` is
+            set, ``paths``, the files written.
         """
-        rng = np.random.default_rng(self.config.randomSeed)
-        tractBoundingCircle = \
-            skyMap.generateTract(tractId).getInnerSkyPolygon().getBoundingCircle()
-        tractArea = tractBoundingCircle.getArea() * (180 / np.pi) ** 2
+        if outputDir is None:
+            return self.run(tractId, skyMap).getDict()
+        paths = self.writeFakeCatParquet(tractId, skyMap, os.path.join(outputDir, f"tract-{tractId}"))
+        self.log.info(f"Wrote fakes of tract {tractId} to {len(paths)} files.")
+        return dict(paths=paths)
+
+    def getSeed(self, tractId):
+        """Return the seed of the random streams of a tract.
+
+        Parameters
+        ----------
+        tractId : `int`
+            Tract id to produce randoms over.
+
+        Returns
+        -------
+        seed : `int` or `list` [`int`]
+            Entropy for `numpy.random.SeedSequence`.
+        """
+        if self.config.doSeedByTract:
+            return [self.config.randomSeed, tractId]
+        return self.config.randomSeed
+
+    def iterFakeCatChunks(self, tractId, skyMap):
+        """Create the catalog of fakes covering a tract in chunks of
+        ``chunkSize`` rows.
+
+        The concatenated chunks are identical to the ``fakeCat`` returned by
+        `run` with the same config, whatever the ``chunkSize``, except that
+        the spatial index sorting is not applied. At most one chunk and one
+        random block (see ``_randomBlockSize``) are held in memory at a time.
+
+        Parameters
+        ----------
+        tractId : `int`
+            Tract id to produce randoms over.
+        skyMap : `lsst.skymap.SkyMap`
+            Skymap to produce randoms over.
+
+        Yields
+        ------
+        fakeCat : `pandas.DataFrame`
+            Catalog of the fakes in the next chunk, indexed by their
+            position in the full catalog. Follows the columns and format
+            expected in `lsst.pipe.tasks.InsertFakes`.
+        """
+        chunkSize = self.config.chunkSize
+        pending = []
+        nPending = 0
+        start = 0
+        for _, data in self._iterFakeCatData(tractId, skyMap):
+            pending.append(data)
+            nPending += len(data["fakeId"])
+            while chunkSize > 0 and nPending >= chunkSize:
+                data = _concatFakeCatData(pending)
+                yield self._makeFakeCat(_sliceFakeCatData(data, 0, chunkSize), start)
+                pending = [_sliceFakeCatData(data, chunkSize, nPending)]
+                nPending -= chunkSize
+                start += chunkSize
+        if nPending > 0 or start == 0:
+            yield self._makeFakeCat(_concatFakeCatData(pending), start)
+
+    def writeFakeCatParquet(self, tractId, skyMap, directory):
+        """Write the catalog of fakes covering a tract as partitioned
+        Parquet, one chunk at a time.
+
+        Parameters
+        ----------
+        tractId : `int`
+            Tract id to produce randoms over.
+        skyMap : `lsst.skymap.SkyMap`
+            Skymap to produce randoms over.
+        directory : `str`
+            Directory to write one ``part-NNNNN.parquet`` file per chunk
+            (see `iterFakeCatChunks`) to. ``pandas.read_parquet(directory)``
+            reads back the catalog returned by `run`, without the spatial
+            index sorting.
+
+        Returns
+        -------
+        paths : `list` [`str`]
+            The files written, in catalog order.
+        """
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for idx, chunk in enumerate(self.iterFakeCatChunks(tractId, skyMap)):
+            path = os.path.join(directory, f"part-{idx:05d}.parquet")
+            chunk.to_parquet(path, index=False)
+            paths.append(path)
+        return paths
+
+    def _iterFakeCatData(self, tractId, skyMap):
+        """Create the columns of the catalog of fakes covering a tract, one
+        random block at a time.
+
+        Parameters
+        ----------
+        tractId : `int`
+            Tract id to produce randoms over.
+        skyMap : `lsst.skymap.SkyMap`
+            Skymap to produce randoms over.
+
+        Yields
+        ------
+        start : `int`
+            Position of the first fake of the block in the full catalog.
+        data : `dict` [`str`, array-like]
+            Columns of the fakes in the block. At least one, possibly
+            empty, block is yielded.
+        """
+        tractPolygon = skyMap.generateTract(tractId).getInnerSkyPolygon()
+        tractBoundingCircle = tractPolygon.getBoundingCircle()
+        if self.config.doSampleTractPolygon:
+            tractArea = self._getPolygonArea(tractPolygon) * (180 / np.pi) ** 2
+            areaName = "inner polygon"
+        else:
+            tractArea = tractBoundingCircle.getArea() * (180 / np.pi) ** 2
+            areaName = "bounding circle"
         nFakes = int(self.config.fakeDensity * tractArea)
 
         self.log.info(
             f"Creating {nFakes} star fakes over tractId={tractId} with "
-            f"bounding circle area: {tractArea} deg^2")
+            f"{areaName} area: {tractArea} deg^2")
+
+        seed = self.getSeed(tractId)
+        # Each block draws from its own stream, so the catalog does not
+        # depend on how it is split into chunks. The first block draws from
+        # np.random.default_rng(seed), so catalogs that fit in one block are
+        # the same as when the catalog was drawn from a single stream.
+        blockStarts = np.arange(0, max(nFakes, 1), self._randomBlockSize)
+        blockEnds = np.append(blockStarts[1:], nFakes)
+        seedSeq = np.random.SeedSequence(seed)
+        seedSeqs = [seedSeq] + seedSeq.spawn(len(blockStarts) - 1)
+        for start, end, seedSeq in zip(blockStarts, blockEnds, seedSeqs):
+            yield start, self._createFakeCatData(end - start,
+                                                 start,
+                                                 nFakes,
+                                                 tractPolygon,
+                                                 np.random.default_rng(seedSeq),
+                                                 seed)
+
+    def _createFakeCatData(self, nFakes, start, nTotal, tractPolygon, rng, seed):
+        """Create the columns of one block of the catalog of fakes.
+
+        Parameters
+        ----------
+        nFakes : `int`
+            Number of fakes in the block.
+        start : `int`
+            Position of the first fake of the block in the full catalog.
+        nTotal : `int`
+            Number of fakes in the full catalog.
+        tractPolygon : `lsst.sphgeom.ConvexPolygon`
+            Inner polygon of the tract.
+        rng : `numpy.random.Generator`
+            Initialized random number generator for this block.
+        seed : `int` or `list` [`int`]
+            Seed of the catalog, used to derive the ids.
+
+        Returns
+        -------
+        data : `dict` [`str`, array-like]
+            Columns of the fakes in the block.
+        """
+        if self.config.doSampleTractPolygon:
+            randPositions = self.createRandomPolygonPositions(nFakes, tractPolygon, rng)
+        else:
+            randPositions = self.createRandomPositions(nFakes, tractPolygon.getBoundingCircle(), rng)
+        randMags = self.createRandomMagnitudes(nFakes, rng)
 
         # Concatenate the data and add dummy values for the unused variables.
         # Set all data to PSF like objects.
-        randData = {
-            "fakeId": [uuid.uuid4().int & (1 << 64) - 1 for n in range(nFakes)],
-            **self.createRandomPositions(nFakes, tractBoundingCircle, rng),
-            **self.createVisitCoaddSubdivision(nFakes),
-            **self.createRandomMagnitudes(nFakes, rng),
-            self.config.diskHLR: np.ones(nFakes, dtype="float"),
-            self.config.bulgeHLR: np.ones(nFakes, dtype="float"),
-            self.config.nDisk: np.ones(nFakes, dtype="float"),
-            self.config.nBulge: np.ones(nFakes, dtype="float"),
-            self.config.aDisk: np.ones(nFakes, dtype="float"),
-            self.config.aBulge: np.ones(nFakes, dtype="float"),
-            self.config.bDisk: np.ones(nFakes, dtype="float"),
-            self.config.bBulge: np.ones(nFakes, dtype="float"),
-            self.config.paDisk: np.ones(nFakes, dtype="float"),
-            self.config.paBulge: np.ones(nFakes, dtype="float"),
-            self.config.sourceType: nFakes * ["star"]}
-
-        return Struct(fakeCat=pd.DataFrame(data=randData))
+        return {
+            "fakeId": self.createFakeIds(start, nFakes, seed),
+            **randPositions,
+            **self.createVisitCoaddSubdivision(nFakes, start, nTotal),
+            **randMags,
+            **self.createStarShapes(nFakes)}
+
+    def _makeFakeCat(self, data, start=0):
+        """Make a catalog of fakes from its columns.
+
+        Parameters
+        ----------
+        data : `dict` [`str`, array-like]
+            Columns of the fakes.
+        start : `int`, optional
+            Position of the first fake in the full catalog.
+
+        Returns
+        -------
+        fakeCat : `pandas.DataFrame`
+            Catalog of the fakes, indexed by position in the full catalog.
+        """
+        index = pd.RangeIndex(start, start + len(data["fakeId"]))
+        if self.config.doCompactCatalog:
+            # Keep the columns that share a buffer from being copied.
+            return pd.DataFrame(data=data, index=index, copy=False)
+        return pd.DataFrame(data=data, index=index)
+
+    def createFakeIds(self, start, nFakes, seed):
+        """Create unique 64 bit ids from the positions of fakes in the
+        catalog.
+
+        Parameters
+        ----------
+        start : `int`
+            Position of the first fake in the full catalog.
+        nFakes : `int`
+            Number of fakes to create ids for.
+        seed : `int` or `list` [`int`]
+            Seed of the catalog; catalogs with different seeds get different
+            ids.
+
+        Returns
+        -------
+        ids : `numpy.ndarray`, (N,)
+            Unsigned 64 bit ids, unique within the catalog.
+
+        Notes
+        -----
+        The position of each fake, offset by a key derived from ``seed``, is
+        scrambled with the SplitMix64 finalizer. Every step of the finalizer
+        is a bijection of the 64 bit integers, so the ids are unique without
+        comparing them to the ids of other chunks.
+        """
+        key = np.random.SeedSequence(seed).generate_state(1, dtype=np.uint64)[0]
+        ids = np.arange(start, start + nFakes, dtype=np.uint64) + key
+        ids ^= ids >> np.uint64(30)
+        ids *= np.uint64(0xbf58476d1ce4e5b9)
+        ids ^= ids >> np.uint64(27)
+        ids *= np.uint64(0x94d049bb133111eb)
+        ids ^= ids >> np.uint64(31)
+        return ids
 
     def createRandomPositions(self, nFakes, boundingCircle, rng):
         """Create a set of spatially uniform randoms over the tract bounding
@@ -219,6 +638,119 @@ class CreateRandomApFakesTask(PipelineTask):
         return {self.config.decColName: decs,
                 self.config.raColName: ras}
 
+    def createRandomPolygonPositions(self, nFakes, polygon, rng):
+        """Create a set of spatially uniform randoms within a convex polygon
+        on the sphere.
+
+        Points are drawn over the bounding circle of the polygon in batches
+        sized from the polygon to circle area ratio, and those outside the
+        polygon are rejected until ``nFakes`` remain.
+
+        Parameters
+        ----------
+        nFakes : `int`
+            Number of fakes to create.
+        polygon : `lsst.sphgeom.ConvexPolygon`
+            Polygon covering the tract.
+        rng : `numpy.random.Generator`
+            Initialized random number generator.
+
+        Returns
+        -------
+        data : `dict`[`str`, `numpy.ndarray`]
+            Dictionary of RA and Dec locations within the polygon.
+        """
+        boundingCircle = polygon.getBoundingCircle()
+        acceptance = self._getPolygonArea(polygon) / boundingCircle.getArea()
+
+        ras = [np.empty(0)]
+        decs = [np.empty(0)]
+        nFound = 0
+        while nFound < nFakes:
+            nBatch = int(np.ceil(1.1 * (nFakes - nFound) / acceptance))
+            batch = self.createRandomPositions(nBatch, boundingCircle, rng)
+            isInPolygon = self._getPolygonMask(polygon,
+                                               batch[self.config.raColName],
+                                               batch[self.config.decColName])
+            ras.append(batch[self.config.raColName][isInPolygon])
+            decs.append(batch[self.config.decColName][isInPolygon])
+            nFound += isInPolygon.sum()
+
+        return {self.config.decColName: np.concatenate(decs)[:nFakes],
+                self.config.raColName: np.concatenate(ras)[:nFakes]}
+
+    def _getPolygonVertices(self, polygon):
+        """Get the vertices of a polygon as an array.
+
+        Parameters
+        ----------
+        polygon : `lsst.sphgeom.ConvexPolygon`
+            Polygon to get the vertices of.
+
+        Returns
+        -------
+        vertices : `numpy.ndarray`, (N, 3)
+            Unit vectors of the vertices in counter-clockwise order.
+        """
+        return np.array([[vertex.x(), vertex.y(), vertex.z()]
+                         for vertex in polygon.getVertices()])
+
+    def _getPolygonArea(self, polygon):
+        """Compute the area of a convex polygon on the unit sphere.
+
+        Parameters
+        ----------
+        polygon : `lsst.sphgeom.ConvexPolygon`
+            Polygon to compute the area of.
+
+        Returns
+        -------
+        area : `float`
+            Area of the polygon in steradians.
+
+        Notes
+        -----
+        The polygon is split into a fan of triangles around its first
+        vertex. The solid angle of each triangle follows
+        Van Oosterom & Strackee, IEEE Trans. Biomed. Eng., 30, 125 (1983).
+        """
+        vertices = self._getPolygonVertices(polygon)
+        first = vertices[0]
+        seconds = vertices[1:-1]
+        thirds = vertices[2:]
+        tripleProducts = np.einsum("j,ij->i", first, np.cross(seconds, thirds))
+        denominators = (1
+                        + np.dot(seconds, first)
+                        + np.einsum("ij,ij->i", seconds, thirds)
+                        + np.dot(thirds, first))
+        return np.sum(2 * np.arctan2(np.abs(tripleProducts), denominators))
+
+    def _getPolygonMask(self, polygon, ras, decs):
+        """Find the points within a convex polygon on the sphere.
+
+        Parameters
+        ----------
+        polygon : `lsst.sphgeom.ConvexPolygon`
+            Polygon to test against.
+        ras : `numpy.ndarray`, (N,)
+            RA coordinates in radians.
+        decs : `numpy.ndarray`, (N,)
+            Dec coordinates in radians.
+
+        Returns
+        -------
+        mask : `numpy.ndarray`, (N,)
+            Boolean array that is `True` for points within the polygon.
+        """
+        vertices = self._getPolygonVertices(polygon)
+        # Inward pointing normals of the great circles through each edge.
+        edgeNormals = np.cross(vertices, np.roll(vertices, -1, axis=0))
+        vectors = np.empty((len(ras), 3))
+        vectors[:, 0] = np.cos(decs) * np.cos(ras)
+        vectors[:, 1] = np.cos(decs) * np.sin(ras)
+        vectors[:, 2] = np.sin(decs)
+        return np.all(np.dot(vectors, edgeNormals.transpose()) >= 0, axis=1)
+
     def _createRotMatrix(self, boundingCircle):
         """Compute the 3d rotation matrix to rotate the dec=90 pole to the
         center of the circle bound.
@@ -272,7 +804,7 @@ class CreateRandomApFakesTask(PipelineTask):
         )
         return rotMatrix
 
-    def createVisitCoaddSubdivision(self, nFakes):
+    def createVisitCoaddSubdivision(self, nFakes, start=0, nTotal=None):
         """Assign a given fake either a visit image or coadd or both based on
         the ``faction`` config value.
 
@@ -280,6 +812,11 @@ class CreateRandomApFakesTask(PipelineTask):
         ----------
         nFakes : `int`
             Number of fakes to create.
+        start : `int`, optional
+            Position of the first fake in the full catalog, if only a block
+            of the catalog is being created.
+        nTotal : `int`, optional
+            Number of fakes in the full catalog. Defaults to ``nFakes``.
 
         Returns
         -------
@@ -287,16 +824,16 @@ class CreateRandomApFakesTask(PipelineTask):
             Dictionary of boolean arrays specifying which image to put a
             given fake into.
         """
-        nBoth = int(self.config.fraction * nFakes)
-        nOnly = int((1 - self.config.fraction) / 2 * nFakes)
-        isVisitSource = np.zeros(nFakes, dtype=bool)
-        isTemplateSource = np.zeros(nFakes, dtype=bool)
-        if nBoth > 0:
-            isVisitSource[:nBoth] = True
-            isTemplateSource[:nBoth] = True
+        if nTotal is None:
+            nTotal = nFakes
+        nBoth = int(self.config.fraction * nTotal)
+        nOnly = int((1 - self.config.fraction) / 2 * nTotal)
+        idxs = np.arange(start, start + nFakes)
+        isVisitSource = idxs < nBoth
+        isTemplateSource = idxs < nBoth
         if nOnly > 0:
-            isVisitSource[nBoth:(nBoth + nOnly)] = True
-            isTemplateSource[(nBoth + nOnly):] = True
+            isVisitSource = idxs < nBoth + nOnly
+            isTemplateSource |= idxs >= nBoth + nOnly
 
         return {self.config.visitSourceFlagCol: isVisitSource,
                 self.config.templateSourceFlagCol: isTemplateSource}
@@ -315,13 +852,276 @@ class CreateRandomApFakesTask(PipelineTask):
         -------
         randMags : `dict`[`str`, `numpy.ndarray`]
             Dictionary of magnitudes in the bands set by the ``filterSet``
-            config option.
+            config option. Unless ``magSampling`` is ``uniform``, also
+            contains the weights of the fakes under ``weightColName``.
+
+        Notes
+        -----
+        The weight of a fake is the ratio of the uniform density to the
+        density it was drawn from, so weighted counts of fakes are unbiased
+        estimates of the counts uniform sampling would give.
         """
-        mags = rng.uniform(self.config.magMin,
-                           self.config.magMax,
-                           size=nFakes)
+        if self.config.magSampling == "stratified":
+            mags, weights = self._createStratifiedMagnitudes(nFakes, rng)
+        elif self.config.magSampling == "importance":
+            mags, weights = self._createImportanceMagnitudes(nFakes, rng)
+        else:
+            mags = rng.uniform(self.config.magMin,
+                               self.config.magMax,
+                               size=nFakes)
+            weights = None
+        if self.config.doCompactCatalog:
+            mags = mags.astype(np.float32)
         randMags = {}
         for fil in self.config.filterSet:
             randMags[self.config.magVar % fil] = mags
+        if weights is not None:
+            randMags[self.config.weightColName] = weights
 
         return randMags
+
+    def _createStratifiedMagnitudes(self, nFakes, rng):
+        """Draw magnitudes stratified in equal bins between ``magMin`` and
+        ``magMax``.
+
+        Parameters
+        ----------
+        nFakes : `int`
+            Number of fakes to create.
+        rng : `numpy.random.Generator`
+            Initialized random number generator.
+
+        Returns
+        -------
+        mags : `numpy.ndarray`, (N,)
+            Magnitudes in random order, so that the visit and template
+            subdivision does not depend on magnitude.
+        weights : `numpy.ndarray`, (N,)
+            Expected number of fakes in the bin of each fake under uniform
+            sampling, divided by the number drawn.
+        """
+        nBins = self.config.magSamplingBins
+        binWidth = (self.config.magMax - self.config.magMin) / nBins
+        # Spread the remainder over randomly chosen bins to keep them unbiased.
+        counts = np.full(nBins, nFakes // nBins)
+        counts[rng.choice(nBins, size=nFakes % nBins, replace=False)] += 1
+
+        bins = np.repeat(np.arange(nBins), counts)
+        mags = self.config.magMin + binWidth * (bins + rng.uniform(0, 1, size=nFakes))
+        weights = (nFakes / nBins) / counts[bins]
+
+        order = rng.permutation(nFakes)
+        return mags[order], weights[order]
+
+    def _createImportanceMagnitudes(self, nFakes, rng):
+        """Draw magnitudes from a defensive mixture of a uniform and a
+        truncated normal distribution between ``magMin`` and ``magMax``.
+
+        Parameters
+        ----------
+        nFakes : `int`
+            Number of fakes to create.
+        rng : `numpy.random.Generator`
+            Initialized random number generator.
+
+        Returns
+        -------
+        mags : `numpy.ndarray`, (N,)
+            Magnitudes of the fakes.
+        weights : `numpy.ndarray`, (N,)
+            Ratio of the uniform density to the mixture density at each
+            magnitude.
+        """
+        magMin = self.config.magMin
+        magMax = self.config.magMax
+        center = self.config.importanceMag
+        width = self.config.importanceWidth
+        uniformFraction = self.config.importanceUniformFraction
+
+        cdfMin = ndtr((magMin - center) / width)
+        cdfMax = ndtr((magMax - center) / width)
+        isUniform = rng.uniform(0, 1, size=nFakes) < uniformFraction
+        # Draw from the truncated normal by inverting its CDF.
+        normalMags = center + width * ndtri(rng.uniform(cdfMin, cdfMax, size=nFakes))
+        mags = np.where(isUniform,
+                        rng.uniform(magMin, magMax, size=nFakes),
+                        np.clip(normalMags, magMin, magMax))
+
+        uniformDensity = 1 / (magMax - magMin)
+        normalDensity = (np.exp(-0.5 * ((mags - center) / width) ** 2)
+                         / (np.sqrt(2 * np.pi) * width * (cdfMax - cdfMin)))
+        mixtureDensity = uniformFraction * uniformDensity + (1 - uniformFraction) * normalDensity
+        return mags, uniformDensity / mixtureDensity
+
+    def createStarShapes(self, nFakes):
+        """Create the unused shape columns and source type of PSF like
+        fakes.
+
+        Parameters
+        ----------
+        nFakes : `int`
+            Number of fakes to create.
+
+        Returns
+        -------
+        shapes : `dict`[`str`, `numpy.ndarray`]
+            Dictionary of dummy shape parameters and source types. If
+            ``doCompactCatalog`` is set the shape columns share a single
+            float32 buffer and the source type is categorical.
+        """
+        shapeCols = [self.config.diskHLR, self.config.bulgeHLR,
+                     self.config.nDisk, self.config.nBulge,
+                     self.config.aDisk, self.config.aBulge,
+                     self.config.bDisk, self.config.bBulge,
+                     self.config.paDisk, self.config.paBulge]
+        if self.config.doCompactCatalog:
+            ones = np.ones(nFakes, dtype=np.float32)
+            shapes = {col: ones for col in shapeCols}
+            shapes[self.config.sourceType] = pd.Categorical.from_codes(
+                np.zeros(nFakes, dtype=np.int8), categories=["star"])
+        else:
+            shapes = {col: np.ones(nFakes, dtype="float") for col in shapeCols}
+            shapes[self.config.sourceType] = nFakes * ["star"]
+
+        return shapes
+
+    def createSpatialIndex(self, fakeCat):
+        """Sort a fakes catalog into declination zones and index the zones.
+
+        Within each zone the fakes are ordered by RA wrapped to [0, 2pi),
+        allowing consumers to select the rows near a position with a binary
+        search instead of a scan over the whole catalog.
+
+        Parameters
+        ----------
+        fakeCat : `pandas.DataFrame`
+            Catalog of fakes to index.
+
+        Returns
+        -------
+        fakeCat : `pandas.DataFrame`
+            Input catalog sorted by zone and RA.
+        fakeCatIndex : `pandas.DataFrame`
+            One row per non-empty zone, with columns ``zoneId``, ``decMin``
+            and ``decMax`` (radians), and the half open range of rows
+            ``begin`` to ``end`` of the sorted catalog in the zone.
+        """
+        zoneHeight = np.radians(self.config.spatialIndexZoneHeight)
+        ras = np.mod(fakeCat[self.config.raColName].to_numpy(), 2 * np.pi)
+        zones = np.floor(
+            (fakeCat[self.config.decColName].to_numpy() + np.pi / 2) / zoneHeight).astype(np.int64)
+
+        order = np.lexsort((ras, zones))
+        fakeCat = fakeCat.iloc[order].reset_index(drop=True)
+
+        zoneIds, begins, counts = np.unique(zones[order],
+                                            return_index=True,
+                                            return_counts=True)
+        fakeCatIndex = pd.DataFrame(
+            data={"zoneId": zoneIds,
+                  "decMin": zoneIds * zoneHeight - np.pi / 2,
+                  "decMax": (zoneIds + 1) * zoneHeight - np.pi / 2,
+                  "begin": begins,
+                  "end": begins + counts})
+
+        return fakeCat, fakeCatIndex
+
+
+def _concatFakeCatData(blocks):
+    """Concatenate the columns of consecutive blocks of fakes.
+
+    Parameters
+    ----------
+    blocks : `list` [`dict` [`str`, array-like]]
+        Columns of each block, as made by
+        ``CreateRandomApFakesTask._createFakeCatData``. Emptied as the
+        columns are concatenated, to limit peak memory.
+
+    Returns
+    -------
+    data : `dict` [`str`, array-like]
+        The concatenated columns. Columns that share a buffer in every block
+        share a buffer in the result.
+    """
+    if len(blocks) == 1:
+        return blocks[0]
+    names = list(blocks[0])
+    data = {}
+    # Concatenated columns, keyed by the identities of their blocks' arrays;
+    # these stay alive while any column still holds them, so ids are unique.
+    merged = {}
+    for name in names:
+        arrays = [block.pop(name) for block in blocks]
+        key = tuple(id(array) for array in arrays)
+        if key not in merged:
+            if isinstance(arrays[0], pd.Categorical):
+                merged[key] = pd.api.types.union_categoricals(arrays)
+            elif isinstance(arrays[0], list):
+                merged[key] = list(itertools.chain.from_iterable(arrays))
+            else:
+                merged[key] = np.concatenate(arrays)
+        data[name] = merged[key]
+    return data
+
+
+def _sliceFakeCatData(data, begin, end):
+    """Select consecutive rows of the columns of a block of fakes.
+
+    Parameters
+    ----------
+    data : `dict` [`str`, array-like]
+        Columns of the fakes.
+    begin, end : `int`
+        Half open range of the rows to select.
+
+    Returns
+    -------
+    data : `dict` [`str`, array-like]
+        The selected rows. Columns that share a buffer in ``data`` share a
+        buffer in the result.
+    """
+    sliced = {}
+    for name, array in data.items():
+        if id(array) not in sliced:
+            sliced[id(array)] = array[begin:end]
+    return {name: sliced[id(array)] for name, array in data.items()}
+
+
+# Task and skymap used by forked runTracts workers
+_forkedTask = None
+_forkedSkyMap = None
+
+
+def _setForkedTask(task, skyMap):
+    """Make a task and skymap available to a forked worker process.
+
+    Parameters
+    ----------
+    task : `CreateRandomApFakesTask`
+        The task to run in the worker.
+    skyMap : `lsst.skymap.SkyMap`
+        Skymap to produce randoms over. Inherited from the parent process
+        when forking, so it is never pickled.
+    """
+    global _forkedTask, _forkedSkyMap
+    _forkedTask = task
+    _forkedSkyMap = skyMap
+
+
+def _runForkedTract(tractId, outputDir):
+    """Create the fakes of one tract in a forked worker process.
+
+    Parameters
+    ----------
+    tractId : `int`
+        Tract id to produce randoms over.
+    outputDir : `str` or `None`
+        Directory to write the catalog under, as in
+        `CreateRandomApFakesTask.runTracts`.
+
+    Returns
+    -------
+    result : `dict`
+        The output of `CreateRandomApFakesTask._runTract`.
+    """
+    return _forkedTask._runTract(tractId, _forkedSkyMap, outputDir)
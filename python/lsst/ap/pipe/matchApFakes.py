@@ -25,7 +25,7 @@
 import numpy as np
 from scipy.spatial import cKDTree
 
-from lsst.geom import Box2D, radians, SpherePoint
+from lsst.geom import Box2D
 import lsst.pex.config as pexConfig
 from lsst.pipe.base import PipelineTask, PipelineTaskConnections, Struct
 import lsst.pipe.base.connectionTypes as connTypes
@@ -33,7 +33,53 @@ from lsst.pipe.tasks.insertFakes import InsertFakesConfig
 
 __all__ = ["MatchApFakesTask",
            "MatchApFakesConfig",
-           "MatchApFakesConnections"]
+           "MatchApFakesConnections",
+           "MatchApFakesVisitTask",
+           "MatchApFakesVisitConfig",
+           "MatchApFakesVisitConnections"]
+
+# Columns of the associated DiaSources used for matching.
+_DIA_SOURCE_MATCH_COLUMNS = ["ra", "decl", "diaSourceId"]
+
+
+def _getColumns(columns, requiredColumns):
+    """Combine configured and required columns of a catalog.
+
+    Parameters
+    ----------
+    columns : iterable of `str`
+        The configured columns, or an empty sequence for all columns.
+    requiredColumns : iterable of `str`
+        The columns that must be read.
+
+    Returns
+    -------
+    columns : `list` [`str`] or `None`
+        The columns to read without duplicates, or `None` for all columns.
+    """
+    if not columns:
+        return None
+    return list(dict.fromkeys(list(requiredColumns) + list(columns)))
+
+
+def _getDataFrame(handle, columns):
+    """Read some columns of a DataFrame dataset.
+
+    Parameters
+    ----------
+    handle : `lsst.daf.butler.DeferredDatasetHandle`
+        Handle to the dataset.
+    columns : `list` [`str`] or `None`
+        The columns to read, or `None` for all columns.
+
+    Returns
+    -------
+    catalog : `pandas.DataFrame`
+        The requested columns of the dataset.
+    """
+    if columns is None:
+        return handle.get()
+    return handle.get(parameters={"columns": columns})
 
 
 class MatchApFakesConnections(PipelineTaskConnections,
@@ -48,6 +94,13 @@ class MatchApFakesConnections(PipelineTaskConnections,
         doc="Catalog of fake sources to draw inputs from.",
         name="{fakesType}fakeSourceCat",
         storageClass="DataFrame",
+        dimensions=("tract", "skymap"),
+        deferLoad=True,
+    )
+    fakeCatIndex = connTypes.Input(
+        doc="Zone index of the rows of the fakes catalog.",
+        name="{fakesType}fakeSourceCat_zoneIndex",
+        storageClass="DataFrame",
         dimensions=("tract", "skymap")
     )
     diffIm = connTypes.Input(
@@ -62,6 +115,7 @@ class MatchApFakesConnections(PipelineTaskConnections,
         name="{fakesType}{coaddName}Diff_assocDiaSrc",
         storageClass="DataFrame",
         dimensions=("instrument", "visit", "detector"),
+        deferLoad=True,
     )
     matchedDiaSources = connTypes.Output(
         doc="",
@@ -70,6 +124,12 @@ class MatchApFakesConnections(PipelineTaskConnections,
         dimensions=("instrument", "visit", "detector"),
     )
 
+    def __init__(self, *, config=None):
+        super().__init__(config=config)
+
+        if not config.doUseSpatialIndex:
+            self.inputs.remove("fakeCatIndex")
+
 
 class MatchApFakesConfig(
         InsertFakesConfig,
@@ -83,6 +143,27 @@ class MatchApFakesConfig(
         min=0,
         max=10,
     )
+    doUseSpatialIndex = pexConfig.Field(
+        doc="Use the zone index written by CreateRandomApFakesTask to select "
+            "the fakes near the difference image instead of testing the "
+            "whole catalog.",
+        dtype=bool,
+        default=False,
+    )
+    fakeCatColumns = pexConfig.ListField(
+        doc="Columns of the fakes catalog to read and copy into the matched "
+            "catalog, in addition to the RA and Dec columns. If empty, read "
+            "all columns.",
+        dtype=str,
+        default=[],
+    )
+    diaSourceColumns = pexConfig.ListField(
+        doc="Columns of the associated DiaSource catalog to read and copy "
+            "into the matched catalog, in addition to ra, decl and "
+            "diaSourceId. If empty, read all columns.",
+        dtype=str,
+        default=[],
+    )
 
 
 class MatchApFakesTask(PipelineTask):
@@ -95,13 +176,42 @@ class MatchApFakesTask(PipelineTask):
     _DefaultName = "matchApFakes"
     ConfigClass = MatchApFakesConfig
 
+    # Fractional padding on the circle bounding an image on the sky.
+    _boundingCirclePadding = 1.1
+
     def runQuantum(self, butlerQC, inputRefs, outputRefs):
         inputs = butlerQC.get(inputRefs)
+        inputs["fakeCat"] = _getDataFrame(inputs["fakeCat"], self.getFakeCatColumns())
+        inputs["associatedDiaSources"] = _getDataFrame(inputs["associatedDiaSources"],
+                                                       self.getDiaSourceColumns())
 
         outputs = self.run(**inputs)
         butlerQC.put(outputs, outputRefs)
 
-    def run(self, fakeCat, diffIm, associatedDiaSources):
+    def getFakeCatColumns(self):
+        """Return the columns of the fakes catalog to read.
+
+        Returns
+        -------
+        columns : `list` [`str`] or `None`
+            The configured ``fakeCatColumns`` and the columns needed for
+            matching, or `None` to read all columns.
+        """
+        return _getColumns(self.config.fakeCatColumns,
+                           [self.config.raColName, self.config.decColName])
+
+    def getDiaSourceColumns(self):
+        """Return the columns of the associated DiaSource catalog to read.
+
+        Returns
+        -------
+        columns : `list` [`str`] or `None`
+            The configured ``diaSourceColumns`` and the columns needed for
+            matching, or `None` to read all columns.
+        """
+        return _getColumns(self.config.diaSourceColumns, _DIA_SOURCE_MATCH_COLUMNS)
+
+    def run(self, fakeCat, diffIm, associatedDiaSources, fakeCatIndex=None):
         """Match fakes to detected diaSources within a difference image bound.
 
         Parameters
@@ -112,6 +222,9 @@ class MatchApFakesTask(PipelineTask):
             Difference image where ``associatedDiaSources`` were detected in.
         associatedDiaSources : `pandas.DataFrame`
             Catalog of difference image sources detected in ``diffIm``.
+        fakeCatIndex : `pandas.DataFrame`, optional
+            Zone index of ``fakeCat`` as written by
+            `lsst.ap.pipe.createApFakes.CreateRandomApFakesTask`.
 
         Returns
         -------
@@ -121,8 +234,7 @@ class MatchApFakesTask(PipelineTask):
             - ``matchedDiaSources`` : Fakes matched to input diaSources. Has
               length of ``fakeCat``. (`pandas.DataFrame`)
         """
-        trimmedFakes = self._trimFakeCat(fakeCat, diffIm)
-        nPossibleFakes = len(trimmedFakes)
+        trimmedFakes = self._trimFakeCat(fakeCat, diffIm, fakeCatIndex)
 
         fakeVects = self._getVectors(trimmedFakes[self.config.raColName],
                                      trimmedFakes[self.config.decColName])
@@ -130,22 +242,50 @@ class MatchApFakesTask(PipelineTask):
             np.radians(associatedDiaSources.loc[:, "ra"]),
             np.radians(associatedDiaSources.loc[:, "decl"]))
 
+        # Not persisted between runs: building the tree costs milliseconds
+        # per detector, less than reading a stored index would
         diaSrcTree = cKDTree(diaSrcVects)
         dist, idxs = diaSrcTree.query(
             fakeVects,
             distance_upper_bound=np.radians(self.config.matchDistanceArcseconds / 3600))
+
+        return Struct(
+            matchedDiaSources=self._mergeMatches(trimmedFakes, associatedDiaSources, dist, idxs)
+        )
+
+    def _mergeMatches(self, trimmedFakes, associatedDiaSources, dist, idxs):
+        """Join fakes to the diaSources they were matched to.
+
+        Parameters
+        ----------
+        trimmedFakes : `pandas.DataFrame`
+            Fakes within the area of the difference image.
+        associatedDiaSources : `pandas.DataFrame`
+            Catalog of difference image sources to match to.
+        dist : `numpy.ndarray`, (N,)
+            Distance from each fake to its matched diaSource, or ``inf`` if
+            no diaSource was found within the match distance.
+        idxs : `numpy.ndarray`, (N,)
+            Position of the matched diaSource in ``associatedDiaSources``.
+            Ignored for unmatched fakes.
+
+        Returns
+        -------
+        matchedFakes : `pandas.DataFrame`
+            Fakes joined to the matched diaSources. Unmatched fakes have a
+            ``diaSourceId`` of 0.
+        """
+        nPossibleFakes = len(trimmedFakes)
         nFakesFound = np.isfinite(dist).sum()
 
         self.log.info(f"Found {nFakesFound} out of {nPossibleFakes} possible.")
         diaSrcIds = associatedDiaSources.iloc[np.where(np.isfinite(dist), idxs, 0)]["diaSourceId"].to_numpy()
         matchedFakes = trimmedFakes.assign(diaSourceId=np.where(np.isfinite(dist), diaSrcIds, 0))
 
-        return Struct(
-            matchedDiaSources=matchedFakes.merge(
-                associatedDiaSources.reset_index(drop=True), on="diaSourceId", how="left")
-        )
+        return matchedFakes.merge(
+            associatedDiaSources.reset_index(drop=True), on="diaSourceId", how="left")
 
-    def _trimFakeCat(self, fakeCat, image):
+    def _trimFakeCat(self, fakeCat, image, fakeCatIndex=None):
         """Trim the fake cat to about the size of the input image.
 
         Parameters
@@ -154,24 +294,134 @@ class MatchApFakesTask(PipelineTask):
             The catalog of fake sources to be input
         image : `lsst.afw.image.exposure.exposure.ExposureF`
             The image into which the fake sources should be added
+        fakeCatIndex : `pandas.core.frame.DataFrame`, optional
+            Zone index of ``fakeCat``. If provided, only the rows in the
+            zones and RA range overlapping the image are considered.
 
         Returns
         -------
         fakeCat : `pandas.core.frame.DataFrame`
             The original fakeCat trimmed to the area of the image
+
+        Notes
+        -----
+        Fakes are first cut on the sky to a circle bounding the image, which
+        is cheap to evaluate over the whole catalog. Only the fakes within
+        this circle are transformed to pixel coordinates and tested against
+        the image bounding box.
         """
         wcs = image.getWcs()
 
         bbox = Box2D(image.getBBox())
+        center, radius = self._getBoundingCircle(wcs, bbox)
+
+        if fakeCatIndex is None:
+            rows = np.arange(len(fakeCat))
+        else:
+            rows = self._getIndexedRows(fakeCat, fakeCatIndex, center, radius)
+        ras = fakeCat[self.config.raColName].to_numpy()[rows]
+        decs = fakeCat[self.config.decColName].to_numpy()[rows]
+
+        isNearby = self._getBoundingCircleMask(ras, decs, center, radius)
+        rows = rows[isNearby]
+        xs, ys = wcs.skyToPixelArray(ras[isNearby], decs[isNearby], degrees=False)
+
+        # Match the half open interval used by Box2D.contains.
+        isContained = np.logical_and.reduce(
+            [xs >= bbox.getMinX(), xs < bbox.getMaxX(),
+             ys >= bbox.getMinY(), ys < bbox.getMaxY()])
+
+        return fakeCat.iloc[rows[isContained]]
+
+    def _getIndexedRows(self, fakeCat, fakeCatIndex, center, radius):
+        """Find the rows of a zone indexed catalog that may fall in a circle.
+
+        Parameters
+        ----------
+        fakeCat : `pandas.DataFrame`
+            Catalog of fakes, sorted by zone and RA.
+        fakeCatIndex : `pandas.DataFrame`
+            Zone index of ``fakeCat``.
+        center : `lsst.geom.SpherePoint`
+            Center of the circle.
+        radius : `float`
+            Opening angle of the circle in radians.
+
+        Returns
+        -------
+        rows : `numpy.ndarray`, (N,)
+            Sorted positions of the candidate rows in ``fakeCat``.
+        """
+        centerRa = center.getRa().asRadians()
+        centerDec = center.getDec().asRadians()
+        zones = fakeCatIndex[np.logical_and(fakeCatIndex["decMax"] >= centerDec - radius,
+                                            fakeCatIndex["decMin"] <= centerDec + radius)]
+
+        if np.abs(centerDec) + radius >= np.pi / 2:
+            raRanges = [(0, 2 * np.pi)]
+        else:
+            halfWidth = np.arcsin(np.sin(radius) / np.cos(centerDec))
+            raMin = np.mod(centerRa - halfWidth, 2 * np.pi)
+            raMax = raMin + 2 * halfWidth
+            raRanges = [(raMin, min(raMax, 2 * np.pi))]
+            if raMax > 2 * np.pi:
+                raRanges.append((0, raMax - 2 * np.pi))
+
+        allRas = fakeCat[self.config.raColName].to_numpy()
+        rows = [np.empty(0, dtype=np.int64)]
+        for begin, end in zip(zones["begin"], zones["end"]):
+            zoneRas = np.mod(allRas[begin:end], 2 * np.pi)
+            for raMin, raMax in raRanges:
+                rows.append(np.arange(begin + np.searchsorted(zoneRas, raMin, side="left"),
+                                      begin + np.searchsorted(zoneRas, raMax, side="right")))
+
+        return np.sort(np.concatenate(rows))
+
+    def _getBoundingCircleMask(self, ras, decs, center, radius):
+        """Find the points within a circle on the sky.
 
-        def trim(row):
-            coord = SpherePoint(row[self.config.raColName],
-                                row[self.config.decColName],
-                                radians)
-            cent = wcs.skyToPixel(coord)
-            return bbox.contains(cent)
+        Parameters
+        ----------
+        ras : `numpy.ndarray`, (N,)
+            RA coordinates in radians.
+        decs : `numpy.ndarray`, (N,)
+            Dec coordinates in radians.
+        center : `lsst.geom.SpherePoint`
+            Center of the circle.
+        radius : `float`
+            Opening angle of the circle in radians.
 
-        return fakeCat[fakeCat.apply(trim, axis=1)]
+        Returns
+        -------
+        mask : `numpy.ndarray`, (N,)
+            Boolean array that is `True` for points within the circle.
+        """
+        centerVect = self._getVectors(np.array([center.getRa().asRadians()]),
+                                      np.array([center.getDec().asRadians()]))[0]
+        return np.dot(self._getVectors(ras, decs), centerVect) >= np.cos(radius)
+
+    def _getBoundingCircle(self, wcs, bbox):
+        """Compute a circle on the sky that encloses an image.
+
+        Parameters
+        ----------
+        wcs : `lsst.afw.geom.SkyWcs`
+            Wcs of the image.
+        bbox : `lsst.geom.Box2D`
+            Bounding box of the image.
+
+        Returns
+        -------
+        center : `lsst.geom.SpherePoint`
+            Sky position of the center of the image.
+        radius : `float`
+            Opening angle of the circle in radians. Padded to allow for
+            distortion along the edges of the image.
+        """
+        center = wcs.pixelToSky(bbox.getCenter())
+        radius = max(center.separation(wcs.pixelToSky(corner)).asRadians()
+                     for corner in bbox.getCorners())
+        return center, min(self._boundingCirclePadding * radius, np.pi)
 
     def _getVectors(self, ras, decs):
         """Convert ra dec to unit vectors on the sphere.
@@ -195,3 +445,182 @@ class MatchApFakesTask(PipelineTask):
         vectors[:, 1] = np.cos(decs) * np.sin(ras)
 
         return vectors
+
+
+class MatchApFakesVisitConnections(PipelineTaskConnections,
+                                   defaultTemplates={"coaddName": "deep",
+                                                     "fakesType": "fakes_"},
+                                   dimensions=("tract",
+                                               "skymap",
+                                               "instrument",
+                                               "visit")):
+    fakeCat = connTypes.Input(
+        doc="Catalog of fake sources to draw inputs from.",
+        name="{fakesType}fakeSourceCat",
+        storageClass="DataFrame",
+        dimensions=("tract", "skymap"),
+        deferLoad=True,
+    )
+    fakeCatIndex = connTypes.Input(
+        doc="Zone index of the rows of the fakes catalog.",
+        name="{fakesType}fakeSourceCat_zoneIndex",
+        storageClass="DataFrame",
+        dimensions=("tract", "skymap")
+    )
+    diffIm = connTypes.Input(
+        doc="Difference images on which the DiaSources were detected, one "
+            "per detector.",
+        name="{fakesType}{coaddName}Diff_differenceExp",
+        storageClass="ExposureF",
+        dimensions=("instrument", "visit", "detector"),
+        multiple=True,
+    )
+    associatedDiaSources = connTypes.Input(
+        doc="DiaSource catalogs after matching and SDMification, one per "
+            "detector.",
+        name="{fakesType}{coaddName}Diff_assocDiaSrc",
+        storageClass="DataFrame",
+        dimensions=("instrument", "visit", "detector"),
+        multiple=True,
+        deferLoad=True,
+    )
+    matchedDiaSources = connTypes.Output(
+        doc="Fakes matched to the DiaSources of each detector.",
+        name="{fakesType}{coaddName}Diff_matchDiaSrc",
+        storageClass="DataFrame",
+        dimensions=("instrument", "visit", "detector"),
+        multiple=True,
+    )
+
+    def __init__(self, *, config=None):
+        super().__init__(config=config)
+
+        if not config.doUseSpatialIndex:
+            self.inputs.remove("fakeCatIndex")
+
+
+class MatchApFakesVisitConfig(
+        MatchApFakesConfig,
+        pipelineConnections=MatchApFakesVisitConnections):
+    """Config for MatchApFakesVisitTask.
+    """
+    pass
+
+
+class MatchApFakesVisitTask(MatchApFakesTask):
+    """Match fakes to the detected diaSources of all detectors in a visit at
+    once.
+
+    Produces the same ``matchDiaSrc`` outputs as running `MatchApFakesTask`
+    on each detector, while building a single KD-tree and running a single
+    query for the whole visit.
+    """
+
+    _DefaultName = "matchApFakesVisit"
+    ConfigClass = MatchApFakesVisitConfig
+
+    # Offset between detectors along the extra dimension of the KD-tree.
+    # Larger than any chord between two points on the unit sphere, so fakes
+    # are never matched to a diaSource of a different detector.
+    _detectorSeparation = 4.0
+
+    def runQuantum(self, butlerQC, inputRefs, outputRefs):
+        inputs = butlerQC.get(inputRefs)
+        inputs["fakeCat"] = _getDataFrame(inputs["fakeCat"], self.getFakeCatColumns())
+
+        diffIms = {ref.dataId["detector"]: diffIm
+                   for ref, diffIm in zip(inputRefs.diffIm, inputs["diffIm"])}
+        diaSources = {ref.dataId["detector"]: diaSrc
+                      for ref, diaSrc in zip(inputRefs.associatedDiaSources,
+                                             inputs["associatedDiaSources"])}
+        detectors = sorted(diffIms.keys() & diaSources.keys())
+        inputs["diffIm"] = [diffIms[detector] for detector in detectors]
+        diaSourceColumns = self.getDiaSourceColumns()
+        inputs["associatedDiaSources"] = [_getDataFrame(diaSources[detector], diaSourceColumns)
+                                          for detector in detectors]
+
+        outputs = self.run(**inputs)
+        matchedDiaSources = dict(zip(detectors, outputs.matchedDiaSources))
+        for ref in outputRefs.matchedDiaSources:
+            if ref.dataId["detector"] in matchedDiaSources:
+                butlerQC.put(matchedDiaSources[ref.dataId["detector"]], ref)
+
+    def run(self, fakeCat, diffIm, associatedDiaSources, fakeCatIndex=None):
+        """Match fakes to detected diaSources for a set of detectors.
+
+        Parameters
+        ----------
+        fakeCat : `pandas.DataFrame`
+            Catalog of fakes to match to detected diaSources.
+        diffIm : `list` [`lsst.afw.image.Exposure`]
+            Difference images of each detector.
+        associatedDiaSources : `list` [`pandas.DataFrame`]
+            Catalogs of difference image sources detected in each element of
+            ``diffIm``.
+        fakeCatIndex : `pandas.DataFrame`, optional
+            Zone index of ``fakeCat`` as written by
+            `lsst.ap.pipe.createApFakes.CreateRandomApFakesTask`.
+
+        Returns
+        -------
+        result : `lsst.pipe.base.Struct`
+            Results struct with components.
+
+            - ``matchedDiaSources`` : Fakes matched to input diaSources for
+              each detector, in the order of ``diffIm``.
+              (`list` [`pandas.DataFrame`])
+        """
+        trimmedFakes = [self._trimFakeCat(fakeCat, image, fakeCatIndex) for image in diffIm]
+
+        fakeVects = np.concatenate(
+            [self._getDetectorVectors(fakes[self.config.raColName],
+                                      fakes[self.config.decColName],
+                                      idx)
+             for idx, fakes in enumerate(trimmedFakes)])
+        diaSrcVects = np.concatenate(
+            [self._getDetectorVectors(np.radians(diaSrc.loc[:, "ra"]),
+                                      np.radians(diaSrc.loc[:, "decl"]),
+                                      idx)
+             for idx, diaSrc in enumerate(associatedDiaSources)])
+
+        diaSrcTree = cKDTree(diaSrcVects)
+        dist, idxs = diaSrcTree.query(
+            fakeVects,
+            distance_upper_bound=np.radians(self.config.matchDistanceArcseconds / 3600))
+
+        fakeOffsets = np.cumsum([0] + [len(fakes) for fakes in trimmedFakes])
+        diaSrcOffsets = np.cumsum([0] + [len(diaSrc) for diaSrc in associatedDiaSources])
+        matchedDiaSources = []
+        for idx, (fakes, diaSrc) in enumerate(zip(trimmedFakes, associatedDiaSources)):
+            fakeSlice = slice(fakeOffsets[idx], fakeOffsets[idx + 1])
+            matchedDiaSources.append(
+                self._mergeMatches(fakes,
+                                   diaSrc,
+                                   dist[fakeSlice],
+                                   idxs[fakeSlice] - diaSrcOffsets[idx]))
+
+        return Struct(matchedDiaSources=matchedDiaSources)
+
+    def _getDetectorVectors(self, ras, decs, detectorIdx):
+        """Convert ra dec to unit vectors offset by detector.
+
+        Parameters
+        ----------
+        ras : `numpy.ndarray`, (N,)
+            RA coordinates in radians.
+        decs : `numpy.ndarray`, (N,)
+            Dec coordinates in radians.
+        detectorIdx : `int`
+            Position of the detector in the inputs.
+
+        Returns
+        -------
+        vectors : `numpy.ndarray`, (N, 4)
+            Vectors on the unit sphere for the given RA/DEC values, with a
+            fourth coordinate separating detectors.
+        """
+        vectors = np.empty((len(ras), 4))
+        vectors[:, :3] = self._getVectors(ras, decs)
+        vectors[:, 3] = detectorIdx * self._detectorSeparation
+
+        return vectors
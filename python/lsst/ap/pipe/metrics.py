@@ -35,9 +35,11 @@ import lsst.pex.config as pexConfig
 from lsst.pipe.base import Struct
 import lsst.pipe.base.connectionTypes as connTypes
 from lsst.pipe.tasks.insertFakes import InsertFakesConfig
-from lsst.verify import Measurement
+from lsst.verify import Datum, Measurement
 from lsst.verify.tasks import MetricTask, MetricComputationError
 
+from .completeness import computeCompletenessHistogram, makeMagBinEdges
+
 
 class ApFakesCompletenessMetricConnections(
         MetricTask.ConfigClass.ConnectionsClass,
@@ -53,6 +55,7 @@ class ApFakesCompletenessMetricConnections(
         name="{fakesType}{coaddName}Diff_matchDiaSrc",
         storageClass="DataFrame",
         dimensions=("instrument", "visit", "detector"),
+        deferLoad=True,
     )
 
 
@@ -80,6 +83,37 @@ class ApFakesCompletenessMetricConfig(
         min=1,
         max=40,
     )
+    doBinned = pexConfig.Field(
+        doc="Also compute the completeness in bins of magnitude between "
+            "magMin and magMax, for each of bands, and store the curves as "
+            "extras of the measurement.",
+        dtype=bool,
+        default=False,
+    )
+    magBinWidth = pexConfig.RangeField(
+        doc="Width of the magnitude bins if doBinned is set.",
+        dtype=float,
+        default=0.5,
+        min=0,
+        inclusiveMin=False,
+    )
+    bands = pexConfig.ListField(
+        doc="Bands to compute completeness curves for if doBinned is set. If "
+            "empty, use only the band of the quantum.",
+        dtype=str,
+        default=[],
+    )
+    doUseWeights = pexConfig.Field(
+        doc="Weight each fake by its sampling weight, as written by "
+            "CreateRandomApFakesTask with a non-uniform magSampling.",
+        dtype=bool,
+        default=False,
+    )
+    weightColName = pexConfig.Field(
+        doc="Name of the column holding the sampling weight of each fake.",
+        dtype=str,
+        default="magWeight",
+    )
 
 
 class ApFakesCompletenessMetricTask(MetricTask):
@@ -93,6 +127,11 @@ class ApFakesCompletenessMetricTask(MetricTask):
         try:
             inputs = butlerQC.get(inputRefs)
             inputs["band"] = butlerQC.quantum.dataId["band"]
+            # Reading a missing column fails in the formatter; let run report it
+            available = set(inputs["matchedFakes"].get(component="columns"))
+            columns = [column for column in self.getMatchedFakesColumns(inputs["band"])
+                       if column in available]
+            inputs["matchedFakes"] = inputs["matchedFakes"].get(parameters={"columns": columns})
             outputs = self.run(**inputs)
             if outputs.measurement is not None:
                 butlerQC.put(outputs, outputRefs)
@@ -105,6 +144,29 @@ class ApFakesCompletenessMetricTask(MetricTask):
                 "Measurement of {!r} failed on {}->{}\n{}",
                 self, inputRefs, outputRefs, traceback.format_exc())
 
+    def getMatchedFakesColumns(self, band):
+        """Return the columns of the matched fakes catalog used by `run`.
+
+        Parameters
+        ----------
+        band : `str`
+            Band of the ccdExposure.
+
+        Returns
+        -------
+        columns : `list` [`str`]
+            The magnitude columns of each band used, ``diaSourceId`` and,
+            if ``config.doUseWeights`` is set, the weight column.
+        """
+        bands = [band]
+        if self.config.doBinned and self.config.bands:
+            bands.extend(self.config.bands)
+        columns = list(dict.fromkeys(self.config.magVar % columnBand for columnBand in bands))
+        columns.append("diaSourceId")
+        if self.config.doUseWeights:
+            columns.append(self.config.weightColName)
+        return columns
+
     def run(self, matchedFakes, band):
         """Compute the completeness of recovered fakes within a magnitude
         range.
@@ -114,15 +176,34 @@ class ApFakesCompletenessMetricTask(MetricTask):
         matchedFakes : `lsst.afw.table.SourceCatalog` or `None`
             Catalog of fakes that were inserted into the ccdExposure matched
             to their detected counterparts.
+        band : `str`
+            Band of the ccdExposure.
 
         Returns
         -------
         result : `lsst.pipe.base.Struct`
             A `~lsst.pipe.base.Struct` containing the following component:
             ``measurement``
-                the ratio (`lsst.verify.Measurement` or `None`)
+                the ratio (`lsst.verify.Measurement` or `None`). If
+                ``config.doBinned`` is set, its extras also hold the
+                completeness curves (see `addBinnedCompleteness`).
+
+        Raises
+        ------
+        lsst.verify.tasks.MetricComputationError
+            Raised if ``matchedFakes`` lacks the magnitudes of ``band``, the
+            ``diaSourceId`` column or, if ``config.doUseWeights`` is set, the
+            weights, or if no fakes are in the magnitude range.
         """
         if matchedFakes is not None:
+            requiredColumns = [self.config.magVar % band, "diaSourceId"]
+            if self.config.doUseWeights:
+                requiredColumns.append(self.config.weightColName)
+            missing = [column for column in requiredColumns if column not in matchedFakes.columns]
+            if missing:
+                raise MetricComputationError(
+                    f"Columns {missing} not found in the matched fakes catalog; "
+                    f"cannot compute completeness.")
             magnitudes = matchedFakes[f"{self.config.magVar}" % band]
             magCutFakes = matchedFakes[np.logical_and(magnitudes > self.config.magMin,
                                                       magnitudes < self.config.magMax)]
@@ -131,11 +212,67 @@ class ApFakesCompletenessMetricTask(MetricTask):
                     "No matched fakes catalog sources found; Completeness is "
                     "ill defined.")
             else:
+                if self.config.doUseWeights:
+                    weights = magCutFakes[self.config.weightColName]
+                else:
+                    weights = np.ones(len(magCutFakes))
                 meas = Measurement(
                     self.config.metricName,
-                    ((magCutFakes["diaSourceId"] > 0).sum() / len(magCutFakes))
+                    (weights[magCutFakes["diaSourceId"] > 0].sum() / weights.sum())
                     * u.dimensionless_unscaled)
+                if self.config.doBinned:
+                    self.addBinnedCompleteness(meas, matchedFakes, band)
         else:
             self.log.info("Nothing to do: no matched catalog found.")
             meas = None
         return Struct(measurement=meas)
+
+    def addBinnedCompleteness(self, measurement, matchedFakes, band):
+        """Add completeness curves of all configured bands to a measurement.
+
+        Parameters
+        ----------
+        measurement : `lsst.verify.Measurement`
+            The measurement to add extras to.
+        matchedFakes : `pandas.DataFrame`
+            Catalog of fakes that were inserted into the ccdExposure matched
+            to their detected counterparts.
+        band : `str`
+            Band of the ccdExposure, used if ``config.bands`` is empty.
+
+        Raises
+        ------
+        lsst.verify.tasks.MetricComputationError
+            Raised if ``matchedFakes`` has no magnitudes for one of the bands.
+
+        Notes
+        -----
+        The extras are ``magBinEdges``, the edges of the magnitude bins, and,
+        for each band ``b``, ``bNumPossible`` and ``bNumFound``, the number
+        of inserted and of detected fakes in each bin, and
+        ``bCompleteness``, their ratio (NaN for empty bins). If
+        ``config.doUseWeights`` is set, the numbers are summed weights.
+        """
+        binEdges = makeMagBinEdges(self.config.magMin, self.config.magMax, self.config.magBinWidth)
+        isFound = matchedFakes["diaSourceId"].to_numpy() > 0
+        weights = matchedFakes[self.config.weightColName] if self.config.doUseWeights else None
+        measurement.extras["magBinEdges"] = Datum(
+            binEdges * u.mag, label="mag", description="Edges of the magnitude bins.")
+        for curveBand in self.config.bands or [band]:
+            column = self.config.magVar % curveBand
+            if column not in matchedFakes.columns:
+                raise MetricComputationError(
+                    f"No {column} column in the matched fakes catalog; cannot "
+                    f"compute the completeness of band {curveBand}.")
+            nPossible, nFound = computeCompletenessHistogram(matchedFakes[column], isFound, binEdges, weights)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                completeness = np.where(nPossible > 0, nFound / nPossible, np.nan)
+            measurement.extras[f"{curveBand}NumPossible"] = Datum(
+                nPossible * u.count, label=f"{curveBand} possible",
+                description=f"Number of fakes inserted in each magnitude bin, in band {curveBand}.")
+            measurement.extras[f"{curveBand}NumFound"] = Datum(
+                nFound * u.count, label=f"{curveBand} found",
+                description=f"Number of fakes detected in each magnitude bin, in band {curveBand}.")
+            measurement.extras[f"{curveBand}Completeness"] = Datum(
+                completeness * u.dimensionless_unscaled, label=f"{curveBand} completeness",
+                description=f"Fraction of fakes detected in each magnitude bin, in band {curveBand}.")
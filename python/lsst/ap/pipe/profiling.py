@@ -0,0 +1,413 @@
+#
+# This file is part of ap_pipe.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+__all__ = ["StageProfiler", "TargetCProfiler", "readProfiles", "summarizeProfiles", "getStageTimings",
+           "readStageTimings", "ProfileSummaryParser", "summarizeApPipeProfile"]
+
+import argparse
+import contextlib
+import cProfile
+import glob
+import json
+import os
+import resource
+import socket
+import sys
+import time
+
+import numpy as np
+
+# Quantities recorded for each stage, and reported by summarizeProfiles
+PROFILE_QUANTITIES = ["wallTime", "cpuTime", "maxRss", "readBytes", "writeBytes"]
+
+
+class StageProfiler:
+    """Record the resources used by each pipeline stage.
+
+    Each stage is written as one JSON line to a file in ``directory``, with
+    keys ``stage``, ``dataId``, ``start`` (Unix time), ``wallTime`` and
+    ``cpuTime`` (seconds), ``maxRss`` (bytes), and ``readBytes`` and
+    ``writeBytes`` (bytes read from and written to storage, or `None` if
+    not available).
+
+    Parameters
+    ----------
+    directory : `str`
+        The directory to write profiles to. Each process writes its own file.
+
+    Notes
+    -----
+    ``cpuTime`` includes the time of threads and of child processes that
+    finished during the stage. ``maxRss`` is the peak memory use of the
+    process so far, so it only increases from one stage to the next.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    @property
+    def path(self):
+        """The file that this process writes to (`str`).
+        """
+        return os.path.join(self.directory, "{0}-{1}.jsonl".format(socket.gethostname(), os.getpid()))
+
+    @contextlib.contextmanager
+    def profile(self, stage, dataId):
+        """Profile a block of code as a single stage.
+
+        Parameters
+        ----------
+        stage : `str`
+            The name of the stage.
+        dataId : `dict`
+            The data ID being processed.
+        """
+        start = time.time()
+        startCpu = _getCpuTime()
+        startIo = _getIoBytes()
+        try:
+            yield
+        finally:
+            endIo = _getIoBytes()
+            record = {
+                "stage": stage,
+                "dataId": dict(dataId),
+                "start": start,
+                "wallTime": time.time() - start,
+                "cpuTime": _getCpuTime() - startCpu,
+                "maxRss": _getMaxRss(),
+                "readBytes": endIo[0] - startIo[0] if startIo else None,
+                "writeBytes": endIo[1] - startIo[1] if startIo else None,
+            }
+            self.write(record)
+
+    def write(self, record):
+        """Append a record to this process's profile.
+
+        Parameters
+        ----------
+        record : `dict`
+            The JSON-serializable record to write.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+
+
+class TargetCProfiler:
+    """Run `cProfile` on the stages of selected targets.
+
+    The statistics of each profiled stage are written to
+    ``<directory>/<stage>-<dataId>.prof``, for use with `pstats` or tools
+    such as ``snakeviz``.
+
+    Parameters
+    ----------
+    directory : `str`
+        The directory to write statistics to.
+    dataIds : `list` [`dict`]
+        The (possibly partial) data IDs to profile. A target is profiled if
+        its data ID contains all keys and values of any of these.
+    stages : iterable of `str`, optional
+        The stages to profile.
+
+    Notes
+    -----
+    Only the process running the stage is profiled. Templates processed by
+    forked workers (see ``ApPipeConfig.numProcessCcdProcesses``) are
+    profiled in those workers, as the ``templateCcdProcessor`` stage, which
+    is only profiled if included in ``stages``.
+    """
+
+    def __init__(self, directory, dataIds, stages=("ccdProcessor", "differencer", "diaPipe")):
+        self.directory = directory
+        self.dataIds = [dict(dataId) for dataId in dataIds]
+        self.stages = set(stages)
+        self._active = False
+
+    def isSelected(self, dataId):
+        """Test whether a target is profiled.
+
+        Parameters
+        ----------
+        dataId : `dict`
+            The data ID of the target.
+
+        Returns
+        -------
+        selected : `bool`
+            `True` if ``dataId`` matches any of ``self.dataIds``.
+        """
+        return any(all(key in dataId and str(dataId[key]) == str(value) for key, value in selection.items())
+                   for selection in self.dataIds)
+
+    def getPath(self, stage, dataId):
+        """Return the file to which the statistics of a stage are written.
+
+        Parameters
+        ----------
+        stage : `str`
+            The name of the stage.
+        dataId : `dict`
+            The data ID being processed.
+
+        Returns
+        -------
+        path : `str`
+            The statistics file.
+        """
+        dataIdString = "_".join("{0}={1}".format(key, value) for key, value in sorted(dataId.items()))
+        return os.path.join(self.directory, "{0}-{1}.prof".format(stage, dataIdString.replace("/", "-")))
+
+    @contextlib.contextmanager
+    def profile(self, stage, dataId):
+        """Profile a block of code as a single stage, if it is selected.
+
+        Parameters
+        ----------
+        stage : `str`
+            The name of the stage.
+        dataId : `dict`
+            The data ID being processed.
+        """
+        # Only one cProfile.Profile can be enabled at a time
+        if self._active or stage not in self.stages or not self.isSelected(dataId):
+            yield
+            return
+
+        profiler = cProfile.Profile()
+        self._active = True
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self._active = False
+            os.makedirs(self.directory, exist_ok=True)
+            profiler.dump_stats(self.getPath(stage, dataId))
+
+
+def _getCpuTime():
+    """Return the CPU time used by this process and its finished children.
+    """
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def _getMaxRss():
+    """Return the peak resident memory of this process, in bytes.
+    """
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, and in kilobytes elsewhere
+    return maxRss if sys.platform == "darwin" else maxRss * 1024
+
+
+def _getIoBytes():
+    """Return the bytes this process has read from and written to storage.
+
+    Returns
+    -------
+    ioBytes : `tuple` [`int`, `int`] or `None`
+        The bytes read and written, or `None` if this is not available.
+    """
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(":") for line in f if ":" in line)
+        return int(counters["read_bytes"]), int(counters["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def readProfiles(paths):
+    """Read profile records written by `StageProfiler`.
+
+    Parameters
+    ----------
+    paths : iterable of `str`
+        Profile files, or directories containing them.
+
+    Returns
+    -------
+    records : `list` [`dict`]
+        All records in the files.
+    """
+    records = []
+    for path in paths:
+        files = sorted(glob.glob(os.path.join(path, "*.jsonl"))) if os.path.isdir(path) else [path]
+        for fileName in files:
+            with open(fileName) as f:
+                records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+def summarizeProfiles(records, percentiles=(50, 95, 99)):
+    """Compute percentiles of each profiled quantity for each stage.
+
+    Parameters
+    ----------
+    records : iterable of `dict`
+        Records written by `StageProfiler`.
+    percentiles : sequence of `float`, optional
+        The percentiles to compute.
+
+    Returns
+    -------
+    summary : `dict` [`str`, `dict`]
+        For each stage, ``count`` (the number of records) and, for each
+        quantity, a `dict` of its percentiles keyed by ``"p<percentile>"``.
+        Quantities with no recorded values are omitted.
+    """
+    byStage = {}
+    for record in records:
+        byStage.setdefault(record["stage"], []).append(record)
+
+    summary = {}
+    for stage, stageRecords in byStage.items():
+        stageSummary = {"count": len(stageRecords)}
+        for quantity in PROFILE_QUANTITIES:
+            values = np.array([record[quantity] for record in stageRecords
+                               if record.get(quantity) is not None], dtype=float)
+            if len(values):
+                stageSummary[quantity] = {"p%g" % p: v
+                                          for p, v in zip(percentiles, np.percentile(values, percentiles))}
+        summary[stage] = stageSummary
+    return summary
+
+
+def getStageTimings(summary):
+    """Extract the typical CPU time of each stage from a profile summary.
+
+    Parameters
+    ----------
+    summary : `dict` [`str`, `dict`]
+        The output of `summarizeProfiles`.
+
+    Returns
+    -------
+    timings : `dict` [`str`, `float`]
+        The median CPU time of each stage, in seconds. Stages without
+        recorded CPU times are omitted.
+    """
+    return {stage: stageSummary["cpuTime"]["p50"] for stage, stageSummary in summary.items()
+            if "cpuTime" in stageSummary}
+
+
+def readStageTimings(path):
+    """Read the typical CPU time of each stage.
+
+    Parameters
+    ----------
+    path : `str`
+        Either profiles written by `StageProfiler` (a ``.jsonl`` file, or a
+        directory containing them), the JSON summary written by
+        ``ap_pipe_profile.py --json``, or a JSON object of CPU seconds per
+        stage, as written by ``ap_pipe_profile.py --timings``.
+
+    Returns
+    -------
+    timings : `dict` [`str`, `float`]
+        The typical CPU time of each stage, in seconds.
+
+    Raises
+    ------
+    ValueError
+        Raised if ``path`` is JSON but not in one of these formats.
+    """
+    if os.path.isdir(path) or path.endswith(".jsonl"):
+        return getStageTimings(summarizeProfiles(readProfiles([path])))
+
+    with open(path) as f:
+        timings = json.load(f)
+    if not isinstance(timings, dict):
+        raise ValueError("Stage timings in {0} must be a JSON object.".format(path))
+    if timings and all(isinstance(value, dict) for value in timings.values()):
+        return getStageTimings(timings)
+    try:
+        return {stage: float(seconds) for stage, seconds in timings.items()}
+    except (TypeError, ValueError) as e:
+        raise ValueError("Cannot read stage timings from {0}.".format(path)) from e
+
+
+class ProfileSummaryParser(argparse.ArgumentParser):
+    """Argument parser for summarizing ap_pipe.py stage profiles.
+    """
+
+    def __init__(self, description=None, **kwargs):
+        if description is None:
+            # Description must be readable in both Sphinx and ap_pipe_profile.py -h
+            description = """\
+Summarize the per-stage profiles written by ``ap_pipe.py --profile-stages``.
+
+Prints the 50th, 95th and 99th percentiles of wall time, CPU time, peak
+memory and I/O for each stage.
+"""
+        super().__init__(description=description, **kwargs)
+
+        self.add_argument("paths", nargs="+", metavar="PATH",
+                          help="profile files, or directories containing them "
+                               "(e.g., OUTPUT/apPipe_profile)")
+        self.add_argument("--json", metavar="PATH",
+                          help="also write the full summary as JSON to PATH")
+        self.add_argument("--timings", metavar="PATH",
+                          help="write the median CPU time of each stage to PATH, in the format "
+                               "expected by ap_pipe.py --plan-timings")
+
+
+def summarizeApPipeProfile(args=None):
+    """Print a summary of ap_pipe.py stage profiles.
+
+    Parameters
+    ----------
+    args : `list` [`str`], optional
+        List of command-line arguments; if `None` use `sys.argv`.
+
+    Returns
+    -------
+    summary : `dict` [`str`, `dict`]
+        The output of `summarizeProfiles`.
+    """
+    parser = ProfileSummaryParser()
+    parsedCmd = parser.parse_args(args=args)
+
+    summary = summarizeProfiles(readProfiles(parsedCmd.paths))
+    units = {"wallTime": 1.0, "cpuTime": 1.0, "maxRss": 2**20, "readBytes": 2**20, "writeBytes": 2**20}
+    print("{0:<14s} {1:>6s} {2:<18s} {3:>12s} {4:>12s} {5:>12s}".format(
+        "stage", "count", "quantity", "p50", "p95", "p99"))
+    for stage, stageSummary in sorted(summary.items()):
+        for quantity in PROFILE_QUANTITIES:
+            if quantity in stageSummary:
+                label = quantity + (" (s)" if units[quantity] == 1.0 else " (MiB)")
+                print("{0:<14s} {1:>6d} {2:<18s} {3:>12.2f} {4:>12.2f} {5:>12.2f}".format(
+                    stage, stageSummary["count"], label,
+                    *(value / units[quantity] for value in stageSummary[quantity].values())))
+
+    if parsedCmd.json is not None:
+        with open(parsedCmd.json, "w") as f:
+            json.dump(summary, f, indent=2)
+    if parsedCmd.timings is not None:
+        with open(parsedCmd.timings, "w") as f:
+            json.dump(getStageTimings(summary), f, indent=2)
+    return summary
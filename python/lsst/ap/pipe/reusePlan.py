@@ -0,0 +1,150 @@
+#
+# This file is part of ap_pipe.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+__all__ = ["ReusePlan", "makeReusePlan", "getDataIdKey"]
+
+import collections
+import concurrent.futures
+import os
+import urllib.parse
+
+
+class ReusePlan:
+    """The outputs known to exist before a run starts.
+
+    Parameters
+    ----------
+    existence : `dict` [`tuple`, `bool`], optional
+        Whether each dataset exists, keyed by
+        ``(datasetType, getDataIdKey(dataId))``.
+    """
+
+    def __init__(self, existence=None):
+        self._existence = dict(existence) if existence else {}
+
+    def __len__(self):
+        return len(self._existence)
+
+    def exists(self, datasetType, dataId):
+        """Look up whether a dataset exists in the output repository.
+
+        Parameters
+        ----------
+        datasetType : `str`
+            The dataset type to look up.
+        dataId : `dict`
+            The data ID of the dataset.
+
+        Returns
+        -------
+        exists : `bool` or `None`
+            Whether the dataset exists, or `None` if it is not in the plan.
+        """
+        return self._existence.get((datasetType, getDataIdKey(dataId)))
+
+    def setExists(self, datasetType, dataId, exists=True):
+        """Record whether a dataset exists.
+
+        Parameters
+        ----------
+        datasetType : `str`
+            The dataset type to record.
+        dataId : `dict`
+            The data ID of the dataset.
+        exists : `bool`, optional
+            Whether the dataset exists.
+        """
+        self._existence[(datasetType, getDataIdKey(dataId))] = exists
+
+
+def makeReusePlan(butler, queries, numThreads=16):
+    """Find which of many datasets exist in an output repository.
+
+    Rather than checking each dataset separately, the files of all datasets
+    are looked up concurrently, and each directory containing them is
+    listed only once.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.persistence.Butler`
+        A Butler whose output repository is to be checked.
+    queries : iterable of `tuple` [`str`, `dict`]
+        The dataset type and data ID of each dataset to check. Duplicates
+        are checked once.
+    numThreads : `int`, optional
+        Maximum number of concurrent lookups.
+
+    Returns
+    -------
+    plan : `ReusePlan`
+        Whether each queried dataset exists. Datasets that are not stored as
+        files are omitted, and must be checked with
+        ``butler.datasetExists`` instead.
+    """
+    queries = {(datasetType, getDataIdKey(dataId)): (datasetType, dataId)
+               for datasetType, dataId in queries}
+
+    def getPath(query):
+        datasetType, dataId = query
+        try:
+            uri = butler.getUri(datasetType, dataId, write=True)
+        except Exception:
+            return None
+        # Strip any HDU suffix, e.g. "calexp.fits[0]"
+        return urllib.parse.urlparse(uri).path.split("[")[0]
+
+    def listDirectory(directory):
+        try:
+            return set(os.listdir(directory))
+        except (FileNotFoundError, NotADirectoryError):
+            return set()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=numThreads) as executor:
+        paths = dict(zip(queries, executor.map(getPath, queries.values())))
+        directories = collections.defaultdict(list)
+        for key, path in paths.items():
+            if path:
+                directories[os.path.dirname(path)].append(key)
+        listings = dict(zip(directories, executor.map(listDirectory, directories)))
+
+    existence = {}
+    for directory, keys in directories.items():
+        for key in keys:
+            existence[key] = os.path.basename(paths[key]) in listings[directory]
+    return ReusePlan(existence)
+
+
+def getDataIdKey(dataId):
+    """Return a hashable key uniquely identifying a data ID.
+
+    Parameters
+    ----------
+    dataId : `dict`
+        The data ID to identify.
+
+    Returns
+    -------
+    key : `tuple`
+        A key that is equal for equal data IDs.
+    """
+    return tuple(sorted(dataId.items()))
@@ -0,0 +1,218 @@
+#
+# This file is part of ap_pipe.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+__all__ = ["Arrival", "DirectoryWatcher"]
+
+import collections
+import math
+import os
+import re
+import time
+
+Arrival = collections.namedtuple("Arrival", ["path", "dataId", "time"])
+Arrival.__doc__ = """A newly arrived file.
+
+Parameters
+----------
+path : `str`
+    The path to the file.
+dataId : `dict`
+    The data ID parsed from the path.
+time : `float`
+    The time the file arrived, in seconds since the epoch. This is the last
+    time the file or its metadata changed, so a file copied with its
+    original modification time (e.g., by ``rsync -t`` or ``cp -p``) arrives
+    when it was copied.
+"""
+
+
+class DirectoryWatcher:
+    """Find files as they arrive in a directory tree.
+
+    Parameters
+    ----------
+    directory : `str`
+        The directory to watch, including its subdirectories.
+    pattern : `str`
+        A regular expression matched (with `re.search`) against the path of
+        each file relative to ``directory``. Files that do not match are
+        ignored. The named groups of the match form the data ID of the file,
+        e.g. ``r"(?P<visit>\\d+)/.*-(?P<ccdnum>\\d+)\\.fits"``.
+    keyTypes : `dict` [`str`, `type`], optional
+        The type of each data ID key. Values of other keys are strings.
+    settleTime : `float`, optional
+        Files changed (including their metadata) less than this many
+        seconds ago are assumed to be still being written, and are not
+        reported until later.
+
+    Notes
+    -----
+    Only directories changed since the previous poll are listed again, so
+    polling an unchanged tree costs one ``stat`` per directory. Files are
+    remembered only until they are older than the previous poll, plus files
+    that have not settled yet. This relies on the file system's timestamps
+    agreeing with the local clock to within a couple of seconds.
+    """
+
+    # Allowed difference, in seconds, between file timestamps and the local clock
+    _clockTolerance = 2.0
+
+    def __init__(self, directory, pattern, keyTypes=None, settleTime=0.0):
+        self.directory = directory
+        self.pattern = re.compile(pattern)
+        self.keyTypes = dict(keyTypes) if keyTypes else {}
+        self.settleTime = settleTime
+        # Files and directories changed before this time were handled by an earlier poll
+        self._watermark = -math.inf
+        self._subdirectories = {}
+        # Handled files changed after the watermark, with their change times
+        self._recent = {}
+        self._unsettled = set()
+
+    def poll(self):
+        """Find files that have arrived since the last call.
+
+        Returns
+        -------
+        arrivals : `list` [`Arrival`]
+            The new files matching ``pattern``, in order of arrival. The
+            first call reports all files already present.
+        """
+        now = time.time()
+        arrivals = []
+        unsettled, self._unsettled = self._unsettled, set()
+        directories = [self.directory]
+        while directories:
+            directory = directories.pop()
+            try:
+                changed = _getChangeTime(os.stat(directory))
+            except FileNotFoundError:
+                self._subdirectories.pop(directory, None)
+                continue
+            if changed < self._watermark and directory in self._subdirectories:
+                directories.extend(self._subdirectories[directory])
+                continue
+
+            subdirectories = []
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirectories.append(entry.path)
+                        else:
+                            isUnsettled = entry.path in unsettled
+                            unsettled.discard(entry.path)
+                            self._checkFile(entry.path, now, arrivals, isUnsettled=isUnsettled)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            self._subdirectories[directory] = subdirectories
+            directories.extend(subdirectories)
+
+        # Files in unchanged directories that may have settled since
+        for path in unsettled:
+            self._checkFile(path, now, arrivals, isUnsettled=True)
+
+        self._watermark = now - self._clockTolerance
+        self._recent = {path: changed for path, changed in self._recent.items() if changed >= self._watermark}
+        return sorted(arrivals, key=lambda arrival: arrival.time)
+
+    def _checkFile(self, path, now, arrivals, isUnsettled=False):
+        """Report a file if it is new, matches ``pattern``, and has settled.
+
+        Parameters
+        ----------
+        path : `str`
+            The path to the file.
+        now : `float`
+            The time the current poll started.
+        arrivals : `list` [`Arrival`]
+            The new files found so far, to which the file is added.
+        isUnsettled : `bool`, optional
+            `True` if the file had not settled in the previous poll.
+        """
+        if path in self._recent:
+            return
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return
+        changed = _getChangeTime(stat)
+        if changed < self._watermark and not isUnsettled:
+            return
+
+        match = self.pattern.search(os.path.relpath(path, self.directory))
+        if match is None:
+            self._recent[path] = changed
+            return
+        if now - changed < self.settleTime:
+            self._unsettled.add(path)
+            return
+        self._recent[path] = changed
+        dataId = {key: self.keyTypes[key](value) if key in self.keyTypes else value
+                  for key, value in match.groupdict().items() if value is not None}
+        arrivals.append(Arrival(path=path, dataId=dataId, time=changed))
+
+    def watch(self, interval=1.0, idleTimeout=None):
+        """Report files as they arrive.
+
+        Parameters
+        ----------
+        interval : `float`, optional
+            The time to wait between looking for files, in seconds.
+        idleTimeout : `float`, optional
+            Stop after this many seconds without new files. If `None`, watch
+            forever.
+
+        Yields
+        ------
+        arrivals : `list` [`Arrival`]
+            Each non-empty batch of new files, as returned by `poll`.
+        """
+        lastArrival = time.time()
+        while True:
+            arrivals = self.poll()
+            if arrivals:
+                lastArrival = time.time()
+                yield arrivals
+            elif idleTimeout is not None and time.time() - lastArrival >= idleTimeout:
+                return
+            else:
+                time.sleep(interval)
+
+
+def _getChangeTime(stat):
+    """Return the last time a file or directory, or its metadata, changed.
+
+    Parameters
+    ----------
+    stat : `os.stat_result`
+        The status of the file or directory.
+
+    Returns
+    -------
+    changed : `float`
+        The later of its modification and status change times. Renaming a
+        file into a directory updates both times of the directory, and the
+        status change time of the file.
+    """
+    return max(stat.st_mtime, stat.st_ctime)
@@ -0,0 +1,98 @@
+#
+# This file is part of ap_pipe.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import contextlib
+import io
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch, Mock
+
+import lsst.utils.tests
+import lsst.pex.exceptions as pexExcept
+import lsst.daf.persistence as dafPersist
+
+from lsst.ap.pipe import ApPipeTask
+
+
+class ApPipeParserTestSuite(lsst.utils.tests.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            cls.datadir = lsst.utils.getPackageDir("ap_pipe_testdata")
+        except pexExcept.NotFoundError:
+            raise unittest.SkipTest("ap_pipe_testdata not set up")
+        try:
+            lsst.utils.getPackageDir("obs_decam")
+        except LookupError:
+            raise unittest.SkipTest("obs_decam not set up; needed for ap_pipe_testdata")
+
+    def setUp(self):
+        self.output = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output, ignore_errors=True)
+        # Any attempt to construct a Butler fails; finding the mapper still works
+        self.butler = Mock(side_effect=RuntimeError("Butler constructed"),
+                           getMapperClass=dafPersist.Butler.getMapperClass)
+
+    def parse(self, *args):
+        """Parse an ap_pipe.py command line without constructing a Butler.
+
+        Parameters
+        ----------
+        *args : `str`
+            The arguments after the input repository.
+        """
+        parser = ApPipeTask._makeArgumentParser()
+        with patch.object(dafPersist, "Butler", self.butler), \
+                contextlib.redirect_stdout(io.StringIO()):
+            parser.parse_args(config=ApPipeTask.ConfigClass(),
+                              args=[self.datadir, "--output", self.output] + list(args))
+
+    def testShowConfig(self):
+        """Test that --show config exits without constructing a Butler.
+        """
+        with self.assertRaises(SystemExit) as cm:
+            self.parse("--show", "config")
+        self.assertEqual(cm.exception.code, 0)
+        self.butler.assert_not_called()
+
+    def testShowData(self):
+        """Test that --show data still constructs a Butler.
+        """
+        with self.assertRaisesRegex(RuntimeError, "Butler constructed"):
+            self.parse("--id", "visit=410915", "--show", "data")
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
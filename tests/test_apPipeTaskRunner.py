@@ -0,0 +1,222 @@
+#
+# This file is part of ap_pipe.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import argparse
+import os
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock, Mock
+
+import lsst.utils.tests
+import lsst.pipe.base as pipeBase
+
+from lsst.ap.pipe import ApPipeTask
+from lsst.ap.pipe.apPipeTaskRunner import ApPipeTaskRunner, _parseDataIdLine
+
+
+class PicklableButler:
+    """A stateless mock Butler whose dataRefs can be sent to worker
+    processes.
+    """
+
+    def dataRef(self, datasetType, dataId={}, **rest):
+        return pipeBase.Struct(dataId=dict(dataId, **rest), getButler=PicklableButler)
+
+
+class ApPipeTaskRunnerTestSuite(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.keyTypes = {"visit": int, "ccdnum": int, "filter": str}
+
+    def makeRunner(self, processes=1):
+        """Make a runner for ``--id-stream`` whose task and Butler are mocks.
+
+        Parameters
+        ----------
+        processes : `int`, optional
+            The value of ``-j``.
+
+        Returns
+        -------
+        runner : `lsst.ap.pipe.apPipeTaskRunner.ApPipeTaskRunner`
+            The runner. Its ``_runStreamTarget`` is a mock that succeeds.
+        parsedCmd : `argparse.Namespace`
+            The parsed command to pass to ``runner.runStream``. Its Butler
+            fails to look up ``visit=13``.
+        """
+        def subset(datasetType, dataId):
+            if dataId.get("visit") == 13:
+                raise RuntimeError("Butler lookup failed")
+            dataRef = Mock()
+            dataRef.dataId = dataId
+            return [dataRef]
+
+        butler = Mock()
+        butler.getKeys.return_value = self.keyTypes
+        butler.subset.side_effect = subset
+        parsedCmd = argparse.Namespace(config=Mock(), log=Mock(), doraise=False, clobberConfig=False,
+                                       noBackupConfig=False, processes=processes, timeout=None,
+                                       output="output", profileStages=False, profileId=None,
+                                       butler=butler, idStream="-", reuse=[],
+                                       templateId=argparse.Namespace(idList=[]))
+        runner = ApPipeTaskRunner(ApPipeTask, parsedCmd)
+        for name, value in [("precall", True), ("makeTask", Mock())]:
+            self._setupObjPatch(runner, name, return_value=value)
+        self._setupObjPatch(runner, "_runStreamTarget",
+                            side_effect=lambda task, dataRef, kwargs: pipeBase.Struct(exitStatus=0,
+                                                                                      dataRef=dataRef))
+        return runner, parsedCmd
+
+    def _setupObjPatch(self, *args, **kwargs):
+        patcher = patch.object(*args, **kwargs)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def testParseDataIdLine(self):
+        """Test parsing of JSON and key=value data IDs.
+        """
+        expected = {"visit": 410915, "ccdnum": 25}
+        self.assertEqual(_parseDataIdLine('{"visit": 410915, "ccdnum": 25}', self.keyTypes), expected)
+        self.assertEqual(_parseDataIdLine("visit=410915 ccdnum=25", self.keyTypes), expected)
+        self.assertEqual(_parseDataIdLine("visit=410915 ccdnum=25"), {"visit": "410915", "ccdnum": "25"})
+        self.assertEqual(_parseDataIdLine("visit=1 hdu=3", self.keyTypes), {"visit": 1, "hdu": "3"})
+
+        for line in ["visit", "=410915", '["visit", 410915]', "{visit: 410915}", "visit=abc",
+                     '{"visit": [410915]}', '{"visit": {"min": 1}}']:
+            with self.assertRaises(ValueError, msg=line):
+                _parseDataIdLine(line, self.keyTypes)
+
+    def testRunStream(self):
+        """Test that every valid line is processed, and that bad lines are
+        reported without stopping the stream.
+        """
+        runner, parsedCmd = self.makeRunner()
+        lines = ["visit=1 ccdnum=2\n", "\n", "# comment\n", "visit=x\n", '{"visit": [1]}\n',
+                 "visit=13\n", '{"visit": 3, "ccdnum": 4}\n']
+        results = runner.runStream(parsedCmd, stream=lines)
+
+        self.assertEqual([result.exitStatus for result in results], [0, 1, 1, 1, 0])
+        self.assertEqual([result.dataRef.dataId for result in results if result.dataRef is not None],
+                         [{"visit": 1, "ccdnum": 2}, {"visit": 3, "ccdnum": 4}])
+        runner.makeTask.assert_called_once()
+        self.assertEqual(runner._runStreamTarget.call_count, 2)
+        self.assertEqual(parsedCmd.log.warn.call_count, 3)
+
+    def testRunStreamProcesses(self):
+        """Test that -j is reported as ignored.
+        """
+        runner, parsedCmd = self.makeRunner(processes=4)
+        results = runner.runStream(parsedCmd, stream=["visit=1 ccdnum=2"])
+        self.assertEqual([result.exitStatus for result in results], [0])
+        parsedCmd.log.warn.assert_called_once()
+
+    def testExecutionPlanTemplates(self):
+        """Test that templates are counted, and priced, separately from
+        science images.
+        """
+        runner, parsedCmd = self.makeRunner()
+        parsedCmd.config.doPrepareTemplates = False
+        parsedCmd.config.differencer.coaddName = "deep"
+
+        def makeMockDataRef(datasetType, dataId={}, **rest):
+            dataRef = Mock()
+            dataRef.dataId = dict(dataId, **rest)
+            dataRef.getButler.return_value = butler
+            return dataRef
+
+        butler = Mock()
+        butler.dataRef.side_effect = makeMockDataRef
+        parsedCmd.id = argparse.Namespace(refList=[makeMockDataRef("raw", visit=1, ccdnum=2)])
+        parsedCmd.templateId = argparse.Namespace(idList=[{"visit": 3}, {"visit": 4}])
+
+        timings = {"ccdProcessor": 100.0, "templateCcdProcessor": 40.0, "differencer": 60.0, "diaPipe": 20.0}
+        plan = runner.makeExecutionPlan(parsedCmd, timings=timings)
+        self.assertEqual(plan["stageCounts"], {"ccdProcessor": 1, "templateCcdProcessor": 2,
+                                               "differencer": 1, "diaPipe": 1})
+        self.assertEqual(plan["targets"][0]["templates"],
+                         [{"visit": 3, "ccdnum": 2}, {"visit": 4, "ccdnum": 2}])
+        self.assertAlmostEqual(plan["estimatedCpuHours"], (100.0 + 2*40.0 + 60.0 + 20.0) / 3600.0)
+
+        del timings["templateCcdProcessor"]
+        plan = runner.makeExecutionPlan(parsedCmd, timings=timings)
+        self.assertAlmostEqual(plan["estimatedCpuHours"], (100.0 + 2*100.0 + 60.0 + 20.0) / 3600.0)
+
+    def _checkPrepareTemplates(self, processes):
+        """Check that precall processes every template exactly once, and that
+        targets are then run without templates.
+        """
+        runner, parsedCmd = self.makeRunner(processes=processes)
+        parsedCmd.config.doPrepareTemplates = True
+        parsedCmd.config.doBatchReuseChecks = False
+
+        butler = PicklableButler()
+        parsedCmd.id = argparse.Namespace(refList=[butler.dataRef("raw", visit=visit, ccdnum=ccdnum)
+                                                   for visit, ccdnum in [(1, 5), (2, 5), (1, 6)]])
+        parsedCmd.templateId = argparse.Namespace(idList=[{"visit": 10}, {"visit": 11}])
+
+        # Templates may be processed in forked workers, which report through a file
+        fd, log = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, log)
+
+        def runProcessCcd(sensorRef):
+            with open(log, "a") as f:
+                f.write("{visit} {ccdnum}\n".format(**sensorRef.dataId))
+
+        task = MagicMock()
+        task.runProcessCcd.side_effect = runProcessCcd
+        runner.makeTask.return_value = task
+        with patch.object(pipeBase.ButlerInitializedTaskRunner, "precall", return_value=True):
+            self.assertTrue(ApPipeTaskRunner.precall(runner, parsedCmd))
+
+        with open(log) as f:
+            processed = sorted(tuple(int(value) for value in line.split()) for line in f)
+        self.assertEqual(processed, [(10, 5), (10, 6), (11, 5), (11, 6)])
+        if processes == 1:
+            runner.makeTask.assert_called_once()
+        for _, kwargs in runner.getTargetList(parsedCmd):
+            self.assertTrue(kwargs["templatesPrepared"])
+
+    def testPrepareTemplates(self):
+        """Test that templates shared by several targets are processed once.
+        """
+        self._checkPrepareTemplates(processes=1)
+
+    def testPrepareTemplatesProcesses(self):
+        """Test that templates shared by several targets are processed once
+        when processed in parallel.
+        """
+        self._checkPrepareTemplates(processes=2)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
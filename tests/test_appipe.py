@@ -23,6 +23,8 @@
 
 import contextlib
 import os
+import shutil
+import tempfile
 import unittest
 from unittest.mock import patch, Mock, ANY
 
@@ -32,6 +34,8 @@ import lsst.daf.persistence as dafPersist
 import lsst.pipe.base as pipeBase
 
 from lsst.ap.pipe import ApPipeTask
+from lsst.ap.pipe.profiling import StageProfiler, readProfiles
+from lsst.ap.pipe.reusePlan import ReusePlan, getDataIdKey
 
 
 class PipelineTestSuite(lsst.utils.tests.TestCase):
@@ -185,6 +189,178 @@ class PipelineTestSuite(lsst.utils.tests.TestCase):
             subtasks.differencer.runDataRef.assert_called_once()
             subtasks.diaPipe.run.assert_called_once()
 
+    def _runInMemory(self, reuse):
+        """Run the pipeline with ``doPassResultsInMemory`` on mock subtasks.
+
+        Returns
+        -------
+        diaPipeInputs : `dict`
+            The inputs passed to ``diaPipe.run``.
+        calexpRef : `unittest.mock.Mock`
+            The dataRef from which association inputs are read. Its ``get``
+            returns ``"read <datasetType>"``.
+        """
+        self.config.doPassResultsInMemory = True
+        task = ApPipeTask(self.butler, config=self.config)
+        calexpRef = self.inputRef.getButler().dataRef()
+        calexpRef.get.reset_mock()
+        calexpRef.get.side_effect = lambda datasetType: "read " + datasetType
+        with self.mockPatchSubtasks(task) as subtasks:
+            subtasks.ccdProcessor.runDataRef.return_value = pipeBase.Struct(exposure="calexp in memory")
+            subtasks.differencer.runDataRef.return_value = pipeBase.Struct(
+                diaSources="diaSrc in memory",
+                subtractedExposure="diffIm in memory",
+                warpedExposure="warpedExp in memory",
+            )
+            task.runDataRef(self.inputRef, reuse=reuse)
+            return subtasks.diaPipe.run.call_args.kwargs, calexpRef
+
+    def testPassResultsInMemory(self):
+        """Test that association uses the calexp and difference imaging
+        products in memory instead of reading them.
+        """
+        diaPipeInputs, calexpRef = self._runInMemory(reuse=[])
+        self.assertEqual(diaPipeInputs["exposure"], "calexp in memory")
+        self.assertEqual(diaPipeInputs["diaSourceCat"], "diaSrc in memory")
+        self.assertEqual(diaPipeInputs["diffIm"], "diffIm in memory")
+        self.assertEqual(diaPipeInputs["warpedExposure"], "warpedExp in memory")
+        calexpRef.get.assert_called_once_with("ccdExposureId_bits")
+
+    def testPassResultsInMemoryReuse(self):
+        """Test that association reads the calexp if ccdProcessor was skipped.
+        """
+        diaPipeInputs, calexpRef = self._runInMemory(reuse=["ccdProcessor"])
+        self.assertEqual(diaPipeInputs["exposure"], "read calexp")
+        self.assertEqual(diaPipeInputs["diaSourceCat"], "diaSrc in memory")
+        self.assertEqual(sorted(call.args[0] for call in calexpRef.get.call_args_list),
+                         ["calexp", "ccdExposureId_bits"])
+
+    def testRunAssociationPrefetch(self):
+        """Test that association gets the same inputs whether they are read
+        serially or concurrently.
+        """
+        diaPipeInputs = {}
+        for numThreads in [1, 3]:
+            self.config.numAssociationIoThreads = numThreads
+            task = ApPipeTask(self.butler, config=self.config)
+            sensorRef = Mock(dafPersist.ButlerDataRef)
+            sensorRef.get.side_effect = lambda datasetType: "read " + datasetType
+            with self.mockPatchSubtasks(task) as subtasks:
+                prefetched = task.prefetchAssociationInputs(sensorRef, ["exposure"])
+                self.assertEqual(len(prefetched), 0 if numThreads == 1 else 1)
+                task.runAssociation(sensorRef, inputs={"diffIm": "in memory"}, prefetched=prefetched)
+                diaPipeInputs[numThreads] = subtasks.diaPipe.run.call_args.kwargs
+            # Inputs in memory are never read, and prefetched ones only once
+            self.assertEqual(sensorRef.get.call_count, 4)
+
+        self.assertEqual(diaPipeInputs[1], diaPipeInputs[3])
+        self.assertEqual(diaPipeInputs[1]["diffIm"], "in memory")
+        self.assertEqual(diaPipeInputs[1]["exposure"], "read calexp")
+        self.assertEqual(diaPipeInputs[1]["ccdExposureIdBits"], "read ccdExposureId_bits")
+
+    def testRunAssociationPrefetchError(self):
+        """Test that a failed read stops association, whether inputs are read
+        serially or concurrently.
+        """
+        def get(datasetType):
+            if datasetType == "calexp":
+                raise RuntimeError("Cannot read calexp")
+            return "read " + datasetType
+
+        for numThreads in [1, 3]:
+            self.config.numAssociationIoThreads = numThreads
+            task = ApPipeTask(self.butler, config=self.config)
+            sensorRef = Mock(dafPersist.ButlerDataRef)
+            sensorRef.get.side_effect = get
+            with self.mockPatchSubtasks(task) as subtasks:
+                prefetched = task.prefetchAssociationInputs(sensorRef, ["exposure"])
+                with self.assertRaisesRegex(RuntimeError, "Cannot read calexp"):
+                    task.runAssociation(sensorRef, prefetched=prefetched)
+                subtasks.diaPipe.run.assert_not_called()
+            sensorRef.put.assert_not_called()
+
+    def _checkRunProcessCcdBatch(self, forked):
+        """Check which process ran each image of runProcessCcdBatch, and that
+        the metadata and profile of every image are kept.
+        """
+        self.config.numProcessCcdProcesses = 2
+        task = ApPipeTask(self.butler, config=self.config)
+        parentPid = os.getpid()
+        profileDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, profileDir, ignore_errors=True)
+        task.profilers = [StageProfiler(profileDir)]
+
+        def runProcessCcd(sensorRef):
+            task.ccdProcessor.metadata.add("visit", sensorRef.dataId["visit"])
+            task.ccdProcessor.metadata.add("forked", os.getpid() != parentPid)
+            return pipeBase.Struct(visit=sensorRef.dataId["visit"])
+
+        # Forked workers are sent their dataRefs, so these must be picklable
+        templateRefs = [pipeBase.Struct(dataId={"visit": visit}) for visit in [1, 2, 3]]
+        scienceRef = pipeBase.Struct(dataId={"visit": 4})
+        with patch.object(task, "runProcessCcd", side_effect=runProcessCcd):
+            result = task.runProcessCcdBatch(templateRefs, scienceRef=scienceRef)
+        self.assertEqual(result.visit, 4)
+
+        metadata = task.ccdProcessor.metadata
+        images = dict(zip(metadata.getArray("visit"), metadata.getArray("forked")))
+        self.assertEqual(images, {1: forked, 2: forked, 3: forked, 4: False})
+
+        # Each image is a stage of its own, wherever it ran
+        stages = {record["dataId"]["visit"]: record["stage"] for record in readProfiles([profileDir])}
+        self.assertEqual(stages, {1: "templateCcdProcessor", 2: "templateCcdProcessor",
+                                  3: "templateCcdProcessor", 4: "ccdProcessor"})
+
+    def testRunProcessCcdBatch(self):
+        """Test that templates are processed in forked processes, and the
+        science image in this one.
+        """
+        self._checkRunProcessCcdBatch(forked=True)
+
+    def testRunProcessCcdBatchDaemon(self):
+        """Test that a daemonic process processes all images itself.
+        """
+        with patch("multiprocessing.current_process", return_value=Mock(daemon=True)):
+            self._checkRunProcessCcdBatch(forked=False)
+
+    def testReusePlanTemplates(self):
+        """Test that templates missing from a reuse plan are looked up again,
+        and that processed templates are recorded in the plan.
+        """
+        calexpConfigFile = os.path.join(lsst.utils.getPackageDir('ap_pipe'),
+                                        'config', 'calexpTemplates.py')
+        calexpConfig = self._makeDefaultConfig()
+        calexpConfig.load(calexpConfigFile)
+        calexpConfig.differencer.doSelectSources = False  # Workaround for DM-18394
+
+        # Plans are keyed by data ID, so derived dataRefs need real ones
+        def makeMockDataRef(datasetType, level=None, dataId={}, **rest):
+            mockDataRef = Mock(dafPersist.ButlerDataRef)
+            mockDataRef.dataId = dict(dataId, **rest)
+            mockDataRef.getButler.return_value = self.butler
+            return mockDataRef
+
+        self._setupObjPatch(self.butler, "dataRef", side_effect=makeMockDataRef)
+        inputRef = self.butler.dataRef("raw", **self.dataId)
+
+        task = ApPipeTask(self.butler, config=calexpConfig)
+        templateId = {"visit": 413636}
+        templateDataId = dict(self.dataId, **templateId)
+        with self.mockPatchSubtasks(task) as subtasks:
+            # Mock dataRefs report that the template has been made since planning
+            reusePlan = ReusePlan({("calexp", getDataIdKey(self.dataId)): False,
+                                   ("calexp", getDataIdKey(templateDataId)): False})
+            task.runDataRef(inputRef, templateIds=[templateId], reuse=["ccdProcessor"], reusePlan=reusePlan)
+            subtasks.ccdProcessor.runDataRef.assert_called_once()
+            self.assertTrue(reusePlan.exists("calexp", templateDataId))
+
+        with self.mockPatchSubtasks(task) as subtasks:
+            reusePlan = ReusePlan()
+            task.runDataRef(inputRef, templateIds=[templateId], reusePlan=reusePlan)
+            self.assertEqual(subtasks.ccdProcessor.runDataRef.call_count, 2)
+            self.assertTrue(reusePlan.exists("calexp", templateDataId))
+            self.assertIsNone(reusePlan.exists("calexp", self.dataId))
+
 
 class MemoryTester(lsst.utils.tests.MemoryTestCase):
     pass
@@ -0,0 +1,143 @@
+#
+# This file is part of ap_pipe.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import threading
+import unittest
+
+import lsst.utils.tests
+
+from lsst.ap.pipe.backgroundWriter import BackgroundWriter, AsyncPutDataRef
+
+
+class DictDataRef:
+    """A minimal data reference that stores datasets in a `dict`.
+
+    Writes block until ``released`` is set, and fail for dataset types in
+    ``failures``.
+    """
+
+    def __init__(self, failures=()):
+        self.dataId = {"visit": 42, "ccd": 1}
+        self.datasetType = "raw"
+        self.datasets = {}
+        self.order = []
+        self.failures = set(failures)
+        self.released = threading.Event()
+
+    def put(self, obj, datasetType=None):
+        self.released.wait()
+        if datasetType in self.failures:
+            raise IOError("Cannot write %s" % datasetType)
+        self.datasets[datasetType] = obj
+        self.order.append(datasetType)
+
+    def get(self, datasetType=None):
+        return self.datasets[datasetType]
+
+    def datasetExists(self, datasetType=None, write=False):
+        return datasetType in self.datasets
+
+
+class BackgroundWriterTestSuite(lsst.utils.tests.TestCase):
+
+    def testOrder(self):
+        """Test that datasets are written in order, in the background.
+        """
+        dataRef = DictDataRef()
+        asyncRef = AsyncPutDataRef(dataRef, BackgroundWriter(maxSize=10))
+        for datasetType in ["calexp", "deepDiff_diaSrc", "apdb_marker"]:
+            asyncRef.put(datasetType.upper(), datasetType)
+        self.assertEqual(dataRef.order, [])
+        self.assertEqual(asyncRef.dataId, dataRef.dataId)
+
+        dataRef.released.set()
+        self.assertEqual(asyncRef.get("deepDiff_diaSrc"), "DEEPDIFF_DIASRC")
+        asyncRef._writer.flush()
+        self.assertEqual(dataRef.order, ["calexp", "deepDiff_diaSrc", "apdb_marker"])
+        self.assertTrue(asyncRef.datasetExists("apdb_marker"))
+
+    def testDatasetTypes(self):
+        """Test that only the selected dataset types are written in the
+        background.
+        """
+        dataRef = DictDataRef()
+        asyncRef = AsyncPutDataRef(dataRef, BackgroundWriter(maxSize=10), ["calexp"])
+        asyncRef.put("CALEXP", "calexp")
+        self.assertEqual(dataRef.order, [])
+
+        dataRef.released.set()
+        asyncRef.put("ICEXP", "icExp")
+        self.assertEqual(dataRef.datasets["icExp"], "ICEXP")
+        asyncRef._writer.flush()
+        self.assertEqual(set(dataRef.order), {"calexp", "icExp"})
+
+    def testStop(self):
+        """Test that stopping the writer writes all queued datasets, and that
+        it is restarted by the next write.
+        """
+        dataRef = DictDataRef()
+        writer = BackgroundWriter(maxSize=10)
+        writer.put(dataRef, "CALEXP", "calexp")
+        thread = writer._thread
+        dataRef.released.set()
+        writer.stop()
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(dataRef.order, ["calexp"])
+
+        writer.put(dataRef, "MARKER", "apdb_marker")
+        writer.flush()
+        self.assertTrue(writer._thread.is_alive())
+        self.assertEqual(dataRef.order, ["calexp", "apdb_marker"])
+        writer.stop()
+
+    def testFailure(self):
+        """Test that a failed write is reported, and that later writes are
+        abandoned.
+        """
+        dataRef = DictDataRef(failures=["deepDiff_diaSrc"])
+        dataRef.released.set()
+        writer = BackgroundWriter(maxSize=1)
+        for datasetType in ["calexp", "deepDiff_diaSrc"]:
+            writer.put(dataRef, datasetType.upper(), datasetType)
+        with self.assertRaises(RuntimeError):
+            writer.put(dataRef, "MARKER", "apdb_marker")
+            writer.flush()
+        self.assertEqual(dataRef.order, ["calexp"])
+
+        # The failure is only reported once
+        writer.put(dataRef, "MARKER", "apdb_marker")
+        writer.flush()
+        self.assertEqual(dataRef.order, ["calexp", "apdb_marker"])
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,140 @@
+# This file is part of ap_pipe.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import numpy as np
+import pandas as pd
+import unittest
+
+from lsst.pipe.base import testUtils
+import lsst.utils.tests
+
+from lsst.ap.pipe.completeness import (ApFakesCompletenessHistogramTask,
+                                       ApFakesCompletenessHistogramConfig,
+                                       MergeApFakesCompletenessHistogramsTask,
+                                       MergeApFakesRunCompletenessHistogramsTask,
+                                       computeCompletenessHistogram,
+                                       mergeCompletenessHistograms)
+
+
+class TestApFakesCompletenessHistogram(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        """Create matched fakes catalogs of several detectors.
+        """
+        self.config = ApFakesCompletenessHistogramConfig()
+        self.config.magMin = 20
+        self.config.magMax = 25
+        self.config.magBinWidth = 1
+        self.task = ApFakesCompletenessHistogramTask(config=self.config)
+
+        self.band = "g"
+        self.magCut = 23
+        rng = np.random.default_rng(1234)
+        self.matchedFakes = []
+        for detector in range(4):
+            mags = rng.uniform(19, 26, size=100)
+            ids = np.where(mags < self.magCut, np.arange(1, len(mags) + 1, dtype=int), 0)
+            self.matchedFakes.append(pd.DataFrame({self.config.magVar % self.band: mags,
+                                                   "diaSourceId": ids}))
+
+    def testComputeCompletenessHistogram(self):
+        """Test counting fakes in magnitude bins.
+        """
+        mags = np.array([19.5, 20.0, 20.5, 21.2, 21.9, 24.9, 25.0])
+        isFound = np.array([True, True, False, True, True, False, True])
+        nPossible, nFound = computeCompletenessHistogram(mags, isFound, np.arange(20, 26))
+        np.testing.assert_array_equal(nPossible, [2, 2, 0, 0, 2])
+        np.testing.assert_array_equal(nFound, [1, 2, 0, 0, 1])
+
+    def testComputeWeightedCompletenessHistogram(self):
+        """Test summing the weights of fakes in magnitude bins.
+        """
+        mags = np.array([20.5, 20.5, 21.5])
+        isFound = np.array([True, False, True])
+        weights = np.array([0.5, 2.0, 1.5])
+        nPossible, nFound = computeCompletenessHistogram(mags, isFound, np.arange(20, 23), weights)
+        np.testing.assert_allclose(nPossible, [2.5, 1.5])
+        np.testing.assert_allclose(nFound, [0.5, 1.5])
+
+    def testRun(self):
+        """Test the histogram of a single detector.
+        """
+        result = self.task.run(self.matchedFakes[0], self.band)
+        testUtils.assertValidOutput(self.task, result)
+
+        histogram = result.completenessHistogram
+        np.testing.assert_array_equal(histogram["magMin"], [20, 21, 22, 23, 24])
+        np.testing.assert_array_equal(histogram["magMax"], [21, 22, 23, 24, 25])
+        self.assertTrue((histogram["band"] == self.band).all())
+
+        mags = self.matchedFakes[0][self.config.magVar % self.band]
+        inRange = (mags >= 20) & (mags <= 25)
+        self.assertEqual(histogram["nPossible"].sum(), inRange.sum())
+        self.assertEqual(histogram["nFound"].sum(), (inRange & (mags < self.magCut)).sum())
+        np.testing.assert_array_equal(histogram["nFound"][histogram["magMin"] >= self.magCut], 0)
+
+    def testMerge(self):
+        """Test that merging in stages gives the same counts as merging all
+        detectors at once.
+        """
+        histograms = [self.task.run(matchedFakes, self.band).completenessHistogram
+                      for matchedFakes in self.matchedFakes]
+        visitTask = MergeApFakesCompletenessHistogramsTask()
+        visits = [visitTask.run(histograms[:2]).completenessHistogram,
+                  visitTask.run(histograms[2:]).completenessHistogram]
+        runTask = MergeApFakesRunCompletenessHistogramsTask()
+        result = runTask.run(visits)
+        testUtils.assertValidOutput(runTask, result)
+
+        allFakes = pd.concat(self.matchedFakes, ignore_index=True)
+        expected = self.task.run(allFakes, self.band).completenessHistogram
+        pd.testing.assert_frame_equal(result.completenessHistogram, expected)
+
+    def testMergeBands(self):
+        """Test that histograms of different bands are kept separate.
+        """
+        gHistogram = self.task.run(self.matchedFakes[0], "g").completenessHistogram
+        rFakes = self.matchedFakes[1].rename(columns={self.config.magVar % "g": self.config.magVar % "r"})
+        rHistogram = self.task.run(rFakes, "r").completenessHistogram
+        merged = mergeCompletenessHistograms([rHistogram, gHistogram])
+        self.assertEqual(len(merged), 10)
+        pd.testing.assert_frame_equal(merged[merged["band"] == "g"].reset_index(drop=True), gHistogram)
+
+    def testMergeEmpty(self):
+        """Test merging no histograms.
+        """
+        merged = mergeCompletenessHistograms([])
+        self.assertEqual(len(merged), 0)
+        self.assertEqual(list(merged.columns), ["band", "magMin", "magMax", "nPossible", "nFound"])
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
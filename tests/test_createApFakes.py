@@ -22,6 +22,8 @@
 #
 
 import numpy as np
+import os
+import pandas as pd
 import shutil
 import tempfile
 import unittest
@@ -30,6 +32,7 @@ import lsst.daf.butler.tests as butlerTests
 import lsst.geom as geom
 from lsst.pipe.base import testUtils
 import lsst.skymap as skyMap
+import lsst.sphgeom as sphgeom
 import lsst.utils.tests
 
 from lsst.ap.pipe.createApFakes import CreateRandomApFakesTask, CreateRandomApFakesConfig
@@ -122,6 +125,181 @@ class TestCreateApFakes(lsst.utils.tests.TestCase):
             self.assertTrue(
                 np.all(fakesConfig.magMax > filterMags))
 
+    def testRunPolygon(self):
+        """Test that fakes sampled over the tract polygon are all within it
+        and match the requested density.
+        """
+        fakesConfig = CreateRandomApFakesConfig()
+        fakesConfig.fakeDensity = 100 * self.sourceDensity
+        fakesConfig.doSampleTractPolygon = True
+        fakesTask = CreateRandomApFakesTask(config=fakesConfig)
+        polygon = self.simpleMap.generateTract(self.tractId).getInnerSkyPolygon()
+        fakeCat = fakesTask.run(self.tractId, self.simpleMap).fakeCat
+        self.assertEqual(
+            len(fakeCat),
+            int(fakesConfig.fakeDensity * fakesTask._getPolygonArea(polygon) * (180 / np.pi) ** 2))
+        for idx, row in fakeCat.iterrows():
+            self.assertTrue(
+                polygon.contains(
+                    geom.SpherePoint(row[fakesConfig.raColName],
+                                     row[fakesConfig.decColName],
+                                     geom.radians).getVector()))
+
+    def testPolygonArea(self):
+        """Test the area of a polygon covering one octant of the sphere.
+        """
+        fakesTask = CreateRandomApFakesTask()
+        polygon = sphgeom.ConvexPolygon([sphgeom.UnitVector3d.X(),
+                                         sphgeom.UnitVector3d.Y(),
+                                         sphgeom.UnitVector3d.Z()])
+        self.assertAlmostEqual(fakesTask._getPolygonArea(polygon), np.pi / 2)
+
+    def testRunCompact(self):
+        """Test that the compact catalog holds the same values in smaller
+        types.
+        """
+        fakesConfig = CreateRandomApFakesConfig()
+        fakesConfig.fakeDensity = self.sourceDensity
+        fakesTask = CreateRandomApFakesTask(config=fakesConfig)
+        fakeCat = fakesTask.run(self.tractId, self.simpleMap).fakeCat
+
+        fakesConfig.doCompactCatalog = True
+        compactTask = CreateRandomApFakesTask(config=fakesConfig)
+        compactCat = compactTask.run(self.tractId, self.simpleMap).fakeCat
+
+        self.assertEqual(compactCat[fakesConfig.sourceType].dtype, "category")
+        self.assertTrue(np.all(compactCat[fakesConfig.sourceType] == "star"))
+        self.assertEqual(compactCat[fakesConfig.diskHLR].dtype, np.float32)
+        for col in [fakesConfig.raColName, fakesConfig.decColName, "fakeId"]:
+            np.testing.assert_array_equal(compactCat[col], fakeCat[col])
+        for f in fakesConfig.filterSet:
+            magCol = fakesConfig.magVar % f
+            self.assertEqual(compactCat[magCol].dtype, np.float32)
+            np.testing.assert_allclose(compactCat[magCol], fakeCat[magCol], rtol=1e-6)
+
+    def testIterFakeCatChunks(self):
+        """Test that the streamed chunks concatenate to the catalog returned
+        by run, whatever the chunk size.
+        """
+        fakesConfig = CreateRandomApFakesConfig()
+        fakesConfig.fakeDensity = 100 * self.sourceDensity
+        fakesConfig.fraction = 0.5
+        fakesTask = CreateRandomApFakesTask(config=fakesConfig)
+        # Split the catalog into several random blocks, not aligned with the
+        # chunks.
+        fakesTask._randomBlockSize = 250
+        fakeCat = fakesTask.run(self.tractId, self.simpleMap).fakeCat
+        self.assertEqual(len(fakeCat), 100 * self.nSources)
+
+        chunks = list(fakesTask.iterFakeCatChunks(self.tractId, self.simpleMap))
+        self.assertEqual(len(chunks), 1)
+        pd.testing.assert_frame_equal(chunks[0], fakeCat)
+
+        fakesConfig.chunkSize = 300
+        chunkedTask = CreateRandomApFakesTask(config=fakesConfig)
+        chunkedTask._randomBlockSize = 250
+        pd.testing.assert_frame_equal(chunkedTask.run(self.tractId, self.simpleMap).fakeCat, fakeCat)
+        chunks = list(chunkedTask.iterFakeCatChunks(self.tractId, self.simpleMap))
+        self.assertEqual(len(chunks), int(np.ceil(100 * self.nSources / 300)))
+        self.assertTrue(all(len(chunk) <= 300 for chunk in chunks))
+        pd.testing.assert_frame_equal(pd.concat(chunks), fakeCat)
+        self.assertTrue(fakeCat["fakeId"].is_unique)
+        self.assertEqual(fakeCat[fakesConfig.visitSourceFlagCol].sum(),
+                         fakesTask.createVisitCoaddSubdivision(len(fakeCat))[
+                             fakesConfig.visitSourceFlagCol].sum())
+
+    def testRunReproducible(self):
+        """Test that the same seed produces the same catalog, ids included.
+        """
+        fakesConfig = CreateRandomApFakesConfig()
+        fakesConfig.fakeDensity = self.sourceDensity
+        fakesTask = CreateRandomApFakesTask(config=fakesConfig)
+        fakeCat = fakesTask.run(self.tractId, self.simpleMap).fakeCat
+        otherFakeCat = fakesTask.run(self.tractId, self.simpleMap).fakeCat
+        pd.testing.assert_frame_equal(fakeCat, otherFakeCat)
+
+    def testRunSingleStream(self):
+        """Test that a catalog that fits in one random block is drawn from a
+        single stream seeded by randomSeed.
+        """
+        fakesConfig = CreateRandomApFakesConfig()
+        fakesConfig.fakeDensity = 100 * self.sourceDensity
+        fakesConfig.doSeedByTract = False
+        fakesTask = CreateRandomApFakesTask(config=fakesConfig)
+        fakeCat = fakesTask.run(self.tractId, self.simpleMap).fakeCat
+
+        rng = np.random.default_rng(fakesConfig.randomSeed)
+        bCircle = self.simpleMap.generateTract(self.tractId).getInnerSkyPolygon().getBoundingCircle()
+        positions = fakesTask.createRandomPositions(len(fakeCat), bCircle, rng)
+        mags = fakesTask.createRandomMagnitudes(len(fakeCat), rng)
+        for column, values in {**positions, **mags}.items():
+            np.testing.assert_array_equal(fakeCat[column], values)
+
+    def testRunTracts(self):
+        """Test that tracts seeded by id are independent, and do not depend
+        on the number of processes.
+        """
+        twoTractConfig = skyMap.discreteSkyMap.DiscreteSkyMapConfig()
+        twoTractConfig.raList = [10, 10]
+        twoTractConfig.decList = [-1, -1]
+        twoTractConfig.radiusList = [0.1, 0.1]
+        twoTractMap = skyMap.DiscreteSkyMap(twoTractConfig)
+
+        fakesConfig = CreateRandomApFakesConfig()
+        fakesConfig.fakeDensity = 100 * self.sourceDensity
+        fakesConfig.chunkSize = 300
+        fakesTask = CreateRandomApFakesTask(config=fakesConfig)
+        serial = fakesTask.runTracts([0, 1], twoTractMap)
+        parallel = fakesTask.runTracts([0, 1], twoTractMap, numProcesses=2)
+
+        self.assertEqual(set(parallel), {0, 1})
+        for tractId in [0, 1]:
+            pd.testing.assert_frame_equal(parallel[tractId].fakeCat, serial[tractId].fakeCat)
+            pd.testing.assert_frame_equal(serial[tractId].fakeCat,
+                                          fakesTask.run(tractId, twoTractMap).fakeCat)
+        # The tracts cover the same area, so only the seed differs.
+        self.assertFalse(np.array_equal(serial[0].fakeCat["fakeId"], serial[1].fakeCat["fakeId"]))
+
+        root = tempfile.mkdtemp()
+        try:
+            written = fakesTask.runTracts([0, 1], twoTractMap, numProcesses=2, outputDir=root)
+            for tractId in [0, 1]:
+                self.assertEqual(written[tractId].paths[0],
+                                 os.path.join(root, f"tract-{tractId}", "part-00000.parquet"))
+                pd.testing.assert_frame_equal(pd.read_parquet(os.path.join(root, f"tract-{tractId}")),
+                                              serial[tractId].fakeCat)
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+    def testWriteFakeCatParquet(self):
+        """Test that the partitioned Parquet catalog reads back as the
+        catalog returned by run.
+        """
+        fakesConfig = CreateRandomApFakesConfig()
+        fakesConfig.fakeDensity = 100 * self.sourceDensity
+        fakesConfig.chunkSize = 300
+        fakesTask = CreateRandomApFakesTask(config=fakesConfig)
+        fakeCat = fakesTask.run(self.tractId, self.simpleMap).fakeCat
+
+        root = tempfile.mkdtemp()
+        try:
+            paths = fakesTask.writeFakeCatParquet(self.tractId, self.simpleMap, root)
+            self.assertEqual(len(paths), int(np.ceil(100 * self.nSources / 300)))
+            pd.testing.assert_frame_equal(pd.read_parquet(root), fakeCat)
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+    def testCreateFakeIds(self):
+        """Test that ids are unique, and depend only on the seed and the
+        position of each fake.
+        """
+        fakesTask = CreateRandomApFakesTask()
+        ids = fakesTask.createFakeIds(0, 1000, 1234)
+        self.assertEqual(ids.dtype, np.uint64)
+        self.assertEqual(len(np.unique(ids)), 1000)
+        np.testing.assert_array_equal(ids[500:], fakesTask.createFakeIds(500, 500, 1234))
+        self.assertFalse(np.any(np.isin(ids, fakesTask.createFakeIds(0, 1000, 4321))))
+
     def testCreateRandomPositions(self):
         """Test that the correct number of sources are produced and are
         contained in the cap bound.
@@ -190,6 +368,98 @@ class TestCreateApFakes(lsst.utils.tests.TestCase):
             self.assertTrue(
                 np.all(fakesConfig.magMax > filterMags))
 
+    def testStratifiedMagnitudes(self):
+        """Test that stratified magnitudes fill each bin equally and are
+        shuffled.
+        """
+        fakesConfig = CreateRandomApFakesConfig()
+        fakesConfig.magSampling = "stratified"
+        fakesConfig.magSamplingBins = 10
+        fakesTask = CreateRandomApFakesTask(config=fakesConfig)
+        nFakes = 1003
+        mags = fakesTask.createRandomMagnitudes(nFakes, self.rng)
+        self.assertEqual(len(fakesConfig.filterSet) + 1, len(mags))
+        filterMags = mags[fakesConfig.magVar % fakesConfig.filterSet[0]]
+        weights = mags[fakesConfig.weightColName]
+
+        counts, _ = np.histogram(filterMags, bins=np.linspace(fakesConfig.magMin, fakesConfig.magMax, 11))
+        self.assertTrue(np.all(counts >= nFakes // 10))
+        self.assertTrue(np.all(counts <= nFakes // 10 + 1))
+        self.assertAlmostEqual(weights.sum(), nFakes)
+        self.assertFalse(np.all(np.diff(filterMags) >= 0))
+
+    def testImportanceMagnitudes(self):
+        """Test that importance sampled magnitudes are concentrated around
+        importanceMag, and that their weights recover a uniform distribution.
+        """
+        fakesConfig = CreateRandomApFakesConfig()
+        fakesConfig.magSampling = "importance"
+        fakesConfig.importanceMag = 24
+        fakesConfig.importanceWidth = 0.5
+        fakesTask = CreateRandomApFakesTask(config=fakesConfig)
+        nFakes = 100000
+        mags = fakesTask.createRandomMagnitudes(nFakes, self.rng)
+        filterMags = mags[fakesConfig.magVar % fakesConfig.filterSet[0]]
+        weights = mags[fakesConfig.weightColName]
+
+        self.assertTrue(np.all(fakesConfig.magMin <= filterMags))
+        self.assertTrue(np.all(fakesConfig.magMax >= filterMags))
+        nearCenter = np.abs(filterMags - fakesConfig.importanceMag) < 1
+        self.assertGreater(nearCenter.mean(), 0.5)
+        self.assertLess(weights.max(), 1 / fakesConfig.importanceUniformFraction + 1e-6)
+        # Weighted counts in each magnitude should match uniform sampling.
+        weightedCounts, _ = np.histogram(filterMags, bins=10,
+                                         range=(fakesConfig.magMin, fakesConfig.magMax),
+                                         weights=weights)
+        np.testing.assert_allclose(weightedCounts, nFakes / 10, rtol=0.1)
+
+    def testImportanceMagValidation(self):
+        """Test that importanceMag must be within the sampled magnitudes,
+        and that the weights stay finite at its limits.
+        """
+        fakesConfig = CreateRandomApFakesConfig()
+        fakesConfig.magSampling = "importance"
+        fakesConfig.importanceMag = 60
+        with self.assertRaises(ValueError):
+            fakesConfig.validate()
+        # Only checked when used
+        fakesConfig.magSampling = "uniform"
+        fakesConfig.validate()
+
+        fakesConfig.magSampling = "importance"
+        fakesConfig.importanceWidth = 0.01
+        for importanceMag in [fakesConfig.magMin, fakesConfig.magMax]:
+            fakesConfig.importanceMag = importanceMag
+            fakesConfig.validate()
+            fakesTask = CreateRandomApFakesTask(config=fakesConfig)
+            weights = fakesTask.createRandomMagnitudes(1000, self.rng)[fakesConfig.weightColName]
+            self.assertTrue(np.all(np.isfinite(weights)))
+
+    def testSpatialIndex(self):
+        """Test that the zone index covers every row of the sorted catalog
+        and that rows are sorted by RA within each zone.
+        """
+        fakesConfig = CreateRandomApFakesConfig()
+        fakesConfig.fakeDensity = 1000 * self.sourceDensity
+        fakesConfig.doWriteSpatialIndex = True
+        fakesConfig.spatialIndexZoneHeight = 0.01
+        fakesTask = CreateRandomApFakesTask(config=fakesConfig)
+        result = fakesTask.run(self.tractId, self.simpleMap)
+        fakeCat = result.fakeCat
+        fakeCatIndex = result.fakeCatIndex
+
+        self.assertEqual(fakeCatIndex["begin"].iloc[0], 0)
+        self.assertEqual(fakeCatIndex["end"].iloc[-1], len(fakeCat))
+        np.testing.assert_array_equal(fakeCatIndex["begin"].iloc[1:],
+                                      fakeCatIndex["end"].iloc[:-1])
+        decs = fakeCat[fakesConfig.decColName].to_numpy()
+        ras = np.mod(fakeCat[fakesConfig.raColName].to_numpy(), 2 * np.pi)
+        for _, zone in fakeCatIndex.iterrows():
+            zoneSlice = slice(int(zone["begin"]), int(zone["end"]))
+            self.assertTrue(np.all(decs[zoneSlice] >= zone["decMin"]))
+            self.assertTrue(np.all(decs[zoneSlice] < zone["decMax"]))
+            self.assertTrue(np.all(np.diff(ras[zoneSlice]) >= 0))
+
 
 class MemoryTester(lsst.utils.tests.MemoryTestCase):
     pass
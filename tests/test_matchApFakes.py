@@ -34,7 +34,8 @@ from lsst.pipe.base import testUtils
 import lsst.skymap as skyMap
 import lsst.utils.tests
 
-from lsst.ap.pipe.matchApFakes import MatchApFakesTask, MatchApFakesConfig
+from lsst.ap.pipe.matchApFakes import (MatchApFakesTask, MatchApFakesConfig,
+                                       MatchApFakesVisitTask, MatchApFakesVisitConfig)
 from lsst.ap.pipe.createApFakes import CreateRandomApFakesTask, CreateRandomApFakesConfig
 
 
@@ -167,12 +168,90 @@ class TestMatchApFakes(lsst.utils.tests.TestCase):
             len(self.sourceCat),
             np.sum(np.isfinite(result.matchedDiaSources["extraColumn"])))
 
+    def testRunWithColumns(self):
+        """Test matching catalogs read with only the configured columns.
+        """
+        matchFakesConfig = MatchApFakesConfig()
+        matchFakesConfig.matchDistanceArcseconds = 0.1
+        matchFakes = MatchApFakesTask(config=matchFakesConfig)
+        expected = matchFakes.run(self.fakeCat,
+                                  self.exposure,
+                                  self.sourceCat).matchedDiaSources
+
+        matchFakesConfig.fakeCatColumns = ["fakeId", matchFakesConfig.raColName]
+        matchFakesConfig.diaSourceColumns = ["extraColumn"]
+        fakeCatColumns = matchFakes.getFakeCatColumns()
+        diaSourceColumns = matchFakes.getDiaSourceColumns()
+        self.assertEqual(fakeCatColumns,
+                         [matchFakesConfig.raColName, matchFakesConfig.decColName, "fakeId"])
+        self.assertEqual(diaSourceColumns, ["ra", "decl", "diaSourceId", "extraColumn"])
+
+        result = matchFakes.run(self.fakeCat[fakeCatColumns],
+                                self.exposure,
+                                self.sourceCat[diaSourceColumns]).matchedDiaSources
+        self.assertEqual(set(result.columns), set(fakeCatColumns + diaSourceColumns))
+        pd.testing.assert_frame_equal(result, expected[result.columns])
+
+    def testRunVisit(self):
+        """Test that matching a visit at once gives the same results as
+        matching each detector separately.
+        """
+        matchFakesConfig = MatchApFakesConfig()
+        matchFakesConfig.matchDistanceArcseconds = 0.1
+        matchFakes = MatchApFakesTask(config=matchFakesConfig)
+        expected = matchFakes.run(self.fakeCat,
+                                  self.exposure,
+                                  self.sourceCat).matchedDiaSources
+
+        visitConfig = MatchApFakesVisitConfig()
+        visitConfig.matchDistanceArcseconds = 0.1
+        visitTask = MatchApFakesVisitTask(config=visitConfig)
+        # Identical detectors check that matches never cross detectors.
+        result = visitTask.run(self.fakeCat,
+                               [self.exposure, self.exposure],
+                               [self.sourceCat, self.sourceCat])
+        self.assertEqual(len(result.matchedDiaSources), 2)
+        for matched in result.matchedDiaSources:
+            pd.testing.assert_frame_equal(matched, expected)
+
     def testTrimCat(self):
         """Test that the correct number of sources are in the ccd area.
         """
         matchTask = MatchApFakesTask()
         result = matchTask._trimFakeCat(self.fakeCat, self.exposure)
         self.assertEqual(len(result), self.inExp.sum())
+        np.testing.assert_array_equal(result.index,
+                                      self.fakeCat.index[self.inExp])
+
+    def testBoundingCircleMask(self):
+        """Test that the sky prefilter keeps every fake on the image.
+        """
+        matchTask = MatchApFakesTask()
+        center, radius = matchTask._getBoundingCircle(
+            self.exposure.getWcs(),
+            geom.Box2D(self.exposure.getBBox()))
+        isNearby = matchTask._getBoundingCircleMask(
+            self.fakeCat[matchTask.config.raColName].to_numpy(),
+            self.fakeCat[matchTask.config.decColName].to_numpy(),
+            center,
+            radius)
+        self.assertTrue(np.all(isNearby[self.inExp]))
+        self.assertLess(isNearby.sum(), len(self.fakeCat))
+
+    def testTrimCatWithIndex(self):
+        """Test that trimming with the zone index selects the same fakes as
+        trimming the whole catalog.
+        """
+        fakesConfig = CreateRandomApFakesConfig()
+        fakesConfig.spatialIndexZoneHeight = 0.01
+        fakesTask = CreateRandomApFakesTask(config=fakesConfig)
+        sortedCat, fakeCatIndex = fakesTask.createSpatialIndex(self.fakeCat)
+
+        matchTask = MatchApFakesTask()
+        result = matchTask._trimFakeCat(sortedCat, self.exposure, fakeCatIndex)
+        expected = matchTask._trimFakeCat(sortedCat, self.exposure)
+        self.assertEqual(len(result), self.inExp.sum())
+        np.testing.assert_array_equal(result["fakeId"], expected["fakeId"])
 
 
 class MemoryTester(lsst.utils.tests.MemoryTestCase):
@@ -23,11 +23,13 @@
 import astropy.units as u
 import numpy as np
 import unittest
+from unittest.mock import Mock
 
 from lsst.pipe.base import testUtils
 import lsst.skymap as skyMap
 import lsst.utils.tests
 from lsst.verify import Name
+from lsst.verify.tasks import MetricComputationError
 from lsst.verify.tasks.testUtils import MetricTaskTestCase
 
 from lsst.ap.pipe.createApFakes import CreateRandomApFakesTask, CreateRandomApFakesConfig
@@ -118,6 +120,79 @@ class TestApCompletenessTask(MetricTaskTestCase):
         self.assertEqual(meas.metric_name, Name(metric="ap_pipe.apFakesCompleteness"))
         self.assertEqual(meas.quantity, 0 * u.dimensionless_unscaled)
 
+    def testWeighted(self):
+        """Test that doUseWeights weights each fake.
+        """
+        metricComplete = self.makeTask()
+        metricComplete.config.doUseWeights = True
+        isFound = self.fakeCat["diaSourceId"] > 0
+        weightedCat = self.fakeCat.assign(**{metricComplete.config.weightColName: isFound.astype(float)})
+        result = metricComplete.run(weightedCat, self.band)
+        testUtils.assertValidOutput(metricComplete, result)
+        self.assertEqual(result.measurement.quantity, 1 * u.dimensionless_unscaled)
+
+    def testBinned(self):
+        """Test the completeness curves computed with doBinned.
+        """
+        metricComplete = self.makeTask()
+        metricComplete.config.doBinned = True
+        metricComplete.config.magBinWidth = 1
+        metricComplete.config.bands = ["g", "r"]
+        result = metricComplete.run(self.fakeCat, self.band)
+        testUtils.assertValidOutput(metricComplete, result)
+
+        extras = result.measurement.extras
+        np.testing.assert_array_equal(extras["magBinEdges"].quantity.value, np.arange(20, 31))
+        for band in ["g", "r"]:
+            nPossible = extras[f"{band}NumPossible"].quantity.value
+            nFound = extras[f"{band}NumFound"].quantity.value
+            self.assertEqual(nPossible.sum(), len(self.fakeCat))
+            self.assertEqual(nFound.sum(), self.expectedAllMatched)
+            np.testing.assert_array_equal(nFound[5:], 0)
+            np.testing.assert_array_equal(extras[f"{band}Completeness"].quantity.value[5:], 0)
+
+    def testBinnedMissingBand(self):
+        """Test doBinned with a band that is not in the catalog.
+        """
+        metricComplete = self.makeTask()
+        metricComplete.config.doBinned = True
+        metricComplete.config.bands = ["g", "notABand"]
+        with self.assertRaises(MetricComputationError):
+            metricComplete.run(self.fakeCat, self.band)
+
+    def testMissingColumn(self):
+        """Test that a missing weight column is reported as a
+        MetricComputationError.
+        """
+        metricComplete = self.makeTask()
+        metricComplete.config.doUseWeights = True
+        with self.assertRaises(MetricComputationError):
+            metricComplete.run(self.fakeCat, self.band)
+
+    def testRunQuantumMissingColumns(self):
+        """Test that runQuantum reads only columns in the catalog, so that
+        missing columns are reported by run.
+        """
+        metricComplete = self.makeTask()
+        metricComplete.config.doBinned = True
+        metricComplete.config.bands = ["g", "notABand"]
+
+        def get(component=None, parameters=None):
+            if component == "columns":
+                return self.fakeCat.columns
+            return self.fakeCat[parameters["columns"]]
+
+        handle = Mock()
+        handle.get.side_effect = get
+        butlerQC = Mock()
+        butlerQC.get.return_value = {"matchedFakes": handle}
+        butlerQC.quantum.dataId = {"band": self.band}
+        metricComplete.runQuantum(butlerQC, Mock(), Mock())
+
+        handle.get.assert_called_with(parameters={"columns": [metricComplete.config.magVar % "g",
+                                                              "diaSourceId"]})
+        butlerQC.put.assert_not_called()
+
 
 # Hack around unittest's hacky test setup system
 del MetricTaskTestCase
@@ -0,0 +1,126 @@
+#
+# This file is part of ap_pipe.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+
+import lsst.utils.tests
+
+from lsst.ap.pipe.profiling import (StageProfiler, TargetCProfiler, readProfiles, summarizeProfiles,
+                                    getStageTimings, readStageTimings)
+
+
+class ProfilingTestSuite(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+
+    def testProfile(self):
+        """Test that each profiled stage is recorded and summarized.
+        """
+        profiler = StageProfiler(self.root)
+        for visit in range(10):
+            with profiler.profile("differencer", {"visit": visit, "ccd": 1}):
+                sum(range(1000))
+        with self.assertRaises(ValueError):
+            with profiler.profile("diaPipe", {"visit": 0, "ccd": 1}):
+                raise ValueError("Failures are profiled too")
+
+        records = readProfiles([self.root])
+        self.assertEqual(len(records), 11)
+        self.assertEqual(records[3]["dataId"], {"visit": 3, "ccd": 1})
+        for record in records:
+            self.assertGreaterEqual(record["wallTime"], 0.0)
+            self.assertGreaterEqual(record["cpuTime"], 0.0)
+            self.assertGreater(record["maxRss"], 0)
+
+        summary = summarizeProfiles(records)
+        self.assertEqual(summary.keys(), {"differencer", "diaPipe"})
+        self.assertEqual(summary["differencer"]["count"], 10)
+        wallTimes = summary["differencer"]["wallTime"]
+        self.assertEqual(wallTimes.keys(), {"p50", "p95", "p99"})
+        self.assertLessEqual(wallTimes["p50"], wallTimes["p99"])
+
+    def testReadStageTimings(self):
+        """Test that stage timings are read from profiles and from both JSON
+        summaries of them.
+        """
+        profileDir = os.path.join(self.root, "apPipe_profile")
+        profiler = StageProfiler(profileDir)
+        for record in [{"stage": "ccdProcessor", "dataId": {"visit": 1}, "cpuTime": 10.0},
+                       {"stage": "ccdProcessor", "dataId": {"visit": 2}, "cpuTime": 30.0},
+                       {"stage": "diaPipe", "dataId": {"visit": 1}, "cpuTime": 5.0}]:
+            profiler.write(record)
+        expected = {"ccdProcessor": 20.0, "diaPipe": 5.0}
+        self.assertEqual(readStageTimings(profileDir), expected)
+        self.assertEqual(readStageTimings(profiler.path), expected)
+
+        summary = summarizeProfiles(readProfiles([profileDir]))
+        for name, contents in [("summary.json", summary), ("timings.json", getStageTimings(summary))]:
+            path = os.path.join(self.root, name)
+            with open(path, "w") as f:
+                json.dump(contents, f)
+            self.assertEqual(readStageTimings(path), expected)
+
+        path = os.path.join(self.root, "bad.json")
+        with open(path, "w") as f:
+            json.dump({"ccdProcessor": "fast"}, f)
+        with self.assertRaises(ValueError):
+            readStageTimings(path)
+
+    def testCProfile(self):
+        """Test that only selected stages of selected targets are profiled.
+        """
+        profiler = TargetCProfiler(self.root, [{"visit": 42}, {"visit": 43, "ccd": 2}])
+        for visit in [41, 42, 43]:
+            for ccd in [1, 2]:
+                dataId = {"visit": visit, "ccd": ccd}
+                with profiler.profile("runDataRef", dataId):
+                    for stage in ["differencer", "diaPipe"]:
+                        with profiler.profile(stage, dataId):
+                            sorted(range(1000), reverse=True)
+
+        expected = {profiler.getPath(stage, dataId)
+                    for stage in ["differencer", "diaPipe"]
+                    for dataId in [{"visit": 42, "ccd": 1}, {"visit": 42, "ccd": 2}, {"visit": 43, "ccd": 2}]}
+        self.assertEqual({os.path.join(self.root, name) for name in os.listdir(self.root)}, expected)
+        stats = pstats.Stats(profiler.getPath("diaPipe", {"visit": 43, "ccd": 2}))
+        self.assertTrue(any(function[2] == "<built-in method builtins.sorted>" for function in stats.stats))
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
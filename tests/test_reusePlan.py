@@ -0,0 +1,88 @@
+#
+# This file is part of ap_pipe.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import lsst.utils.tests
+
+from lsst.ap.pipe.reusePlan import makeReusePlan
+
+
+class TemplateButler:
+    """A minimal butler that maps data IDs to files in a directory.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def getUri(self, datasetType, dataId=None, write=False):
+        if datasetType == "apdb_marker":
+            raise KeyError("No file template for %s" % datasetType)
+        return os.path.join(self.root, "%(visit)d" % dataId,
+                            "%s-%d.fits[0]" % (datasetType, dataId["ccd"]))
+
+
+class ReusePlanTestSuite(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        os.makedirs(os.path.join(self.root, "42"))
+        for name in ["calexp-1.fits", "calexp-2.fits", "deepDiff_diaSrc-1.fits"]:
+            open(os.path.join(self.root, "42", name), "w").close()
+
+    def testPlan(self):
+        """Test that the plan matches the files in the repository.
+        """
+        queries = [(datasetType, {"visit": visit, "ccd": ccd})
+                   for datasetType in ["calexp", "deepDiff_diaSrc", "apdb_marker"]
+                   for visit in [42, 43]
+                   for ccd in [1, 2]]
+        plan = makeReusePlan(TemplateButler(self.root), queries + queries)
+
+        self.assertTrue(plan.exists("calexp", {"ccd": 2, "visit": 42}))
+        self.assertTrue(plan.exists("deepDiff_diaSrc", {"visit": 42, "ccd": 1}))
+        self.assertFalse(plan.exists("deepDiff_diaSrc", {"visit": 42, "ccd": 2}))
+        self.assertFalse(plan.exists("calexp", {"visit": 43, "ccd": 1}))
+        # Datasets without files must be checked separately
+        self.assertIsNone(plan.exists("apdb_marker", {"visit": 42, "ccd": 1}))
+        self.assertEqual(len(plan), 8)
+
+        plan.setExists("calexp", {"visit": 43, "ccd": 1})
+        self.assertTrue(plan.exists("calexp", {"visit": 43, "ccd": 1}))
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
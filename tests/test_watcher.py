@@ -0,0 +1,154 @@
+#
+# This file is part of ap_pipe.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import lsst.utils.tests
+
+from lsst.ap.pipe.watcher import DirectoryWatcher
+
+
+class DirectoryWatcherTestSuite(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.pattern = r"(?P<visit>\d+)/raw-(?P<ccdnum>\d+)\.fits$"
+
+    def dropFile(self, visit, ccdnum, mtime=None):
+        """Simulate the arrival of a raw file.
+        """
+        directory = os.path.join(self.root, str(visit))
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "raw-%d.fits" % ccdnum)
+        with open(path, "w") as f:
+            f.write("SIMPLE")
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def testPoll(self):
+        """Test that each matching file is reported once, in order of arrival,
+        once it has settled.
+        """
+        watcher = DirectoryWatcher(self.root, self.pattern, keyTypes={"visit": int}, settleTime=0.5)
+        self.dropFile(410915, 25)
+        time.sleep(0.05)
+        self.dropFile(410915, 24)
+        open(os.path.join(self.root, "410915", "raw-24.fits.tmp"), "w").close()
+        self.assertEqual(watcher.poll(), [])
+
+        time.sleep(0.6)
+        self.dropFile(410915, 26)
+        arrivals = watcher.poll()
+        self.assertEqual([arrival.dataId for arrival in arrivals],
+                         [{"visit": 410915, "ccdnum": "25"}, {"visit": 410915, "ccdnum": "24"}])
+        self.assertLess(arrivals[0].time, arrivals[1].time)
+        self.assertEqual(watcher.poll(), [])
+
+        time.sleep(0.6)
+        self.assertEqual([arrival.dataId for arrival in watcher.poll()],
+                         [{"visit": 410915, "ccdnum": "26"}])
+
+    def testPollPreservedTime(self):
+        """Test that a file copied with an old modification time must settle,
+        and arrives when it was copied.
+        """
+        watcher = DirectoryWatcher(self.root, self.pattern, keyTypes={"visit": int, "ccdnum": int},
+                                   settleTime=0.5)
+        copied = time.time()
+        self.dropFile(410915, 1, mtime=copied - 3600)
+        self.assertEqual(watcher.poll(), [])
+
+        time.sleep(0.6)
+        arrivals = watcher.poll()
+        self.assertEqual([arrival.dataId for arrival in arrivals], [{"visit": 410915, "ccdnum": 1}])
+        self.assertAlmostEqual(arrivals[0].time, copied, delta=1.0)
+
+    def testPollChanges(self):
+        """Test that files renamed into the tree are reported, and that only
+        recent and unsettled files are remembered.
+        """
+        watcher = DirectoryWatcher(self.root, self.pattern, keyTypes={"visit": int, "ccdnum": int},
+                                   settleTime=0.5)
+        watcher._clockTolerance = 0.0
+        self.dropFile(410915, 1)
+        time.sleep(0.6)
+        self.assertEqual(len(watcher.poll()), 1)
+
+        # Fully written elsewhere, then moved into place with its old time
+        staging = tempfile.mkdtemp(dir=self.root, prefix=".staging")
+        stagedPath = os.path.join(staging, "raw-2.fits")
+        open(stagedPath, "w").close()
+        os.utime(stagedPath, (time.time() - 60, time.time() - 60))
+        os.makedirs(os.path.join(self.root, "410916"))
+        os.rename(stagedPath, os.path.join(self.root, "410916", "raw-2.fits"))
+        self.assertEqual(watcher.poll(), [])
+
+        # Changing the directory of an unsettled file must not lose it
+        time.sleep(0.3)
+        self.dropFile(410916, 3)
+        time.sleep(0.3)
+        self.assertEqual([arrival.dataId for arrival in watcher.poll()], [{"visit": 410916, "ccdnum": 2}])
+        time.sleep(0.3)
+        self.assertEqual([arrival.dataId for arrival in watcher.poll()], [{"visit": 410916, "ccdnum": 3}])
+
+        time.sleep(0.05)
+        self.assertEqual(watcher.poll(), [])
+        self.assertEqual(watcher._recent, {})
+        self.assertEqual(watcher._unsettled, set())
+
+    def testWatch(self):
+        """Test that files dropped while watching are all reported.
+        """
+        def dropFiles():
+            for ccdnum in range(1, 6):
+                time.sleep(0.05)
+                self.dropFile(410916, ccdnum)
+
+        dropper = threading.Thread(target=dropFiles)
+        dropper.start()
+        watcher = DirectoryWatcher(self.root, self.pattern, keyTypes={"visit": int, "ccdnum": int})
+        seen = [arrival.dataId["ccdnum"]
+                for arrivals in watcher.watch(interval=0.01, idleTimeout=1.0)
+                for arrival in arrivals]
+        dropper.join()
+        self.assertEqual(seen, [1, 2, 3, 4, 5])
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()